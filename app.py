@@ -1,406 +1,101 @@
+import contextlib
 import datetime as dt
+import hmac
+import os
+from concurrent.futures import as_completed
+
 import pandas as pd
 import streamlit as st
-import plotly.express as px
-from sqlalchemy import create_engine, text
-import sqlite3
+
+from kpi_engine import (
+    COMPARE_MODES, DB_PROFILE, FILTER_OPS, HEADLINE_MEASURES, RESULT_CACHE, SCHEMA_STATS, TABLE_VERSIONS,
+    QueryInterrupted, cache_memory, comparison_window, data_version, engine, get_query, kpi_columns, kpi_formats,
+    kpi_tables,
+    load_headline_periods, load_page, page_cursor, process_memory, set_error_handler, set_thread_profile,
+    submit_kpis, window_bounds,
+)
+from kpi_charts import chart
+from kpi_cube import FILTER_DIMENSIONS, FORMATS as CUBE_FORMATS, dimension_members, load_cube, refresh as refresh_cube
+from kpi_profile import RunProfile
+from kpi_service import serve_in_background
+import kpi_approx
+import kpi_fact
+import kpi_prefix
+import kpi_schema
+import kpi_stock
 
 # ── 1. Set Streamlit page config ───────────────────────────────────────────
 st.set_page_config(page_title="Supply-Chain KPI Dashboard", layout="wide")
 
+# Profiling (see kpi_profile): ?profile=1 or the Diagnostics button profiles exactly one run, for admins only.
+# Admins are the pages opened with ?admin=<KPI_ADMIN_TOKEN>; without the token nobody is, and
+# KPI_ADMIN_TOKEN=* makes every session an admin (local development only).
+ADMIN_TOKEN = os.environ.get("KPI_ADMIN_TOKEN", "")
+is_admin = ADMIN_TOKEN == "*" or (
+    bool(ADMIN_TOKEN) and hmac.compare_digest(st.query_params.get("admin", ""), ADMIN_TOKEN))
+abandoned = st.session_state.pop("active_profile", None)
+if abandoned is not None:
+    abandoned.stop()  # a rerun cut the profiled run short
+run_profile = None
+if is_admin and (st.session_state.pop("profile_next_run", False) or st.query_params.get("profile") == "1"):
+    run_profile = RunProfile()
+    run_profile.start()
+    st.session_state["active_profile"] = run_profile
+    if "profile" in st.query_params:
+        del st.query_params["profile"]
+set_thread_profile(run_profile)
+
+
+def timed(section, step):
+    """Time a block into this run's profile when the run is profiled."""
+    return run_profile.step(section, step) if run_profile is not None else contextlib.nullcontext()
+
+
 # ── 2. DB Engine and Query Functions ────────────────────────────────────────
-engine = create_engine("sqlite:///mydb.db")
-
-
-def get_query(query_name):
-    queries = {
-        "dbo.usp_KPI_SalesVsPurchases": """
-            SELECT 
-                (SELECT SUM(ExtendedPrice)
-                 FROM SalesInvoiceLines
-                 WHERE LastEditedWhen BETWEEN ? AND ?) AS TotalSales,
-                (SELECT SUM(ExpectedUnitPricePerOuter * OrderedOuters) 
-                 FROM PurchaseOrderLines 
-                 WHERE LastReceiptDate BETWEEN ? AND ?) AS TotalPurchases
-        """,
-
-        "dbo.usp_KPI_AvgMarginPerProductWithGroup": """
-            SELECT 
-                si.StockItemID,
-                si.StockItemName,
-                sg.StockGroupID,
-                sg.StockGroupName,
-                AVG(il.LineProfit) AS AvgMargin,
-                COUNT(DISTINCT il.InvoiceID) AS InvoiceCount,
-                SUM(il.LineProfit) AS TotalProfit,
-                SUM(il.ExtendedPrice) AS TotalRevenue,
-                ROUND(
-                    SUM(il.LineProfit) * 1.0
-                    / NULLIF(SUM(il.ExtendedPrice), 0)
-                    * 100, 2
-                ) AS MarginPct
-            FROM SalesInvoiceLines AS il
-            JOIN WarehouseStockItem AS si
-                ON si.StockItemID = il.StockItemID
-            LEFT JOIN StockItemsStockGroups AS sisg
-                ON sisg.StockItemID = si.StockItemID
-            LEFT JOIN WarehouseStockGroups AS sg
-                ON sg.StockGroupID = sisg.StockGroupID
-            WHERE il.LastEditedWhen BETWEEN ? AND ?
-            GROUP BY
-                si.StockItemID,
-                si.StockItemName,
-                sg.StockGroupID,
-                sg.StockGroupName
-            ORDER BY AvgMargin DESC
-        """,
-
-        "dbo.usp_KPI_DealCoverage": """
-            SELECT
-                (SELECT COUNT(DISTINCT StockGroupID)
-                 FROM SalesSpecialDeals
-                 WHERE StockGroupID IS NOT NULL) AS GroupsWithDeals,
-                (SELECT COUNT(*) FROM WarehouseStockGroups) AS TotalGroups,
-                ROUND(
-                    CAST((SELECT COUNT(DISTINCT StockGroupID)
-                          FROM SalesSpecialDeals
-                          WHERE StockGroupID IS NOT NULL) AS REAL)
-                    / NULLIF((SELECT COUNT(*) FROM WarehouseStockGroups), 0) * 100.0,
-                    2
-                ) AS DealCoveragePercent
-        """,
-
-        "dbo.usp_KPI_StockMovementVolume": """
-            SELECT 
-                SUM(Quantity) AS TotalMovementVolume
-            FROM StockItemTransactions
-            WHERE TransactionOccurredWhen BETWEEN ? AND ?
-        """,
-
-        "dbo.usp_KPI_MostDiscountedClients": """
-            SELECT
-                bg.BuyingGroupName AS ClientGroup,
-                ROUND(SUM(COALESCE(sd.DiscountPercentage, 0.0)), 2) AS TotalDiscountPct,
-                COUNT(sd.SpecialDealID) AS DealCount,
-                ROUND(AVG(COALESCE(sd.DiscountPercentage, 0.0)), 2) AS AvgDiscount,
-                ROUND(MAX(COALESCE(sd.DiscountPercentage, 0.0)), 2) AS MaxDiscount
-            FROM SalesBuyingGroups AS bg
-            LEFT JOIN SalesSpecialDeals AS sd
-                ON bg.BuyingGroupID = sd.BuyingGroupID
-                AND sd.DiscountPercentage IS NOT NULL
-            GROUP BY bg.BuyingGroupName
-            HAVING COUNT(sd.SpecialDealID) > 0
-            ORDER BY SUM(COALESCE(sd.DiscountPercentage, 0.0)) DESC
-            LIMIT ?
-        """,
-
-        "dbo.usp_KPI_SupplierPerformance": """
-            WITH Receipts AS (
-                SELECT
-                    sit.SupplierID,
-                    sit.TransactionOccurredWhen AS ReceiptDate,
-                    sit.Quantity
-                FROM StockItemTransactions sit
-                JOIN ApplicationTransactionTypes tt
-                    ON tt.TransactionTypeID = sit.TransactionTypeID
-                WHERE tt.TransactionTypeName = 'Stock Receipt'
-                    AND sit.SupplierID IS NOT NULL
-            ),
-            Numbered AS (
-                SELECT
-                    SupplierID,
-                    Quantity,
-                    ReceiptDate,
-                    LAG(ReceiptDate) OVER(
-                        PARTITION BY SupplierID ORDER BY ReceiptDate
-                    ) AS PrevReceipt
-                FROM Receipts
-            )
-            SELECT
-                s.SupplierID,
-                sp.SupplierName,
-                COUNT(*) AS ReceiptEvents,
-                SUM(s.Quantity) AS TotalQtyReceived,
-                AVG(julianday(s.ReceiptDate) - julianday(s.PrevReceipt)) AS AvgDaysBetweenReceipts
-            FROM Numbered s
-            JOIN PurchasingSuppliers sp
-                ON sp.SupplierID = s.SupplierID
-            WHERE s.PrevReceipt IS NOT NULL
-            GROUP BY s.SupplierID, sp.SupplierName
-            ORDER BY TotalQtyReceived DESC
-        """,
-
-        "dbo.usp_KPI_PromoPerformance": """
-            SELECT
-                COUNT(DISTINCT sd.SpecialDealID) AS ActiveDeals,
-                ROUND(AVG(COALESCE(sd.DiscountPercentage, 0.0)), 2) AS AvgDiscountPct,
-                ROUND(MAX(COALESCE(sd.DiscountPercentage, 0.0)), 2) AS MaxDiscountPct,
-                COUNT(DISTINCT sd.StockGroupID) AS GroupsWithDeals,
-                COUNT(DISTINCT sd.BuyingGroupID) AS BuyingGroupsWithDeals
-            FROM SalesSpecialDeals sd
-            WHERE sd.DiscountPercentage IS NOT NULL
-        """,
-
-        "dbo.usp_KPI_TransactionDistribution": """
-            SELECT 
-                tt.TransactionTypeName,
-                COUNT(*) AS TxnCount,
-                COUNT(*) * 100.0 / SUM(COUNT(*)) OVER() AS PctShare
-            FROM StockItemTransactions sit
-            JOIN ApplicationTransactionTypes tt 
-                ON sit.TransactionTypeID = tt.TransactionTypeID
-            WHERE sit.TransactionOccurredWhen BETWEEN ? AND ?
-            GROUP BY tt.TransactionTypeName
-            ORDER BY TxnCount DESC
-        """,
-
-        "dbo.usp_KPI_GrossProfit": """
-            SELECT 
-                SUM(LineProfit) AS TotalProfit,
-                SUM(ExtendedPrice) AS TotalRevenue,
-                (SUM(LineProfit) * 1.0) / NULLIF(SUM(ExtendedPrice), 0) AS GrossMarginPct
-            FROM SalesInvoiceLines
-        """,
-
-        "dbo.usp_KPI_COGSvsPurchases": """
-            SELECT 
-                SUM(ExtendedPrice - LineProfit) AS COGS,
-                (SELECT SUM(ExpectedUnitPricePerOuter * OrderedOuters) 
-                 FROM PurchaseOrderLines) AS TotalPurchases
-            FROM SalesInvoiceLines
-        """,
-
-        "dbo.usp_KPI_PromoDealsByStockGroup": """
-            SELECT
-                grp.StockGroupID,
-                grp.StockGroupName,
-                COUNT(DISTINCT sd.SpecialDealID) AS DealCount,
-                COUNT(DISTINCT COALESCE(sd.StockItemID, sisg2.StockItemID)) AS AffectedItems,
-                ROUND(AVG(COALESCE(sd.DiscountPercentage, 0.0)), 2) AS AvgDiscountPct
-            FROM WarehouseStockGroups AS grp
-            LEFT JOIN SalesSpecialDeals AS sd
-                ON grp.StockGroupID = sd.StockGroupID
-                OR grp.StockGroupID IN (
-                    SELECT sisg.StockGroupID 
-                    FROM StockItemsStockGroups sisg 
-                    WHERE sisg.StockItemID = sd.StockItemID
-                )
-            LEFT JOIN StockItemsStockGroups AS sisg2
-                ON sisg2.StockGroupID = grp.StockGroupID
-            GROUP BY grp.StockGroupID, grp.StockGroupName
-            ORDER BY DealCount DESC
-        """,
-
-        "dbo.usp_KPI_PromoPerformanceByBuyingGroup": """
-            SELECT
-                bg.BuyingGroupID,
-                bg.BuyingGroupName,
-                COUNT(DISTINCT sd.SpecialDealID) AS DealCount,
-                ROUND(AVG(COALESCE(sd.DiscountPercentage, 0.0)), 2) AS AvgDiscountPct,
-                SUM(COALESCE(il.ExtendedPrice, 0)) AS SalesDuringDeals,
-                SUM(COALESCE(il.LineProfit, 0)) AS ProfitDuringDeals
-            FROM SalesBuyingGroups AS bg
-            LEFT JOIN SalesSpecialDeals AS sd
-                ON bg.BuyingGroupID = sd.BuyingGroupID
-            LEFT JOIN StockItemsStockGroups AS sisg
-                ON sisg.StockItemID = sd.StockItemID
-            LEFT JOIN WarehouseStockGroups AS grp
-                ON grp.StockGroupID = COALESCE(sisg.StockGroupID, sd.StockGroupID)
-            LEFT JOIN StockItemsStockGroups AS sisg2
-                ON sisg2.StockGroupID = grp.StockGroupID
-            LEFT JOIN SalesInvoiceLines AS il
-                ON il.StockItemID = sisg2.StockItemID
-            GROUP BY
-                bg.BuyingGroupID,
-                bg.BuyingGroupName
-            ORDER BY SalesDuringDeals DESC
-        """,
-
-        "dbo.usp_KPI_SupposedTaxAmount": """
-            SELECT 
-                il.TaxRate,
-                SUM(ROUND(
-                    il.ExtendedPrice
-                    * (il.TaxRate / (100.0 + il.TaxRate)),
-                    2
-                )) AS ExpectedTaxAmount,
-                SUM(il.TaxAmount) AS RecordedTaxAmount,
-                SUM(il.TaxAmount) - SUM(ROUND(
-                    il.ExtendedPrice
-                    * (il.TaxRate / (100.0 + il.TaxRate)),
-                    2
-                )) AS TaxVariance
-            FROM SalesInvoiceLines il
-            WHERE il.LastEditedWhen BETWEEN ? AND ?
-            GROUP BY il.TaxRate
-        """,
-
-        "dbo.usp_KPI_SalesByStockGroup": """
-            WITH SalesLines AS (
-                SELECT
-                    il.StockItemID,
-                    il.Quantity,
-                    il.LineProfit,
-                    il.ExtendedPrice,
-                    si.CustomerID
-                FROM SalesInvoiceLines AS il
-                LEFT JOIN SalesInvoices AS si
-                    ON si.InvoiceID = il.InvoiceID
-                WHERE il.LastEditedWhen BETWEEN ? AND ?
-            ),
-            SalesWithGroups AS (
-                SELECT
-                    COALESCE(sisg.StockGroupID, sg0.StockGroupID) AS StockGroupID,
-                    sl.Quantity,
-                    sl.LineProfit,
-                    sl.ExtendedPrice,
-                    sl.CustomerID
-                FROM SalesLines AS sl
-                LEFT JOIN StockItemsStockGroups AS sisg
-                    ON sisg.StockItemID = sl.StockItemID
-                LEFT JOIN WarehouseStockGroups AS sg0
-                    ON sg0.StockGroupID = sisg.StockGroupID
-            )
-            SELECT
-                sg.StockGroupID,
-                sg.StockGroupName,
-                SUM(swg.Quantity) AS TotalUnitsSold,
-                SUM(swg.LineProfit) AS TotalProfit,
-                SUM(swg.ExtendedPrice) AS TotalRevenue,
-                ROUND(
-                    SUM(swg.LineProfit) * 1.0
-                    / NULLIF(SUM(swg.ExtendedPrice), 0)
-                    * 100, 2
-                ) AS GrossMarginPct
-            FROM SalesWithGroups AS swg
-            JOIN WarehouseStockGroups AS sg
-                ON sg.StockGroupID = swg.StockGroupID
-            GROUP BY
-                sg.StockGroupID,
-                sg.StockGroupName
-            ORDER BY TotalUnitsSold DESC
-        """,
-
-        "dbo.usp_KPI_CustomerSegmentSales": """
-            SELECT
-                cc.CustomerCategoryName,
-                COUNT(DISTINCT sit.CustomerID) AS Customers,
-                COUNT(*) AS ShipmentEvents,
-                SUM(ABS(sit.Quantity)) AS TotalQtyShipped
-            FROM StockItemTransactions sit
-            JOIN SalesCustomers c
-                ON c.CustomerID = sit.CustomerID
-            JOIN SalesCustomersCategories cc
-                ON cc.CustomerCategoryID = c.CustomerCategoryID
-            WHERE sit.CustomerID IS NOT NULL
-                AND sit.TransactionTypeID = 10
-            GROUP BY cc.CustomerCategoryName
-            ORDER BY TotalQtyShipped DESC
-        """,
-
-        "dbo.usp_KPI_ProductImbalance_SingleRow": """
-            WITH
-            Sales AS (
-                SELECT StockItemID, SUM(Quantity) AS QtySold
-                FROM SalesInvoiceLines
-                WHERE LastEditedWhen BETWEEN ? AND ?
-                GROUP BY StockItemID
-            ),
-            Purch AS (
-                SELECT
-                    pol.StockItemID,
-                    po.SupplierID,
-                    SUM(pol.OrderedOuters) AS QtyPurchased
-                FROM PurchaseOrderLines pol
-                JOIN PurchaseOrders po
-                    ON po.PurchaseOrderID = pol.PurchaseOrderID
-                WHERE pol.LastReceiptDate BETWEEN ? AND ?
-                GROUP BY pol.StockItemID, po.SupplierID
-            ),
-            Imb AS (
-                SELECT
-                    pur.StockItemID,
-                    pur.SupplierID,
-                    COALESCE(pur.QtyPurchased, 0) AS QtyPurchased,
-                    COALESCE(sal.QtySold, 0) AS QtySold,
-                    COALESCE(pur.QtyPurchased, 0) - COALESCE(sal.QtySold, 0) AS NetBuildUp,
-                    CASE
-                        WHEN COALESCE(sal.QtySold, 0) = 0 THEN NULL
-                        ELSE CAST(pur.QtyPurchased AS REAL) / sal.QtySold
-                    END AS PurchaseToSalesRatio
-                FROM Purch pur
-                LEFT JOIN Sales sal
-                    ON sal.StockItemID = pur.StockItemID
-            )
-            SELECT
-                i.StockItemID,
-                si.StockItemName,
-                GROUP_CONCAT(sg.StockGroupName, ', ') AS StockGroupNames,
-                i.SupplierID,
-                sup.SupplierName,
-                i.QtyPurchased,
-                i.QtySold,
-                i.NetBuildUp,
-                i.PurchaseToSalesRatio
-            FROM Imb i
-            JOIN WarehouseStockItem si
-                ON si.StockItemID = i.StockItemID
-            JOIN PurchasingSuppliers sup
-                ON sup.SupplierID = i.SupplierID
-            LEFT JOIN StockItemsStockGroups sisg
-                ON sisg.StockItemID = i.StockItemID
-            LEFT JOIN WarehouseStockGroups sg
-                ON sg.StockGroupID = sisg.StockGroupID
-            GROUP BY
-                i.StockItemID,
-                si.StockItemName,
-                i.SupplierID,
-                sup.SupplierName,
-                i.QtyPurchased,
-                i.QtySold,
-                i.NetBuildUp,
-                i.PurchaseToSalesRatio
-            ORDER BY NetBuildUp DESC
-            LIMIT ?
-        """,
-
-        # Data validation query
-        "check_special_deals": """
-            SELECT 
-                COUNT(*) as TotalRecords,
-                COUNT(StockGroupID) as RecordsWithStockGroupID,
-                COUNT(BuyingGroupID) as RecordsWithBuyingGroupID,
-                COUNT(DiscountPercentage) as RecordsWithDiscount,
-                ROUND(AVG(COALESCE(DiscountPercentage, 0.0)), 2) as AvgDiscountPct,
-                ROUND(MAX(COALESCE(DiscountPercentage, 0.0)), 2) as MaxDiscountPct,
-                COUNT(DISTINCT StockGroupID) as UniqueStockGroups,
-                COUNT(DISTINCT BuyingGroupID) as UniqueBuyingGroups
-            FROM SalesSpecialDeals
-        """
-    }
-    return queries.get(query_name, "")
+set_error_handler(st.error)
 
 
-def run_proc(proc_name: str, params=()):
-    query = get_query(proc_name)
-    if not query:
-        return pd.DataFrame()  # Return empty DataFrame if query not found
+@st.cache_resource
+def start_kpi_service(port):
+    """Serve the KPI HTTP API from this process so it shares the dashboard's result cache."""
+    return serve_in_background(port)
 
-    # For procedures with specific parameter handling
-    if proc_name == "dbo.usp_KPI_SalesVsPurchases":
-        # This proc needs date parameters twice (for sales and purchases)
-        return pd.read_sql(query, engine, params=(params[0], params[1], params[0], params[1]))
-    elif proc_name == "dbo.usp_KPI_ProductImbalance_SingleRow":
-        # This proc needs start_date, end_date, start_date, end_date, limit
-        if len(params) == 3:  # If called with (start_date, end_date, limit)
-            return pd.read_sql(query, engine, params=(params[0], params[1], params[0], params[1], params[2]))
 
-    # Default parameter handling
-    try:
-        return pd.read_sql(query, engine, params=params)
-    except Exception as e:
-        st.error(f"Error executing query {proc_name}: {e}")
-        return pd.DataFrame()  # Return empty DataFrame on error
+if os.environ.get("KPI_SERVICE_PORT"):
+    start_kpi_service(int(os.environ["KPI_SERVICE_PORT"]))
+
+
+@st.cache_resource
+def ensure_summaries(version):
+    """Add any missing derived columns, then fold new rows into the drill-down cube, sales fact, day sketches
+    and stock balances once per database version."""
+    for label, update in (("Derived measure columns", kpi_schema.migrate), ("Drill-down cube", refresh_cube),
+                          ("Sales fact", kpi_fact.refresh), ("Approximate-mode sketches", kpi_approx.refresh),
+                          ("Stock balances", kpi_stock.refresh)):
+        try:
+            update()
+        except Exception as e:
+            st.warning(f"{label} could not be refreshed: {e}")
+
+
+# An immutable snapshot is never written, so its summaries must be built beforehand
+if DB_PROFILE != "immutable":
+    ensure_summaries(data_version())
+
+
+@st.cache_resource
+def window_index():
+    """Answer the additive window KPIs from prefix sums, kept current in the background."""
+    return kpi_prefix.install()
+
+
+WINDOW_INDEX = window_index()
+
+
+@st.cache_resource
+def approx_preview():
+    """Day sketches and row samples for approximate previews, kept current in the background."""
+    return kpi_approx.install()
 
 
 def check_special_deals_data():
@@ -419,8 +114,39 @@ MAX_DATE = dt.date(2016, 12, 31)
 st.sidebar.header("Date Window")
 start_date = st.sidebar.date_input("Start date", MIN_DATE, MIN_DATE, MAX_DATE)
 end_date = st.sidebar.date_input("End date", MAX_DATE, MIN_DATE, MAX_DATE)
-sd = dt.datetime.combine(start_date, dt.time.min)
-ed = dt.datetime.combine(end_date, dt.time.max)
+sd, ed = window_bounds(start_date, end_date)
+compare_mode = st.sidebar.selectbox("Compare to", COMPARE_MODES)
+compare_dates = comparison_window(start_date, end_date, compare_mode)
+if compare_dates:
+    st.sidebar.caption(f"Comparing with {compare_dates[0]:%Y-%m-%d} → {compare_dates[1]:%Y-%m-%d}")
+
+st.sidebar.markdown("---")
+st.sidebar.header("🔎 Drill-down Filters")
+drill_filters = []
+for dim, label in FILTER_DIMENSIONS.items():
+    members = dimension_members(dim)
+    names = dict(zip(members.iloc[:, 0], members.iloc[:, 1]))
+    selected = st.sidebar.multiselect(label, list(names), format_func=names.get, key=f"drill_{dim}")
+    if selected:
+        drill_filters.append((dim, tuple(sorted(selected))))
+drill_filters = tuple(drill_filters)
+# Sales sections read from the cube while filters are set; the others say they are not filtered
+unfiltered_note = ("ℹ️ Not filtered by the drill-down filters ("
+                   + ", ".join(FILTER_DIMENSIONS[dim].lower() for dim, _ in drill_filters) + ")"
+                   if drill_filters else None)
+
+st.sidebar.markdown("---")
+st.sidebar.header("📡 Live Mode")
+# ?live=1 starts a wall screen in live mode
+live = st.sidebar.toggle("Auto-refresh", st.query_params.get("live") == "1",
+                         help="Re-render sections on a timer; a KPI only reloads once a table it reads has changed")
+live_every = st.sidebar.select_slider("Check every (s)", [2, 5, 10, 30, 60], value=5, disabled=not live)
+
+st.sidebar.markdown("---")
+st.sidebar.header("≈ Approximate Mode")
+approx = st.sidebar.toggle("Preview heavy KPIs", st.query_params.get("approx") == "1",
+                           help="Show estimates with 95% confidence intervals from sketches and a row sample "
+                                "while the exact figures load")
 
 # Add SalesSpecialDeals validation button in sidebar
 st.sidebar.markdown("---")
@@ -440,98 +166,97 @@ if st.sidebar.button("Check SalesSpecialDeals"):
 
 
 # ── 4. Load KPI DataFrames ─────────────────────────────────────────────────
-@st.cache_data(ttl=600)
-def load_kpis(s, e):
+# KPI results and table pages live in the engine's process-wide cache, under
+# one memory budget (KPI_CACHE_MB), and KPIs load on its shared background
+# executor, so concurrent sessions asking for the same KPI and window share a
+# single query execution.
+def _parse_filter_value(value, op):
+    if op == "contains":
+        return value
     try:
-        return {
-            "sales_vs_pur": run_proc("dbo.usp_KPI_SalesVsPurchases", (s, e)),
-            "avg_margin_with_group": run_proc("dbo.usp_KPI_AvgMarginPerProductWithGroup", (s, e)),
-            "deal_cov": run_proc("dbo.usp_KPI_DealCoverage", ()),
-            "movement": run_proc("dbo.usp_KPI_StockMovementVolume", (s, e)),
-            "top_clients": run_proc("dbo.usp_KPI_MostDiscountedClients", (10,)),
-            "supplier_perf": run_proc("dbo.usp_KPI_SupplierPerformance", ()),
-            "promo_perf": run_proc("dbo.usp_KPI_PromoPerformance", ()),
-            "txn_dist": run_proc("dbo.usp_KPI_TransactionDistribution", (s, e)),
-            "gross": run_proc("dbo.usp_KPI_GrossProfit", ()),
-            "cogs_vs_po": run_proc("dbo.usp_KPI_COGSvsPurchases", ()),
-            "promo_by_group": run_proc("dbo.usp_KPI_PromoDealsByStockGroup", ()),
-            "promo_by_buy": run_proc("dbo.usp_KPI_PromoPerformanceByBuyingGroup", ()),
-            "tax_variance": run_proc("dbo.usp_KPI_SupposedTaxAmount", (s, e)),
-            "sales_by_group": run_proc("dbo.usp_KPI_SalesByStockGroup", (s, e)),
-            "cust_seg": run_proc("dbo.usp_KPI_CustomerSegmentSales", ()),
-            "imbalance": run_proc("dbo.usp_KPI_ProductImbalance_SingleRow", (sd, ed, 10)),
-        }
-    except Exception as e:
-        st.error(f"Error loading KPI data: {e}")
-        return {
-            "sales_vs_pur": pd.DataFrame(),
-            "avg_margin_with_group": pd.DataFrame(),
-            "deal_cov": pd.DataFrame(),
-            "movement": pd.DataFrame(),
-            "top_clients": pd.DataFrame(),
-            "supplier_perf": pd.DataFrame(),
-            "promo_perf": pd.DataFrame(),
-            "txn_dist": pd.DataFrame(),
-            "gross": pd.DataFrame(),
-            "cogs_vs_po": pd.DataFrame(),
-            "promo_by_group": pd.DataFrame(),
-            "promo_by_buy": pd.DataFrame(),
-            "tax_variance": pd.DataFrame(),
-            "sales_by_group": pd.DataFrame(),
-            "cust_seg": pd.DataFrame(),
-            "imbalance": pd.DataFrame(),
-        }
-
+        number = float(value)
+    except ValueError:
+        return value
+    return int(number) if number.is_integer() else number
+
+
+def column_config(formats, columns):
+    """Grid column configs for ``formats`` (column -> NumberColumn format) on the columns shown.
+
+    The browser formats the cells, so the frame goes out numeric and still sorts as numbers.
+    """
+    return {col: st.column_config.NumberColumn(format=fmt) for col, fmt in formats.items() if col in columns}
+
+
+def paginated_table(name, s, e):
+    """Detail table for a KPI, streamed from SQL one keyset page at a time."""
+    columns = kpi_columns(name)
+    c1, c2, c3, c4, c5, c6 = st.columns([2, 1, 2, 1, 2, 1])
+    sort_col = c1.selectbox("Sort by", ["(default)"] + columns, key=f"{name}_sort")
+    descending = c2.toggle("Desc", True, key=f"{name}_desc")
+    filter_col = c3.selectbox("Filter column", ["(none)"] + columns, key=f"{name}_filter_col")
+    op = c4.selectbox("Op", list(FILTER_OPS), key=f"{name}_filter_op")
+    value = c5.text_input("Value", key=f"{name}_filter_value")
+    page_size = c6.selectbox("Rows", [25, 50, 100, 250], key=f"{name}_page_size")
+
+    order_by = None if sort_col == "(default)" else ((sort_col, "DESC" if descending else "ASC"),)
+    filters = ()
+    if filter_col != "(none)" and value != "":
+        filters = ((filter_col, op, _parse_filter_value(value, op)),)
+
+    # Keyset cursors of the pages visited so far; reset when the query changes
+    pager = st.session_state.setdefault(f"{name}_pager", {"signature": None, "cursors": [None]})
+    signature = (s, e, order_by, filters, page_size)
+    if pager["signature"] != signature:
+        pager["signature"], pager["cursors"] = signature, [None]
 
-@st.cache_data(ttl=600)
-def load_trend(s, e):
-    sql = text("""
-        WITH Sales AS (
-            SELECT 
-                strftime('%Y-%m-01', LastEditedWhen) AS Period,
-                SUM(ExtendedPrice) AS Sales
-            FROM SalesInvoiceLines
-            WHERE LastEditedWhen BETWEEN :start AND :end
-            GROUP BY strftime('%Y-%m', LastEditedWhen)
-        ), Purchases AS (
-            SELECT 
-                strftime('%Y-%m-01', LastReceiptDate) AS Period,
-                SUM(ExpectedUnitPricePerOuter * OrderedOuters) AS Purchases
-            FROM PurchaseOrderLines
-            WHERE LastReceiptDate BETWEEN :start AND :end
-            GROUP BY strftime('%Y-%m', LastReceiptDate)
-        )
-        SELECT 
-            COALESCE(s.Period, p.Period) AS Period,
-            COALESCE(s.Sales, 0) AS Sales,
-            COALESCE(p.Purchases, 0) AS Purchases
-        FROM Sales s
-        LEFT JOIN Purchases p ON s.Period = p.Period
-        UNION ALL
-        SELECT 
-            p.Period,
-            0 AS Sales,
-            p.Purchases
-        FROM Purchases p
-        WHERE p.Period NOT IN (SELECT Period FROM Sales)
-        ORDER BY Period;
-    """)
     try:
-        return pd.read_sql(sql, engine, params={"start": s, "end": e})
-    except Exception as e:
-        st.error(f"Error loading trend data: {e}")
-        return pd.DataFrame(columns=["Period", "Sales", "Purchases"])
+        # One extra row tells us whether a next page exists
+        page = load_page(name, s, e, order_by, filters, pager["cursors"][-1], page_size + 1)
+    except QueryInterrupted as exc:
+        st.warning(f"⏱️ {exc}. Try a narrower filter or rerun to retry.")
+        return
+    has_next = len(page) > page_size
+    page = page.iloc[:page_size]
+    st.dataframe(page, column_config=column_config(kpi_formats(name), page.columns))
+
+    prev_col, info_col, next_col = st.columns([1, 4, 1])
+    if prev_col.button("◀ Prev", key=f"{name}_prev", disabled=len(pager["cursors"]) == 1):
+        pager["cursors"].pop()
+        st.rerun()
+    if next_col.button("Next ▶", key=f"{name}_next", disabled=not has_next):
+        pager["cursors"].append(page_cursor(page, name, order_by))
+        st.rerun()
+    info_col.caption(f"Page {len(pager['cursors'])}")
 
 
 try:
-    kpis = load_kpis(sd, ed)
-    trend = load_trend(sd, ed)
-
-    # ── 5. Fix AvgMargin dtype so nlargest works ───────────────────────────────
-    if not kpis["avg_margin_with_group"].empty and "AvgMargin" in kpis["avg_margin_with_group"].columns:
-        kpis["avg_margin_with_group"]["AvgMargin"] = pd.to_numeric(
-            kpis["avg_margin_with_group"]["AvgMargin"], errors="coerce"
-        )
+    # ── 5. Start every KPI in the background, cheapest first ──────────────────
+    # KPI frames are shared across sessions: never modify them in place.
+    if run_profile is not None:
+        run_profile.record("page", "setup", run_profile.elapsed())
+    futures = submit_kpis(sd, ed, profile=run_profile)
+    # A rerun supersedes the previous run's loads; cancel whatever it left behind
+    superseded = st.session_state.get("kpi_batch")
+    if superseded is not None:
+        superseded.cancel()
+    st.session_state["kpi_batch"] = futures
+    kpis, interrupted = {}, set()
+
+
+    def kpi(name):
+        """Wait for a KPI's background load; errors it reported are shown here, once."""
+        if name not in kpis:
+            try:
+                with timed(name, "wait"):
+                    kpis[name], errors = futures[name].result()
+            except QueryInterrupted as exc:
+                kpis[name], errors = pd.DataFrame(), []
+                interrupted.add(name)
+                st.warning(f"⏱️ {exc}. Narrow the date window or rerun to retry.")
+            for message in errors:
+                st.error(message)
+        return kpis[name]
 
 
     # ── 6. Helper to safely extract a single value ─────────────────────────────
@@ -539,287 +264,636 @@ try:
         return df[col].iloc[0] if col in df.columns and not df.empty and pd.notna(df[col].iloc[0]) else default
 
 
-    # ── 7. Extract headline metrics ────────────────────────────────────────────
-    sales = get_first(kpis["sales_vs_pur"], "TotalSales")
-    purch = get_first(kpis["sales_vs_pur"], "TotalPurchases")
-    profit = get_first(kpis["gross"], "TotalProfit")
-    margin = get_first(kpis["gross"], "GrossMarginPct")
-    cogs = get_first(kpis["cogs_vs_po"], "COGS")
-    total_txn = int(kpis["txn_dist"]["TxnCount"].sum() if "TxnCount" in kpis["txn_dist"].columns and not kpis[
-        "txn_dist"].empty else 0)
-    mov = get_first(kpis["movement"], "TotalMovementVolume")
-    cov = get_first(kpis["deal_cov"], "DealCoveragePercent")
-    deals = int(get_first(kpis["promo_perf"], "ActiveDeals"))
-    avg_disc = get_first(kpis["promo_perf"], "AvgDiscountPct") / 100.0
-    max_disc = get_first(kpis["promo_perf"], "MaxDiscountPct") / 100.0
+    # ── 7. Page skeleton: every section gets a placeholder up front ────────────
+    st.title("📊 Optimisation de la chaîne d'approvisionnement")
+    headline_slots = [st.empty() for _ in range(3)]
+    for slot in headline_slots:
+        slot.caption("⏳ Loading metrics…")
+    st.subheader("🏷️ Top 10 Most-Discounted Clients")
+    clients_slot = st.empty()
+    clients_slot.caption("⏳ Loading…")
+
+    TAB_SECTIONS = {
+        "trend": "📊 Sales vs Purchases Trend",
+        "avg_margin_with_group": "📈 Margin by Product",
+        "supplier_perf": "🚚 Supplier Performance",
+        "sales_by_group": "🛒 Sales by Stock Group",
+        "cust_seg": "👥 Customer Segments",
+        "txn_dist": "🔄 Transaction Mix",
+        "promo_by_group": "🎯 Promo by Stock Group",
+        "promo_by_buy": "👥 Promo by Buying Group",
+        "tax_variance": "💲 Tax Analysis",
+        "imbalance": "📦 Imbalance",
+        "stock_on_hand": "🏬 Stock on Hand",
+        "drilldown": "🔎 Drill-down",
+    }
+    tab_slots = {}
+    for name, tab in zip(TAB_SECTIONS, st.tabs(list(TAB_SECTIONS.values()))):
+        with tab:
+            tab_slots[name] = st.empty()
+            tab_slots[name].caption("⏳ Loading…")
+
+
+    def show(slot, section, render, names=()):
+        """Fill a section's placeholder.
+
+        In live mode the section is a fragment re-run every ``live_every``
+        seconds on its own; its KPIs reload only once a table they read has
+        changed, otherwise it redraws from the frames it already holds.
+        """
+        if not live:
+            with slot.container(), timed(section, "render"):
+                render()
+            return
+        tables = sorted({table for name in names for table in kpi_tables(name)})
+
+        def refresh():
+            seen = st.session_state.setdefault("live_versions", {})
+            versions = TABLE_VERSIONS.version(tables)
+            if seen.get(section, versions) != versions:
+                futures.update(submit_kpis(sd, ed, names))
+                for name in names:
+                    kpis.pop(name, None)
+                    interrupted.discard(name)
+            seen[section] = versions
+            with timed(section, "render"):
+                render()
+
+        with slot.container():
+            st.fragment(refresh, run_every=live_every)()
+
 
     # ── 8. Headline metrics display ────────────────────────────────────────────
-    st.title("📊 Optimisation de la chaîne d'approvisionnement")
-    c1, c2, c3, c4 = st.columns(4)
-    c1.metric("Total Sales", f"${sales:,.2f}")
-    c2.metric("Total Profit", f"${profit:,.2f}")
-    c3.metric("Gross Margin", f"{margin:.1%}")
-    c4.metric("Total Purchases", f"${purch:,.2f}")
+    HEADLINE_KPIS = ["sales_vs_pur", "gross", "cogs_vs_po"]
+
+
+    def headline_figures():
+        """Headline measures of the window and, when comparing, their deltas."""
+        figures = {
+            "TotalSales": get_first(kpi("sales_vs_pur"), "TotalSales"),
+            "TotalPurchases": get_first(kpi("sales_vs_pur"), "TotalPurchases"),
+            "TotalProfit": get_first(kpi("gross"), "TotalProfit"),
+            "GrossMarginPct": get_first(kpi("gross"), "GrossMarginPct"),
+            "COGS": get_first(kpi("cogs_vs_po"), "COGS"),
+        }
+        deltas = {}
+        if compare_dates:
+            # Both periods from one query; profit, margin and COGS become window-scoped
+            periods = load_headline_periods(sd, ed, *window_bounds(*compare_dates))
+            if not periods.empty:
+                current, previous = periods.loc["current"].fillna(0), periods.loc["comparison"].fillna(0)
+                figures = {col: current[col] for col in HEADLINE_MEASURES}
+                for col in HEADLINE_MEASURES:
+                    if col == "GrossMarginPct":
+                        deltas[col] = f"{(current[col] - previous[col]) * 100:+.1f} pp"
+                    elif previous[col]:
+                        deltas[col] = f"{current[col] / previous[col] - 1:+.1%}"
+        return figures, deltas
+
+
+    # Headline measure -> cube_query measure
+    CUBE_HEADLINE = {"TotalSales": "Revenue", "TotalProfit": "Profit", "GrossMarginPct": "GrossMarginPct"}
+
+
+    def filtered_headline_figures():
+        """headline_figures with the sales measures taken from the cube under the drill-down filters."""
+        figures, deltas = headline_figures()
+        totals = load_cube(sd, ed, drill_filters)
+        previous = load_cube(*window_bounds(*compare_dates), drill_filters) if compare_dates else None
+        for col, measure in CUBE_HEADLINE.items():
+            figures[col] = get_first(totals, measure)
+            deltas.pop(col, None)
+            if previous is None:
+                continue
+            if col == "GrossMarginPct":
+                deltas[col] = f"{(figures[col] - get_first(previous, measure)) * 100:+.1f} pp"
+            elif get_first(previous, measure):
+                deltas[col] = f"{figures[col] / get_first(previous, measure) - 1:+.1%}"
+        return figures, deltas
+
+
+    def render_headline():
+        figures, deltas = filtered_headline_figures() if drill_filters else headline_figures()
+        c1, c2, c3, c4 = st.columns(4)
+        c1.metric("Total Sales", f"${figures['TotalSales']:,.2f}", deltas.get("TotalSales"))
+        c2.metric("Total Profit", f"${figures['TotalProfit']:,.2f}", deltas.get("TotalProfit"))
+        c3.metric("Gross Margin", f"{figures['GrossMarginPct']:.1%}", deltas.get("GrossMarginPct"))
+        c4.metric("Total Purchases", f"${figures['TotalPurchases']:,.2f}", deltas.get("TotalPurchases"))
+        if compare_dates:
+            st.caption(f"Deltas vs {compare_dates[0]:%Y-%m-%d} → {compare_dates[1]:%Y-%m-%d}; "
+                       "profit, margin and COGS are for the selected window.")
+        if drill_filters:
+            st.caption("🔎 Sales, profit and margin are filtered; total purchases are not.")
+
 
     # ── 9. Cost & inventory metrics ───────────────────────────────────────────
-    c5, c6, c7 = st.columns(3)
-    c5.metric("COGS", f"${cogs:,.2f}")
-    c6.metric("Total Transactions", f"{total_txn:,}")
-    c7.metric("Stock Movement Vol.", f"{mov:,}")
+    def render_inventory():
+        if drill_filters:
+            st.caption(unfiltered_note)
+        figures, deltas = headline_figures()
+        mov = get_first(kpi("movement"), "TotalMovementVolume")
+        txn_dist = kpi("txn_dist")
+        total_txn = int(txn_dist["TxnCount"].sum() if "TxnCount" in txn_dist.columns and not txn_dist.empty else 0)
+        c5, c6, c7 = st.columns(3)
+        c5.metric("COGS", f"${figures['COGS']:,.2f}", deltas.get("COGS"), delta_color="inverse")
+        c6.metric("Total Transactions", f"{total_txn:,}")
+        c7.metric("Stock Movement Vol.", f"{mov:,}")
+
 
     # ── 10. Performance & promotions metrics ──────────────────────────────────
-    p1, p2, p3, p4 = st.columns(4)
-    p1.metric("Deal Coverage", f"{cov:.1f}%")
-    p2.metric("Active Deals", f"{deals}")
-    p3.metric("Avg Discount %", f"{avg_disc:.1%}")
-    p4.metric("Max Discount %", f"{max_disc:.1%}")
+    def render_promotions():
+        if drill_filters:
+            st.caption(unfiltered_note)
+        cov = get_first(kpi("deal_cov"), "DealCoveragePercent")
+        deals = int(get_first(kpi("promo_perf"), "ActiveDeals"))
+        avg_disc = get_first(kpi("promo_perf"), "AvgDiscountPct") / 100.0
+        max_disc = get_first(kpi("promo_perf"), "MaxDiscountPct") / 100.0
+        p1, p2, p3, p4 = st.columns(4)
+        p1.metric("Deal Coverage", f"{cov:.1f}%")
+        p2.metric("Active Deals", f"{deals}")
+        p3.metric("Avg Discount %", f"{avg_disc:.1%}")
+        p4.metric("Max Discount %", f"{max_disc:.1%}")
+
 
     # ── 11. Top-discounted clients ─────────────────────────────────────────────
-    st.subheader("🏷️ Top 10 Most-Discounted Clients")
-    if not kpis["top_clients"].empty:
-        # Display with better formatting
-        display_df = kpis["top_clients"].copy()
-        if "TotalDiscountPct" in display_df.columns:
-            display_df["TotalDiscountPct"] = display_df["TotalDiscountPct"].apply(lambda x: f"{x:.2f}%")
-        if "AvgDiscount" in display_df.columns:
-            display_df["AvgDiscount"] = display_df["AvgDiscount"].apply(lambda x: f"{x:.2f}%")
-        st.dataframe(display_df)
-    else:
-        st.warning("⚠️ No client discount data available - check SalesSpecialDeals table")
+    def render_clients():
+        if drill_filters:
+            st.caption(unfiltered_note)
+        if not kpi("top_clients").empty:
+            with timed("clients", "table"):
+                df = kpi("top_clients")
+                st.dataframe(df, column_config=column_config(kpi_formats("top_clients"), df.columns))
+        else:
+            st.warning("⚠️ No client discount data available - check SalesSpecialDeals table")
 
-    # ── 12. Section Tabs ────────────────────────────────────────────────────────
-    tabs = st.tabs([
-        "📊 Sales vs Purchases Trend",
-        "📈 Margin by Product",
-        "🚚 Supplier Performance",
-        "🛒 Sales by Stock Group",
-        "👥 Customer Segments",
-        "🔄 Transaction Mix",
-        "🎯 Promo by Stock Group",
-        "👥 Promo by Buying Group",
-        "💲 Tax Analysis",
-        "📦 Imbalance",
-    ])
 
+    show(headline_slots[0], "headline", render_headline, HEADLINE_KPIS)
+    show(headline_slots[1], "inventory", render_inventory, HEADLINE_KPIS + ["movement", "txn_dist"])
+    show(headline_slots[2], "promotions", render_promotions, ["deal_cov", "promo_perf"])
+    show(clients_slot, "clients", render_clients, ["top_clients"])
+
+    # ── 12. Section Tabs ────────────────────────────────────────────────────────
+    # Each tab renders one KPI frame
     # Trend chart
-    with tabs[0]:
+    def render_trend(trend):
         st.subheader("Monthly Sales vs Purchases")
         if not trend.empty and "Period" in trend.columns and "Sales" in trend.columns and "Purchases" in trend.columns:
             try:
-                trend["Period"] = pd.to_datetime(trend["Period"])
-                fig = px.line(trend, x="Period", y=["Sales", "Purchases"],
-                              labels={"value": "Amount ($)", "Period": "Month"})
-                st.plotly_chart(fig, use_container_width=True)
+                plot_df = trend.assign(Period=pd.to_datetime(trend["Period"]))
+                with timed("trend", "figure"):
+                    fig = chart("line", plot_df, x="Period", y=["Sales", "Purchases"],
+                                labels={"value": "Amount ($)", "Period": "Month"})
+                    st.plotly_chart(fig, use_container_width=True)
             except Exception as e:
                 st.error(f"Error creating trend chart: {e}")
         else:
             st.warning("No trend data available for the selected date range")
 
-        st.dataframe(trend.style.format({"Sales": "${:,.2f}", "Purchases": "${:,.2f}"}))
+        with timed("trend", "table"):
+            st.dataframe(trend, column_config=column_config(kpi_formats("trend"), trend.columns))
 
     # Margin by Product (with Group)
-    with tabs[1]:
+    def render_avg_margin_with_group(df):
         st.subheader("Average Margin per Product (Top 10)")
 
-        if not kpis["avg_margin_with_group"].empty and "AvgMargin" in kpis["avg_margin_with_group"].columns:
+        if not df.empty and "AvgMargin" in df.columns:
             try:
-                df_mg = kpis["avg_margin_with_group"].nlargest(10, "AvgMargin")
+                df_mg = df  # already the top 10 by AvgMargin
                 if not df_mg.empty and "StockItemName" in df_mg.columns and "AvgMargin" in df_mg.columns:
-                    fig = px.bar(
-                        df_mg,
-                        x="StockItemName",
-                        y="AvgMargin",
-                        color="StockGroupName",
-                        labels={
-                            "StockItemName": "Product",
-                            "AvgMargin": "Avg Margin",
-                            "StockGroupName": "Product Group"
-                        }
-                    )
-                    st.plotly_chart(fig, use_container_width=True)
-                    st.dataframe(df_mg)
+                    with timed("avg_margin_with_group", "figure"):
+                        fig = chart(
+                                    "bar",
+                                    df_mg,
+                                    x="StockItemName",
+                                    y="AvgMargin",
+                                    color="StockGroupName",
+                                    labels={
+                                    "StockItemName": "Product",
+                                    "AvgMargin": "Avg Margin",
+                                    "StockGroupName": "Product Group"
+                                    }
+                                    )
+                        st.plotly_chart(fig, use_container_width=True)
+                    with timed("avg_margin_with_group", "table"):
+                        paginated_table("avg_margin_with_group", sd, ed)
                 else:
                     st.warning("Insufficient data to display the margin chart")
             except Exception as e:
                 st.error(f"Error creating margin chart: {e}")
         else:
             st.warning("No margin data available for the selected date range")
-            st.dataframe(kpis["avg_margin_with_group"])
+            st.dataframe(df)
 
     # Supplier Performance
-    with tabs[2]:
+    def render_supplier_perf(df):
         st.subheader("Top Suppliers by Quantity Received")
 
-        if not kpis["supplier_perf"].empty and "TotalQtyReceived" in kpis["supplier_perf"].columns:
+        if not df.empty and "TotalQtyReceived" in df.columns:
             try:
-                df_sup = kpis["supplier_perf"].nlargest(20, "TotalQtyReceived")
+                df_sup = df  # already the top 20 by TotalQtyReceived
                 if not df_sup.empty and "SupplierName" in df_sup.columns:
-                    fig = px.bar(df_sup, x="SupplierName", y="TotalQtyReceived")
-                    st.plotly_chart(fig, use_container_width=True)
-                    st.dataframe(df_sup)
+                    with timed("supplier_perf", "figure"):
+                        fig = chart("bar", df_sup, x="SupplierName", y="TotalQtyReceived")
+                        st.plotly_chart(fig, use_container_width=True)
+                    with timed("supplier_perf", "table"):
+                        paginated_table("supplier_perf", sd, ed)
                 else:
                     st.warning("Insufficient data to display the supplier performance chart")
             except Exception as e:
                 st.error(f"Error creating supplier chart: {e}")
         else:
             st.warning("No supplier performance data available")
-            st.dataframe(kpis["supplier_perf"])
+            st.dataframe(df)
 
     # Sales by Stock Group
-    with tabs[3]:
+    def render_sales_by_group(df):
         st.subheader("Units Sold & Profit by Stock Group")
 
-        if not kpis["sales_by_group"].empty and "StockGroupName" in kpis["sales_by_group"].columns:
+        if not df.empty and "StockGroupName" in df.columns:
             try:
-                df_sbg = kpis["sales_by_group"]
+                df_sbg = df
                 if "TotalUnitsSold" in df_sbg.columns and "TotalProfit" in df_sbg.columns:
-                    fig = px.bar(df_sbg, x="StockGroupName", y=["TotalUnitsSold", "TotalProfit"], barmode="group")
-                    st.plotly_chart(fig, use_container_width=True)
-                    st.dataframe(df_sbg)
+                    with timed("sales_by_group", "figure"):
+                        fig = chart("bar", df_sbg, x="StockGroupName", y=["TotalUnitsSold", "TotalProfit"],
+                                    barmode="group")
+                        st.plotly_chart(fig, use_container_width=True)
+                    with timed("sales_by_group", "table"):
+                        paginated_table("sales_by_group", sd, ed)
                 else:
                     st.warning("Missing required columns for sales by group chart")
             except Exception as e:
                 st.error(f"Error creating sales by group chart: {e}")
         else:
             st.warning("No sales by stock group data available for the selected date range")
-            st.dataframe(kpis["sales_by_group"])
+            st.dataframe(df)
 
     # Customer Segments
-    with tabs[4]:
+    def render_cust_seg(df):
         st.subheader("Quantity Shipped by Customer Category")
 
-        if not kpis["cust_seg"].empty and "CustomerCategoryName" in kpis["cust_seg"].columns:
+        if not df.empty and "CustomerCategoryName" in df.columns:
             try:
-                df_cs = kpis["cust_seg"]
+                df_cs = df
                 if "TotalQtyShipped" in df_cs.columns:
-                    fig = px.bar(df_cs, x="CustomerCategoryName", y="TotalQtyShipped")
-                    st.plotly_chart(fig, use_container_width=True)
-                    st.dataframe(df_cs)
+                    with timed("cust_seg", "figure"):
+                        fig = chart("bar", df_cs, x="CustomerCategoryName", y="TotalQtyShipped")
+                        st.plotly_chart(fig, use_container_width=True)
+                    with timed("cust_seg", "table"):
+                        paginated_table("cust_seg", sd, ed)
                 else:
                     st.warning("Missing required columns for customer segments chart")
             except Exception as e:
                 st.error(f"Error creating customer segments chart: {e}")
         else:
             st.warning("No customer segment data available")
-            st.dataframe(kpis["cust_seg"])
+            st.dataframe(df)
 
     # Transaction Mix
-    with tabs[5]:
+    def render_txn_dist(df):
         st.subheader("Transaction Type Distribution")
 
-        if not kpis["txn_dist"].empty and "TransactionTypeName" in kpis["txn_dist"].columns:
+        if not df.empty and "TransactionTypeName" in df.columns:
             try:
-                df_tx = kpis["txn_dist"]
+                df_tx = df
                 if "TxnCount" in df_tx.columns and not df_tx["TxnCount"].sum() == 0:
-                    fig = px.pie(df_tx, names="TransactionTypeName", values="TxnCount")
-                    st.plotly_chart(fig, use_container_width=True)
-                    st.dataframe(df_tx)
+                    with timed("txn_dist", "figure"):
+                        fig = chart("pie", df_tx, names="TransactionTypeName", values="TxnCount")
+                        st.plotly_chart(fig, use_container_width=True)
+                    with timed("txn_dist", "table"):
+                        paginated_table("txn_dist", sd, ed)
                 else:
                     st.warning("No transaction count data available")
             except Exception as e:
                 st.error(f"Error creating transaction distribution chart: {e}")
         else:
             st.warning("No transaction distribution data available for the selected date range")
-            st.dataframe(kpis["txn_dist"])
+            st.dataframe(df)
 
     # Promo by Stock Group
-    with tabs[6]:
+    def render_promo_by_group(df):
         st.subheader("Deals by Stock Group")
 
-        if not kpis["promo_by_group"].empty and "StockGroupName" in kpis["promo_by_group"].columns:
+        if not df.empty and "StockGroupName" in df.columns:
             try:
-                df_ps = kpis["promo_by_group"]
+                df_ps = df
                 # Filter out groups with zero deals for cleaner visualization
                 df_ps_filtered = df_ps[df_ps["DealCount"] > 0] if "DealCount" in df_ps.columns else df_ps
 
                 if not df_ps_filtered.empty and "DealCount" in df_ps_filtered.columns:
-                    fig = px.bar(df_ps_filtered, x="StockGroupName", y="DealCount",
-                                 hover_data=["AvgDiscountPct", "AffectedItems"])
-                    st.plotly_chart(fig, use_container_width=True)
-                    st.dataframe(df_ps)
+                    with timed("promo_by_group", "figure"):
+                        fig = chart("bar", df_ps_filtered, x="StockGroupName", y="DealCount",
+                                    hover_data=["AvgDiscountPct", "AffectedItems"])
+                        st.plotly_chart(fig, use_container_width=True)
+                    with timed("promo_by_group", "table"):
+                        paginated_table("promo_by_group", sd, ed)
                 else:
                     st.warning("No active deals found by stock group")
-                    st.dataframe(df_ps)
+                    with timed("promo_by_group", "table"):
+                        paginated_table("promo_by_group", sd, ed)
             except Exception as e:
                 st.error(f"Error creating promo by stock group chart: {e}")
         else:
             st.warning("⚠️ No deals by stock group—verify SalesSpecialDeals mapping.")
-            st.dataframe(kpis["promo_by_group"])
+            st.dataframe(df)
 
     # Promo by Buying Group
-    with tabs[7]:
+    def render_promo_by_buy(df):
         st.subheader("Deals by Buying Group")
 
-        if not kpis["promo_by_buy"].empty and "BuyingGroupName" in kpis["promo_by_buy"].columns:
+        if not df.empty and "BuyingGroupName" in df.columns:
             try:
-                df_pb = kpis["promo_by_buy"]
+                df_pb = df
                 # Filter out groups with zero deals
                 df_pb_filtered = df_pb[df_pb["DealCount"] > 0] if "DealCount" in df_pb.columns else df_pb
 
                 if not df_pb_filtered.empty and "DealCount" in df_pb_filtered.columns:
-                    fig = px.bar(df_pb_filtered, x="BuyingGroupName", y="DealCount",
-                                 hover_data=["AvgDiscountPct", "SalesDuringDeals"])
-                    st.plotly_chart(fig, use_container_width=True)
-                    st.dataframe(df_pb)
+                    with timed("promo_by_buy", "figure"):
+                        fig = chart("bar", df_pb_filtered, x="BuyingGroupName", y="DealCount",
+                                    hover_data=["AvgDiscountPct", "SalesDuringDeals"])
+                        st.plotly_chart(fig, use_container_width=True)
+                    with timed("promo_by_buy", "table"):
+                        paginated_table("promo_by_buy", sd, ed)
                 else:
                     st.warning("No active deals found by buying group")
-                    st.dataframe(df_pb)
+                    with timed("promo_by_buy", "table"):
+                        paginated_table("promo_by_buy", sd, ed)
             except Exception as e:
                 st.error(f"Error creating promo by buying group chart: {e}")
         else:
             st.warning("⚠️ No deals by buying group—verify SalesSpecialDeals mapping.")
-            st.dataframe(kpis["promo_by_buy"])
+            st.dataframe(df)
 
     # Tax Analysis
-    with tabs[8]:
+    def render_tax_variance(df):
         st.subheader("Expected vs Recorded Tax by Rate")
 
-        if not kpis["tax_variance"].empty and "TaxRate" in kpis["tax_variance"].columns:
+        if not df.empty and "TaxRate" in df.columns:
             try:
-                df_tv = kpis["tax_variance"]
+                df_tv = df
                 if "ExpectedTaxAmount" in df_tv.columns and "RecordedTaxAmount" in df_tv.columns:
-                    fig2 = px.bar(df_tv, x="TaxRate", y=["ExpectedTaxAmount", "RecordedTaxAmount"], barmode="group")
-                    st.plotly_chart(fig2, use_container_width=True)
-                    st.dataframe(df_tv.style.format({
-                        "ExpectedTaxAmount": "${:,.2f}",
-                        "RecordedTaxAmount": "${:,.2f}",
-                        "TaxVariance": "${:,.2f}"
-                    }))
+                    with timed("tax_variance", "figure"):
+                        fig2 = chart("bar", df_tv, x="TaxRate", y=["ExpectedTaxAmount", "RecordedTaxAmount"],
+                                     barmode="group")
+                        st.plotly_chart(fig2, use_container_width=True)
+                    with timed("tax_variance", "table"):
+                        paginated_table("tax_variance", sd, ed)
                 else:
                     st.warning("Missing required columns for tax analysis chart")
             except Exception as e:
                 st.error(f"Error creating tax analysis chart: {e}")
         else:
             st.warning("No tax variance data available for the selected date range")
-            st.dataframe(kpis["tax_variance"])
+            st.dataframe(df)
 
     # Imbalance
-    with tabs[9]:
+    def render_imbalance(df):
         st.subheader("Top 10 Products by Purchase–Sales Buildup")
 
-        if not kpis["imbalance"].empty and "StockItemName" in kpis["imbalance"].columns:
+        if not df.empty and "StockItemName" in df.columns:
             try:
-                df_im = kpis["imbalance"]
+                df_im = df
                 if "NetBuildUp" in df_im.columns and "StockGroupNames" in df_im.columns:
-                    fig = px.bar(df_im,
-                                 x="StockItemName",
-                                 y="NetBuildUp",
-                                 color="StockGroupNames",
-                                 hover_data=["SupplierName", "QtyPurchased", "QtySold", "PurchaseToSalesRatio"])
-                    st.plotly_chart(fig, use_container_width=True)
-                    st.dataframe(df_im.style.format({
-                        "QtyPurchased": "{:,}",
-                        "QtySold": "{:,}",
-                        "NetBuildUp": "{:,}",
-                        "PurchaseToSalesRatio": ".2f"
-                    }))
+                    with timed("imbalance", "figure"):
+                        fig = chart("bar", df_im,
+                                    x="StockItemName",
+                                    y="NetBuildUp",
+                                    color="StockGroupNames",
+                                    hover_data=["SupplierName", "QtyPurchased", "QtySold", "PurchaseToSalesRatio"])
+                        st.plotly_chart(fig, use_container_width=True)
+                    with timed("imbalance", "table"):
+                        paginated_table("imbalance", sd, ed)
                 else:
                     st.warning("Missing required columns for product imbalance chart")
             except Exception as e:
                 st.error(f"Error creating product imbalance chart: {e}")
         else:
             st.warning("No product imbalance data available for the selected date range")
-            st.dataframe(kpis["imbalance"])
+            st.dataframe(df)
+
+    # Stock on hand: month-end levels over the window and on-hand at its end
+    def render_stock_on_hand(df):
+        st.subheader("Inventory Levels")
+        levels = kpi("stock_levels")
+        if not levels.empty and "TotalOnHand" in levels.columns:
+            try:
+                with timed("stock_on_hand", "figure"):
+                    fig = chart("line", levels, x="Period", y="TotalOnHand", markers=True,
+                                hover_data=["ItemsInStock", "ItemsOutOfStock"],
+                                labels={"TotalOnHand": "Units on hand (month-end)", "Period": "Month"})
+                    st.plotly_chart(fig, use_container_width=True)
+            except Exception as e:
+                st.error(f"Error creating inventory levels chart: {e}")
+        else:
+            st.caption("No month-end falls inside the selected date range.")
+
+        st.subheader(f"On Hand at {ed:%Y-%m-%d} (Top 20)")
+        if not df.empty and "QuantityOnHand" in df.columns:
+            try:
+                with timed("stock_on_hand", "figure"):
+                    fig = chart("bar", df, x="StockItemName", y="QuantityOnHand")
+                    st.plotly_chart(fig, use_container_width=True)
+                with timed("stock_on_hand", "table"):
+                    paginated_table("stock_on_hand", sd, ed)
+
+                items = dict(zip(df["StockItemID"], df["StockItemName"]))
+                item = st.selectbox("Item history", list(items), format_func=items.get, key="stock_history_item")
+                history = kpi_stock.item_history(item, sd, ed)
+                with timed("stock_on_hand", "figure"):
+                    fig = chart("line", history, x="Period", y="QuantityOnHand", markers=True,
+                                labels={"QuantityOnHand": "Units on hand", "Period": "Month-end"})
+                    st.plotly_chart(fig, use_container_width=True)
+            except Exception as e:
+                st.error(f"Error creating stock on hand chart: {e}")
+        else:
+            st.warning("No stock on hand data available - check that the stock balances were built")
+            st.dataframe(df)
+
+    # Drill-down: sales measures sliced by the sidebar filters, aggregated from the cube
+    def render_drilldown():
+        st.subheader("Sales Drill-down")
+        if drill_filters:
+            st.caption("Filtered by " + "; ".join(f"{FILTER_DIMENSIONS[dim]}: {len(ids)} selected"
+                                                   for dim, ids in drill_filters))
+        else:
+            st.caption("Pick stock groups, buying groups, suppliers or customer categories in the sidebar to slice.")
+        try:
+            totals = load_cube(sd, ed, drill_filters)
+            d1, d2, d3, d4, d5 = st.columns(5)
+            d1.metric("Sales", f"${get_first(totals, 'Revenue'):,.2f}")
+            d2.metric("Profit", f"${get_first(totals, 'Profit'):,.2f}")
+            d3.metric("Gross Margin", f"{get_first(totals, 'GrossMarginPct'):.1%}")
+            d4.metric("Units Sold", f"{int(get_first(totals, 'Quantity')):,}")
+            d5.metric("Tax Recorded", f"${get_first(totals, 'TaxAmount'):,.2f}")
+
+            breakdown = st.radio("Break down by", list(FILTER_DIMENSIONS) + ["StockItemID"], horizontal=True,
+                                 format_func=lambda dim: FILTER_DIMENSIONS.get(dim, "Product"))
+            df_dd = load_cube(sd, ed, drill_filters, by=breakdown)
+            if not df_dd.empty:
+                with timed("drilldown", "figure"):
+                    fig = chart("bar", df_dd, x=df_dd.columns[1], y=["Revenue", "Profit"], barmode="group")
+                    st.plotly_chart(fig, use_container_width=True)
+                with timed("drilldown", "table"):
+                    st.dataframe(df_dd, column_config=column_config(CUBE_FORMATS, df_dd.columns))
+            else:
+                st.warning("No sales match the selected filters in this date range")
+        except Exception as e:
+            st.error(f"Error loading drill-down data: {e}")
+
+    # Sales tabs while drill-down filters are set: their additive measures, aggregated from the cube
+    def render_filtered_trend():
+        st.subheader("Monthly Sales (filtered)")
+        st.caption("🔎 Sales are filtered; purchases are not kept per sales dimension and are left out.")
+        df = load_cube(sd, ed, drill_filters, by="Period")[["Period", "Revenue"]].rename(columns={"Revenue": "Sales"})
+        if df.empty:
+            st.warning("No sales match the selected filters in this date range")
+            return
+        with timed("trend", "figure"):
+            fig = chart("line", df.assign(Period=pd.to_datetime(df["Period"])), x="Period", y="Sales",
+                        labels={"Sales": "Amount ($)", "Period": "Month"})
+            st.plotly_chart(fig, use_container_width=True)
+        with timed("trend", "table"):
+            st.dataframe(df, column_config=column_config(kpi_formats("trend"), df.columns))
+
+    def render_filtered_avg_margin_with_group():
+        st.subheader("Average Margin per Product (Top 10, filtered)")
+        st.caption("🔎 Filtered; invoice counts are not additive and are left out.")
+        df = load_cube(sd, ed, drill_filters, by="StockItemID").nlargest(10, "AvgMargin")
+        if df.empty:
+            st.warning("No sales match the selected filters in this date range")
+            return
+        df = df[["StockItemID", "StockItemName", "AvgMargin", "Profit", "Revenue", "GrossMarginPct"]]
+        with timed("avg_margin_with_group", "figure"):
+            fig = chart("bar", df, x="StockItemName", y="AvgMargin",
+                        labels={"StockItemName": "Product", "AvgMargin": "Avg Margin"})
+            st.plotly_chart(fig, use_container_width=True)
+        with timed("avg_margin_with_group", "table"):
+            st.dataframe(df, column_config=column_config(CUBE_FORMATS, df.columns))
+
+    def render_filtered_sales_by_group():
+        st.subheader("Units Sold & Profit by Stock Group (filtered)")
+        st.caption("🔎 Filtered; a line counts towards every group of its item, as in the unfiltered tab.")
+        df = load_cube(sd, ed, drill_filters, by="StockGroupID")
+        df = df[df["StockGroupID"] != 0].rename(columns={"Quantity": "TotalUnitsSold", "Profit": "TotalProfit",
+                                                         "Revenue": "TotalRevenue"})
+        if df.empty:
+            st.warning("No sales match the selected filters in this date range")
+            return
+        df = df[["StockGroupID", "StockGroupName", "TotalUnitsSold", "TotalProfit", "TotalRevenue", "GrossMarginPct"]]
+        with timed("sales_by_group", "figure"):
+            fig = chart("bar", df, x="StockGroupName", y=["TotalUnitsSold", "TotalProfit"], barmode="group")
+            st.plotly_chart(fig, use_container_width=True)
+        with timed("sales_by_group", "table"):
+            st.dataframe(df, column_config=column_config(CUBE_FORMATS, df.columns))
+
+
+    # Tabs fill in as their KPIs finish, not in tab order
+    pending = {futures[name]: name for name in TAB_SECTIONS if name in futures}
+    renderers = {
+        "trend": render_trend,
+        "avg_margin_with_group": render_avg_margin_with_group,
+        "supplier_perf": render_supplier_perf,
+        "sales_by_group": render_sales_by_group,
+        "cust_seg": render_cust_seg,
+        "txn_dist": render_txn_dist,
+        "promo_by_group": render_promo_by_group,
+        "promo_by_buy": render_promo_by_buy,
+        "tax_variance": render_tax_variance,
+        "imbalance": render_imbalance,
+        "stock_on_hand": render_stock_on_hand,
+    }
+    filtered_renderers = {
+        "trend": render_filtered_trend,
+        "avg_margin_with_group": render_filtered_avg_margin_with_group,
+        "sales_by_group": render_filtered_sales_by_group,
+    }
+    # Tabs drawing on more than their own KPI
+    TAB_KPIS = {"stock_on_hand": ["stock_on_hand", "stock_levels"]}
+
+    def render_tab(name):
+        if drill_filters and name in filtered_renderers:
+            filtered_renderers[name]()
+            return
+        df = kpi(name)
+        if name not in interrupted:
+            if drill_filters:
+                st.caption(unfiltered_note)
+            renderers[name](df)
+
+    # Estimate column -> (x, y) of the preview chart
+    PREVIEW_CHARTS = {
+        "avg_margin_with_group": ("StockItemName", "AvgMargin"),
+        "sales_by_group": ("StockGroupName", "TotalUnitsSold"),
+        "cust_seg": ("CustomerCategoryName", "TotalQtyShipped"),
+    }
+
+    def render_estimate(name, est):
+        st.subheader(f"{TAB_SECTIONS[name]} (≈ preview)")
+        st.caption("⏳ Estimated from day sketches and a stratified row sample; ± columns are 95% "
+                   "confidence half-widths. The exact figures replace this when they finish.")
+        x, y = PREVIEW_CHARTS[name]
+        fig = chart("bar", est, x=x, y=y, error_y=f"{y}_moe")
+        st.plotly_chart(fig, use_container_width=True)
+        st.dataframe(est.rename(columns=lambda col: f"± {col[:-4]}" if col.endswith("_moe") else col))
+
+    if approx:
+        preview = approx_preview().current()
+        for name in kpi_approx.APPROX_KPIS:
+            if drill_filters and name in filtered_renderers:
+                continue
+            if preview is not None and name in futures and not futures[name].done():
+                try:
+                    est = preview.estimate(name, sd, ed)
+                except Exception as e:
+                    st.error(f"Error estimating {name}: {e}")
+                    continue
+                with tab_slots[name].container(), timed(name, "preview"):
+                    render_estimate(name, est)
+
+
+    for future in as_completed(pending):
+        name = pending[future]
+        show(tab_slots[name], name, lambda name=name: render_tab(name), TAB_KPIS.get(name, [name]))
+    show(tab_slots["drilldown"], "drilldown", render_drilldown)
+
+    # ── 13. Diagnostics ──────────────────────────────────────────────────────────
+    st.sidebar.markdown("---")
+    with st.sidebar.expander("⚙️ Diagnostics"):
+        if SCHEMA_STATS:
+            stats = pd.DataFrame.from_dict(SCHEMA_STATS, orient="index")
+            raw, compact = stats["raw_bytes"].sum(), stats["compact_bytes"].sum()
+            st.metric("KPI frame memory", f"{compact / 1024:,.1f} KiB",
+                      f"{(compact - raw) / max(raw, 1):+.1%} vs raw dtypes", delta_color="inverse")
+            st.dataframe(stats)
+        else:
+            st.caption("No KPI queries executed by this process yet.")
+        cache_stats = RESULT_CACHE.stats()
+        st.caption(
+            f"KPI cache: {cache_stats['hits']:,} hits / {cache_stats['misses']:,} misses, "
+            f"{cache_stats['executions']:,} query executions, "
+            f"{cache_stats['duplicates_avoided']:,} duplicate executions avoided"
+        )
+        memory = process_memory()
+        m1, m2 = st.columns(2)
+        m1.metric("Result cache", f"{cache_stats['bytes'] / 2**20:,.1f} MiB",
+                  f"of {cache_stats['budget'] / 2**20:,.0f} MiB budget", delta_color="off")
+        m2.metric("Process RSS", f"{memory['rss'] / 2**20:,.0f} MiB" if memory["rss"] else "n/a",
+                  f"peak {memory['peak_rss'] / 2**20:,.0f} MiB" if memory["peak_rss"] else None, delta_color="off")
+        st.caption(f"{cache_stats['entries']:,} cached results, {cache_stats['evictions']:,} evicted "
+                   f"(least recently used first), {cache_stats['oversized']:,} too large to cache")
+        per_entry = st.toggle("Per cache entry", key="cache_per_entry")
+        st.dataframe(cache_memory(per_entry), hide_index=True)
+        st.caption(f"Change tracker: {TABLE_VERSIONS.commits_seen:,} commits seen"
+                   + (f", live refresh every {live_every} s" if live else ""))
+        index = WINDOW_INDEX.index
+        over_budget = sorted(set(kpi_prefix.INDEXED_KPIS) - index.kpis) if index is not None else []
+        st.caption(f"Prefix index: {index.nbytes / 2**20:,.1f} MiB, built in {index.build_seconds:.1f} s"
+                   + (f"; over KPI_PREFIX_MB, run as SQL: {', '.join(over_budget)}" if over_budget else "")
+                   if index is not None else
+                   f"Prefix index: unavailable ({WINDOW_INDEX.error})" if WINDOW_INDEX.error else
+                   "Prefix index: building, KPIs run as SQL")
+        if is_admin:
+            st.button("⏱️ Profile this page", help="Rerun the page once with section timers and cProfile on",
+                      on_click=lambda: st.session_state.update(profile_next_run=True))
 
     st.caption("⟡ Powered by SQLite + Streamlit + Plotly (© 2025) | Developed by Ali Aydi & Mahdi Rebai")
 
@@ -835,4 +909,21 @@ except Exception as e:
         st.write("- SalesSpecialDeals table is empty")
         st.write("- Table names don't match schema")
         st.write("- Missing foreign key relationships")
-        st.write("- NULL values in DiscountPercentage column")
\ No newline at end of file
+        st.write("- NULL values in DiscountPercentage column")
+
+# ── 14. Profile of a single run ──────────────────────────────────────────────
+if run_profile is not None:
+    run_profile.stop()
+    set_thread_profile(None)
+    st.session_state.pop("active_profile", None)
+    st.session_state["last_profile"] = run_profile
+last_profile = st.session_state.get("last_profile") if is_admin else None
+if last_profile is not None:
+    with st.expander(f"⏱️ Profile of the run at {last_profile.started_at:%H:%M:%S} "
+                     f"({last_profile.seconds:.2f} s)", expanded=run_profile is not None):
+        st.caption("Seconds per section and step. Steps nest (a section's render includes its figure and table); "
+                   "KPI loads run on the pool alongside the page, so the column does not add up to the run.")
+        st.dataframe(last_profile.sections(), hide_index=True)
+        st.download_button("Download cProfile data (.prof)", last_profile.data,
+                           file_name=f"dashboard-{last_profile.started_at:%Y%m%d-%H%M%S}.prof",
+                           mime="application/octet-stream", on_click="ignore")
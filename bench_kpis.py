@@ -0,0 +1,181 @@
+"""Micro-benchmarks for the KPI engine.
+
+Build a scaled database first, e.g. ``python init_db.py --db bench.db --scale 200``, then:
+
+    python bench_kpis.py fetch --db bench.db
+    python bench_kpis.py profile --db bench.db
+    python bench_kpis.py ingest --db bench.db --records 200000
+    python bench_kpis.py pages --db bench.db --page-size 5
+"""
+import argparse
+import contextlib
+import datetime as dt
+import json
+import pathlib
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+import kpi_engine
+import kpi_ingest
+
+WINDOW = (dt.datetime(2013, 1, 1), dt.datetime(2016, 12, 31, 23, 59, 59))
+
+
+def _best_of(fn, repeat):
+    timings, result = [], None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - started)
+    return min(timings), result
+
+
+def bench_fetch(args):
+    """Rows/second of the full margin-per-product result through each fetch backend."""
+    proc = "dbo.usp_KPI_AvgMarginPerProductWithGroup"
+    print(f"{proc} on {args.db} (best of {args.repeat})")
+    query, params = kpi_engine.get_query(proc), tuple(kpi_engine._sql_param(p) for p in WINDOW)
+    with contextlib.closing(sqlite3.connect(args.db)) as conn:
+        seconds, rows = _best_of(lambda: conn.execute(query, params).fetchall(), args.repeat)
+    print(f"  {'sql':<7} {len(rows):>9,} rows  {seconds * 1000:>9.1f} ms  (sqlite3 fetchall, no frame)")
+    for backend in ("pandas", "arrow"):
+        seconds, df = _best_of(lambda: kpi_engine.run_proc(proc, WINDOW, backend=backend), args.repeat)
+        print(f"  {backend:<7} {len(df):>9,} rows  {seconds * 1000:>9.1f} ms  {len(df) / seconds:>12,.0f} rows/s")
+    if kpi_engine.adbc_sqlite is None:
+        print("  (adbc-driver-sqlite not installed: arrow backend used sqlite3 batches)")
+
+
+def bench_profile(args):
+    """Full KPI set under each connection profile: first pass on fresh connections, then warm."""
+    window = [kpi for kpi, spec in kpi_engine.KPI_CATALOG.items() if spec["window"]]
+    print(f"{len(kpi_engine.KPI_CATALOG)} KPIs ({len(window)} windowed) on {args.db} (warm = best of {args.repeat})")
+
+    def run_all():
+        for kpi in kpi_engine.KPI_CATALOG:
+            kpi_engine.fetch_kpi(kpi, *WINDOW)
+
+    for profile in ("default", "readonly", "immutable"):
+        kpi_engine.use_database(args.db, profile)
+        started = time.perf_counter()
+        run_all()
+        cold = time.perf_counter() - started
+        warm, _ = _best_of(run_all, args.repeat)
+        print(f"  {profile:<10} first {cold * 1000:>9.1f} ms  warm {warm * 1000:>9.1f} ms")
+
+
+def write_feed(db_path, path, records):
+    """Append a synthetic JSONL feed of about ``records`` invoices, purchase orders and their lines."""
+    with contextlib.closing(sqlite3.connect(db_path)) as conn:
+        invoice_id, line_id, po_id, pol_id = (conn.execute(f"SELECT COALESCE(MAX({key}), 0) FROM {table}").fetchone()[0]
+                                              for table, key in [("SalesInvoices", "InvoiceID"),
+                                                                 ("SalesInvoiceLines", "InvoiceLineID"),
+                                                                 ("PurchaseOrders", "PurchaseOrderID"),
+                                                                 ("PurchaseOrderLines", "PurchaseOrderLineID")])
+        prices = dict(conn.execute("SELECT StockItemID, UnitPrice FROM WarehouseStockItem"))
+        customers = [row[0] for row in conn.execute("SELECT CustomerID FROM SalesCustomers")]
+        suppliers = [row[0] for row in conn.execute("SELECT SupplierID FROM PurchasingSuppliers")]
+    items, written, day = list(prices), 0, dt.date(2016, 12, 1)
+    with open(path, "a") as feed:
+        while written < records:
+            date = day.isoformat()
+            invoice_id += 1
+            feed.write(json.dumps({"type": "invoice", "InvoiceID": invoice_id,
+                                   "CustomerID": random.choice(customers), "InvoiceDate": date}) + "\n")
+            for _ in range(random.randint(2, 5)):
+                line_id += 1
+                item, quantity = random.choice(items), random.randint(1, 20)
+                price = quantity * prices[item]
+                feed.write(json.dumps({
+                    "type": "invoice_line", "InvoiceLineID": line_id, "InvoiceID": invoice_id, "StockItemID": item,
+                    "Quantity": quantity, "UnitPrice": prices[item], "ExtendedPrice": price,
+                    "TaxAmount": price * 0.08, "TaxRate": 8.0, "TaxRateID": 2,
+                    "LineProfit": price * random.uniform(0.2, 0.4), "LastEditedWhen": date}) + "\n")
+                written += 1
+            if invoice_id % 4 == 0:
+                po_id += 1
+                feed.write(json.dumps({"type": "purchase_order", "PurchaseOrderID": po_id,
+                                       "SupplierID": random.choice(suppliers), "OrderDate": date,
+                                       "ExpectedDeliveryDate": date}) + "\n")
+                for _ in range(random.randint(2, 4)):
+                    pol_id += 1
+                    item, ordered = random.choice(items), random.randint(10, 100)
+                    feed.write(json.dumps({
+                        "type": "po_line", "PurchaseOrderLineID": pol_id, "PurchaseOrderID": po_id,
+                        "StockItemID": item, "OrderedOuters": ordered, "ReceivedOuters": ordered,
+                        "ExpectedUnitPricePerOuter": prices[item] * 0.7, "LastReceiptDate": date}) + "\n")
+                    written += 1
+                written += 1
+            written += 1
+            day = min(day + dt.timedelta(days=invoice_id % 2), dt.date(2016, 12, 31))
+
+
+def bench_ingest(args):
+    """Records/second and rows/second of kpi_ingest on a copy of the database, per micro-batch size."""
+    with tempfile.TemporaryDirectory() as tmp:
+        feed = pathlib.Path(tmp) / "feed.jsonl"
+        write_feed(args.db, feed, args.records)
+        print(f"{args.records:,} feed records into a copy of {args.db}")
+        for batch in (1000, 5000, 20000):
+            copy = pathlib.Path(tmp) / "ingest.db"
+            shutil.copyfile(args.db, copy)
+            records, rows, seconds = kpi_ingest.ingest(feed, copy, batch=batch)
+            print(f"  batch {batch:>6,}  {seconds:>7.2f} s  {records / seconds:>10,.0f} records/s  "
+                  f"{rows / seconds:>10,.0f} rows/s (derived rows included)")
+
+
+def walk_pages(kpi_name, order_by, page_size):
+    """Every row of a KPI's full result, read one keyset page at a time as the dashboard pages it."""
+    rows, after = [], None
+    while True:
+        page = kpi_engine.fetch_page(kpi_name, *WINDOW, order_by=order_by, after=after, page_size=page_size)
+        rows += page.to_dict("records")
+        if len(page) < page_size:
+            return rows
+        after = kpi_engine.page_cursor(page, kpi_name, order_by)
+
+
+def bench_pages(args):
+    """Pages/second of keyset paging, sorted by each float column both ways; exits 1 if a walk drops or repeats rows."""
+    failures = 0
+    for kpi, spec in kpi_engine.KPI_CATALOG.items():
+        if "key" not in spec:
+            continue
+        full = kpi_engine.run_proc(spec["proc"], WINDOW if spec["window"] else ())
+        floats = [col for col in full.columns if col not in spec["key"] and full[col].dtype.kind == "f"]
+        for col in [None] + floats:
+            for direction in ("DESC", "ASC"):
+                order_by = None if col is None else ((col, direction),)
+                started = time.perf_counter()
+                rows = walk_pages(kpi, order_by, args.page_size)
+                seconds = time.perf_counter() - started
+                keys = {tuple(row[k] for k in spec["key"]) for row in rows}
+                ok = len(rows) == len(keys) == len(full)
+                failures += not ok
+                print(f"  {kpi:<22} {col or '(default)':<24} {direction if col else '':<4} {len(rows):>6,} of "
+                      f"{len(full):>6,} rows  {len(rows) / args.page_size / seconds:>8,.0f} pages/s"
+                      f"{'' if ok else '  MISMATCH'}")
+                if col is None:
+                    break
+    if failures:
+        sys.exit(f"{failures} page walk(s) dropped or repeated rows")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("benchmark", choices=["fetch", "profile", "ingest", "pages"])
+    parser.add_argument("--db", default=kpi_engine.DB_PATH, help="database file to benchmark against")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per measurement; the best is reported")
+    parser.add_argument("--records", type=int, default=100000, help="feed size for the ingest benchmark")
+    parser.add_argument("--page-size", type=int, default=5, help="rows per page for the paging check")
+    args = parser.parse_args()
+    kpi_engine.use_database(args.db)
+    benchmarks = {"fetch": bench_fetch, "profile": bench_profile, "ingest": bench_ingest, "pages": bench_pages}
+    benchmarks[args.benchmark](args)
+
+
+if __name__ == "__main__":
+    main()
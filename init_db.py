@@ -1,12 +1,23 @@
+import argparse
 import sqlite3
 import os
 import pandas as pd
 import random
 from datetime import datetime, timedelta
 
+from kpi_approx import refresh_sketches
+from kpi_cube import refresh_cube
+from kpi_fact import refresh_fact
+from kpi_schema import migrate_schema
+from kpi_stock import refresh_balances
 
-def create_database(db_file="mydb.db"):
-    """Create SQLite database with all required tables matching app.py schema"""
+
+def create_database(db_file="mydb.db", scale=1):
+    """Create SQLite database with all required tables matching app.py schema
+
+    ``scale`` multiplies the stock catalog and the lines per invoice / purchase
+    order, for benchmarking against larger data sets.
+    """
     # Remove existing database if it exists
     if os.path.exists(db_file):
         os.remove(db_file)
@@ -33,7 +44,27 @@ def create_database(db_file="mydb.db"):
 
     # Insert sample data
     print("Inserting sample data...")
-    insert_sample_data(conn)
+    insert_sample_data(conn, scale)
+
+    # Compute the derived measure columns and their covering indexes
+    print("Adding derived columns...")
+    conn.commit()
+    migrate_schema(conn)
+
+    # Precompute the drill-down cube
+    print("Building sales cube...")
+    refresh_cube(conn)
+
+    # Denormalise the invoice lines into the sales fact table
+    print("Building sales fact...")
+    refresh_fact(conn)
+
+    # Day sketches for approximate previews and month-end stock balances; an
+    # immutable snapshot is never written, so these must exist before it is opened
+    print("Building day sketches...")
+    refresh_sketches(conn)
+    print("Building stock balances...")
+    refresh_balances(conn)
 
     # Commit changes and close connection
     conn.commit()
@@ -354,7 +385,7 @@ def create_indexes(cursor):
     cursor.execute('CREATE INDEX idx_Orders_OrderDate ON Orders(OrderDate)')
 
 
-def insert_sample_data(conn):
+def insert_sample_data(conn, scale=1):
     """Insert sample data into all tables with correct table names"""
     cursor = conn.cursor()
 
@@ -461,6 +492,11 @@ def insert_sample_data(conn):
         (12, "Study Desk", 5, 100.00, 249.99, 20.0),
         (13, "Wooden Bookshelf", 5, 70.00, 179.99, 15.0)
     ]
+    # Scaled catalogs add numbered variants of the base items
+    base_items = list(stock_items)
+    for variant in range(1, scale):
+        for item in base_items:
+            stock_items.append((variant * len(base_items) + item[0], f"{item[1]} #{variant}") + item[2:])
     cursor.executemany(
         "INSERT INTO WarehouseStockItem (StockItemID, StockItemName, SupplierID, UnitPrice, RecommendedRetailPrice, TypicalWeightPerUnit) VALUES (?, ?, ?, ?, ?, ?)",
         stock_items)
@@ -473,6 +509,8 @@ def insert_sample_data(conn):
         (9, 4), (10, 4),  # Books
         (11, 5), (12, 5), (13, 5)  # Furniture
     ]
+    stock_item_groups += [(variant * len(base_items) + item_id, group_id)
+                          for variant in range(1, scale) for item_id, group_id in stock_item_groups]
     cursor.executemany("INSERT INTO StockItemsStockGroups (StockItemID, StockGroupID) VALUES (?, ?)", stock_item_groups)
 
     # Insert SalesCustomers
@@ -543,8 +581,8 @@ def insert_sample_data(conn):
     pol_id = 1
     for po in purchase_orders:
         # Each PO has 2-4 line items
-        for _ in range(random.randint(2, 4)):
-            stock_id = random.randint(1, 13)
+        for _ in range(random.randint(2, 4) * scale):
+            stock_id = random.randint(1, len(stock_items))
             ordered = random.randint(10, 100)
             received = ordered - random.randint(0, 5)  # Sometimes receive less
 
@@ -625,8 +663,8 @@ def insert_sample_data(conn):
 
     for invoice in invoices:
         # Each invoice has 2-5 line items
-        for _ in range(random.randint(2, 5)):
-            stock_id = random.randint(1, 13)
+        for _ in range(random.randint(2, 5) * scale):
+            stock_id = random.randint(1, len(stock_items))
             quantity = random.randint(1, 20)
 
             # Get the unit price from the WarehouseStockItem table
@@ -802,7 +840,11 @@ def insert_sample_data(conn):
 
 
 if __name__ == "__main__":
-    create_database()
+    parser = argparse.ArgumentParser(description="Create the dashboard's SQLite database with sample data.")
+    parser.add_argument("--db", default="mydb.db", help="database file to (re)create")
+    parser.add_argument("--scale", type=int, default=1, help="catalog and line-volume multiplier")
+    args = parser.parse_args()
+    create_database(args.db, args.scale)
     print("Database created successfully with corrected table names matching app.py schema.")
     print("Generated comprehensive sample data for years 2013-2016.")
     print("✅ SalesSpecialDeals table populated with deals across all stock groups and buying groups.")
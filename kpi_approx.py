@@ -0,0 +1,448 @@
+"""Approximate previews of the heavy KPIs, with 95% confidence intervals.
+
+    python kpi_approx.py                          # fold new rows into the day sketches
+    python kpi_approx.py --rebuild                # recompute them from scratch
+    python kpi_approx.py --compare 2014-01-01 2015-06-30
+
+Distinct counts come from HyperLogLog sketches stored per day in DaySketches:
+invoices per (day, StockItemID) and shipping customers per (day,
+CustomerCategoryID). HLL registers merge by taking the maximum, so a window's
+count is the merge of its days' sketches, and new rows are folded in above a
+watermark like the sales cube. Sketches are kept sparse (register, rank) until
+a quarter of the registers are set.
+
+Sums and counts are estimated from a stratified row sample of
+SalesInvoiceLines (strata: month x StockItemID) and StockItemTransactions
+(month x TransactionTypeID), at least MIN_STRATUM_SAMPLE rows or
+SAMPLE_RATE of each stratum. A window or group is a domain of the sample:
+totals are weighted by N/n per stratum, ratios use the linearised variance.
+
+The dashboard shows a preview while the exact query still runs, and replaces
+it with the exact frame once that finishes.
+"""
+import argparse
+import contextlib
+import datetime as dt
+import time
+
+import numpy as np
+import pandas as pd
+
+import kpi_engine
+import kpi_prefix
+import kpi_rollups
+
+# HyperLogLog precision: 2**12 registers, 1.6% relative standard error
+PRECISION = 12
+REGISTERS = 1 << PRECISION
+HLL_ERROR = 1.04 / np.sqrt(REGISTERS)
+Z_95 = 1.96
+
+SAMPLE_RATE = 0.05
+MIN_STRATUM_SAMPLE = 10
+
+SKETCH_DDL = [
+    """
+    CREATE TABLE IF NOT EXISTS DaySketches (
+        Sketch TEXT NOT NULL,
+        Day TEXT NOT NULL,
+        GroupID INTEGER NOT NULL,
+        Registers BLOB NOT NULL,
+        PRIMARY KEY (Sketch, Day, GroupID)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS SketchWatermarks (
+        Sketch TEXT PRIMARY KEY,
+        LastID INTEGER NOT NULL
+    )
+    """,
+]
+
+# Sketch -> (source table, its increasing id column, (Day, GroupID, Value) rows with ids in (?, ?])
+SKETCHES = {
+    "invoices": ("SalesInvoiceLines", "InvoiceLineID", """
+        SELECT LastEditedWhen, StockItemID, InvoiceID
+        FROM SalesInvoiceLines
+        WHERE InvoiceLineID > ? AND InvoiceLineID <= ?
+    """),
+    "customers": ("StockItemTransactions", "StockItemTransactionID", """
+        SELECT sit.TransactionOccurredWhen, c.CustomerCategoryID, sit.CustomerID
+        FROM StockItemTransactions sit
+        JOIN SalesCustomers c
+            ON c.CustomerID = sit.CustomerID
+        WHERE sit.TransactionTypeID = 10
+            AND c.CustomerCategoryID IS NOT NULL
+            AND sit.StockItemTransactionID > ? AND sit.StockItemTransactionID <= ?
+    """),
+}
+
+# Rows of a stratum are picked in a fixed pseudo-random order of their ids
+SAMPLE_QUERIES = {
+    "lines": """
+        WITH Ranked AS (
+            SELECT LastEditedWhen AS Day, substr(LastEditedWhen, 1, 7) AS Month, StockItemID,
+                   Quantity, ExtendedPrice, LineProfit,
+                   ROW_NUMBER() OVER (PARTITION BY substr(LastEditedWhen, 1, 7), StockItemID
+                                      ORDER BY (InvoiceLineID * 2654435761) % 4294967291) AS Pick,
+                   COUNT(*) OVER (PARTITION BY substr(LastEditedWhen, 1, 7), StockItemID) AS StratumRows
+            FROM SalesInvoiceLines
+        )
+        SELECT * FROM Ranked WHERE Pick <= MAX(?, StratumRows * ?)
+    """,
+    "txns": """
+        WITH Ranked AS (
+            SELECT TransactionOccurredWhen AS Day, substr(TransactionOccurredWhen, 1, 7) AS Month,
+                   TransactionTypeID, CustomerID, ABS(Quantity) AS QtyShipped,
+                   ROW_NUMBER() OVER (PARTITION BY substr(TransactionOccurredWhen, 1, 7), TransactionTypeID
+                                      ORDER BY (StockItemTransactionID * 2654435761) % 4294967291) AS Pick,
+                   COUNT(*) OVER (PARTITION BY substr(TransactionOccurredWhen, 1, 7), TransactionTypeID)
+                       AS StratumRows
+            FROM StockItemTransactions
+        )
+        SELECT * FROM Ranked WHERE Pick <= MAX(?, StratumRows * ?)
+    """,
+}
+SAMPLE_STRATA = {"lines": ["StockItemID"], "txns": ["TransactionTypeID"]}
+
+CUSTOMER_CATEGORIES = """
+    SELECT c.CustomerID, cc.CustomerCategoryID, cc.CustomerCategoryName
+    FROM SalesCustomers c
+    JOIN SalesCustomersCategories cc
+        ON cc.CustomerCategoryID = c.CustomerCategoryID
+"""
+
+# Catalog KPIs with a preview
+APPROX_KPIS = ["avg_margin_with_group", "sales_by_group", "cust_seg"]
+APPROX_TABLES = tuple(sorted(
+    {"DaySketches"} | {table for name in APPROX_KPIS for table in kpi_engine.kpi_tables(name)}))
+
+
+# ── HyperLogLog ────────────────────────────────────────────────────────────────
+def _hash64(values):
+    # splitmix64 finaliser: integer ids -> uniformly spread 64-bit hashes
+    x = values.astype(np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def _bit_length(x):
+    x, bits = x.copy(), np.zeros(len(x), np.int64)
+    for shift in (32, 16, 8, 4, 2, 1):
+        big = x >= np.uint64(1 << shift)
+        x[big] >>= np.uint64(shift)
+        bits[big] += shift
+    return bits + (x > 0)
+
+
+def registers(values):
+    """(register, rank) of each value: the top bits pick the register, the rank is 1 + leading zeros of the rest."""
+    hashes = _hash64(np.asarray(values))
+    rest = hashes & np.uint64((1 << (64 - PRECISION)) - 1)
+    rank = (64 - PRECISION) + 1 - _bit_length(rest)
+    return (hashes >> np.uint64(64 - PRECISION)).astype(np.int64), rank.astype(np.uint8)
+
+
+def cardinality(dense):
+    """HLL estimates of the rows of a (sketches x REGISTERS) array, linear counting for small sets."""
+    alpha = 0.7213 / (1 + 1.079 / REGISTERS)
+    raw = alpha * REGISTERS ** 2 / np.exp2(-dense.astype(np.float64)).sum(axis=1)
+    zeros = (dense == 0).sum(axis=1)
+    linear = REGISTERS * np.log(REGISTERS / np.maximum(zeros, 1))
+    return np.where((raw <= 2.5 * REGISTERS) & (zeros > 0), linear, raw)
+
+
+def _encode(register, rank):
+    # Sparse packed (register << 8 | rank) words while shorter than the dense byte array
+    if 4 * len(register) < REGISTERS:
+        return ((register.astype("<u4") << 8) | rank).tobytes()
+    dense = np.zeros(REGISTERS, np.uint8)
+    dense[register] = rank
+    return dense.tobytes()
+
+
+def _decode(blobs):
+    """(cell, register, rank) entries of many stored sketches; ``cell`` indexes ``blobs``."""
+    lengths = np.array([len(blob) for blob in blobs], np.int64)
+    dense = lengths == REGISTERS
+    packed = np.frombuffer(b"".join(blob for blob, d in zip(blobs, dense) if not d), "<u4")
+    cells = [np.repeat(np.flatnonzero(~dense), lengths[~dense] // 4)]
+    regs, ranks = [(packed >> 8).astype(np.int64)], [(packed & 0xFF).astype(np.uint8)]
+    for cell in np.flatnonzero(dense):
+        values = np.frombuffer(blobs[cell], np.uint8)
+        set_regs = np.flatnonzero(values)
+        cells.append(np.full(len(set_regs), cell))
+        regs.append(set_regs)
+        ranks.append(values[set_regs])
+    return np.concatenate(cells), np.concatenate(regs), np.concatenate(ranks)
+
+
+def _merge_sketch(conn, sketch, rows):
+    # Max-merge new (Day, GroupID, Value) rows into the stored sketches of their cells
+    register, rank = registers(rows["Value"].to_numpy())
+    entries = pd.DataFrame({"Day": rows["Day"], "GroupID": rows["GroupID"], "Register": register, "Rank": rank})
+    cells = entries[["Day", "GroupID"]].drop_duplicates()
+    stored = pd.DataFrame(conn.execute(
+        "SELECT Day, GroupID, Registers FROM DaySketches WHERE Sketch = ? AND Day BETWEEN ? AND ?",
+        (sketch, cells["Day"].min(), cells["Day"].max())).fetchall(), columns=["Day", "GroupID", "Registers"])
+    stored = stored.merge(cells, on=["Day", "GroupID"])
+    if not stored.empty:
+        cell, register, rank = _decode(stored["Registers"].tolist())
+        entries = pd.concat([entries, pd.DataFrame({
+            "Day": stored["Day"].to_numpy()[cell], "GroupID": stored["GroupID"].to_numpy()[cell],
+            "Register": register, "Rank": rank})], ignore_index=True)
+    merged = entries.groupby(["Day", "GroupID", "Register"], as_index=False)["Rank"].max()
+    bounds = np.flatnonzero(merged[["Day", "GroupID"]].ne(merged[["Day", "GroupID"]].shift()).any(axis=1))
+    bounds = np.append(bounds, len(merged))
+    day, group = merged["Day"].to_numpy(), merged["GroupID"].to_numpy()
+    register, rank = merged["Register"].to_numpy(), merged["Rank"].to_numpy()
+    conn.executemany(
+        "INSERT INTO DaySketches VALUES (?, ?, ?, ?) "
+        "ON CONFLICT (Sketch, Day, GroupID) DO UPDATE SET Registers = excluded.Registers",
+        ((sketch, day[a], int(group[a]), _encode(register[a:b], rank[a:b])) for a, b in zip(bounds, bounds[1:])))
+
+
+def merge_new_rows(conn):
+    """Fold rows newer than each sketch's watermark into DaySketches inside the caller's transaction."""
+    folded = 0
+    for sketch, (table, id_column, query) in SKETCHES.items():
+        row = conn.execute("SELECT LastID FROM SketchWatermarks WHERE Sketch = ?", (sketch,)).fetchone()
+        last_id = row[0] if row else 0
+        high = conn.execute(f"SELECT MAX({id_column}) FROM {table} WHERE {id_column} > ?", (last_id,)).fetchone()[0]
+        if high is None:
+            continue
+        rows = pd.DataFrame(conn.execute(query, (last_id, high)).fetchall(), columns=["Day", "GroupID", "Value"])
+        if not rows.empty:
+            _merge_sketch(conn, sketch, rows)
+        conn.execute(
+            "INSERT INTO SketchWatermarks VALUES (?, ?) ON CONFLICT (Sketch) DO UPDATE SET LastID = excluded.LastID",
+            (sketch, high))
+        folded += len(rows)
+    return folded
+
+
+def refresh_sketches(conn, rebuild=False):
+    """Fold new rows into the day sketches; returns the number of rows folded in."""
+    with conn:
+        for ddl in SKETCH_DDL:
+            conn.execute(ddl)
+        if rebuild:
+            conn.execute("DELETE FROM DaySketches")
+            conn.execute("DELETE FROM SketchWatermarks")
+        return merge_new_rows(conn)
+
+
+def refresh(db_path=None, rebuild=False):
+    """Refresh the day sketches of a database file through its own read-write connection."""
+    with contextlib.closing(kpi_engine.connect_db(db_path, "default")) as conn:
+        return refresh_sketches(conn, rebuild)
+
+
+class DaySketches:
+    """One sketch's stored cells as register entries sorted by day, merged per window on demand."""
+
+    def __init__(self, sketch):
+        stored = pd.read_sql("SELECT Day, GroupID, Registers FROM DaySketches WHERE Sketch = ? ORDER BY Day",
+                             kpi_engine.engine, params=(sketch,))
+        cell, register, rank = _decode(stored["Registers"].tolist()) if len(stored) else ([], [], [])
+        self.groups = np.unique(stored["GroupID"].to_numpy())
+        self.days = stored["Day"].to_numpy()[cell]
+        self.slots = np.searchsorted(self.groups, stored["GroupID"].to_numpy()[cell]) * REGISTERS + register
+        self.ranks = np.asarray(rank, np.uint8)
+
+    def counts(self, s=None, e=None):
+        """Estimated distinct values per GroupID over [s, e] (all days without bounds)."""
+        lo, hi = 0, len(self.days)
+        if s is not None:
+            lo = np.searchsorted(self.days, kpi_engine._sql_param(s), "left")
+            hi = max(lo, np.searchsorted(self.days, kpi_engine._sql_param(e), "right"))
+        dense = np.zeros(len(self.groups) * REGISTERS, np.uint8)
+        np.maximum.at(dense, self.slots[lo:hi], self.ranks[lo:hi])
+        return pd.Series(cardinality(dense.reshape(-1, REGISTERS)), index=self.groups)
+
+    @property
+    def nbytes(self):
+        return self.days.nbytes + self.slots.nbytes + self.ranks.nbytes
+
+
+# ── Stratified samples ────────────────────────────────────────────────────────
+class StratifiedSample:
+    """Sampled rows sorted by Day, with each stratum's expansion weight N/n and variance factor."""
+
+    def __init__(self, name):
+        rows = pd.read_sql(SAMPLE_QUERIES[name], kpi_engine.engine, params=(MIN_STRATUM_SAMPLE, SAMPLE_RATE))
+        rows["Stratum"] = rows.groupby(["Month"] + SAMPLE_STRATA[name]).ngroup()
+        sizes = rows.groupby("Stratum").agg(N=("StratumRows", "first"), n=("Stratum", "size"))
+        population, sampled = sizes["N"].to_numpy(np.float64), sizes["n"].to_numpy(np.float64)
+        self.weight = population / sampled
+        # N^2 (1 - n/N) / n, over the n - 1 of the sample variance; exhaustive strata add nothing
+        self.spread = np.where(sampled > 1,
+                               population * (population - sampled) / (sampled * np.maximum(sampled - 1, 1)), 0.0)
+        self.sampled = sampled
+        self.population = int(population.sum())
+        self.rows = (rows.drop(columns=["Month", "Pick", "StratumRows"]).assign(Lines=1)
+                     .sort_values("Day", kind="stable", ignore_index=True))
+
+    def window(self, s=None, e=None):
+        if s is None:
+            return self.rows
+        days = self.rows["Day"].to_numpy()
+        lo = np.searchsorted(days, kpi_engine._sql_param(s), "left")
+        return self.rows.iloc[lo:max(lo, np.searchsorted(days, kpi_engine._sql_param(e), "right"))]
+
+    def estimate(self, rows, by, columns, ratios=None):
+        """Totals of ``columns`` per ``by`` group over domain ``rows`` of the sample, with 95% margins of error.
+
+        ``ratios`` maps an output column to (numerator, denominator) columns;
+        each output gets a ``<column>_moe`` half-width.
+        """
+        ratios = ratios or {}
+        pairs = {(c, c) for c in columns} | set(ratios.values())
+        frame = rows[by + ["Stratum"] + list(columns)].assign(
+            **{f"{a}*{b}": rows[a] * rows[b] for a, b in pairs})
+        sums = frame.groupby(by + ["Stratum"]).sum()
+        stratum = sums.index.get_level_values("Stratum").to_numpy()
+        weight, spread, sampled = self.weight[stratum], self.spread[stratum], self.sampled[stratum]
+        per_group = {c: sums[c] * weight for c in columns}
+        per_group.update({f"{a}*{b}": spread * (sums[f"{a}*{b}"] - sums[a] * sums[b] / sampled) for a, b in pairs})
+        totals = pd.DataFrame(per_group).groupby(level=by).sum()
+        out = totals[list(columns)].copy()
+        for c in columns:
+            out[f"{c}_moe"] = Z_95 * np.sqrt(totals[f"{c}*{c}"].clip(lower=0))
+        for name, (num, den) in ratios.items():
+            ratio = totals[num] / totals[den].replace(0, np.nan)
+            variance = totals[f"{num}*{num}"] - 2 * ratio * totals[f"{num}*{den}"] + ratio ** 2 * totals[f"{den}*{den}"]
+            out[name] = ratio
+            out[f"{name}_moe"] = Z_95 * np.sqrt(variance.clip(lower=0)) / totals[den].abs()
+        return out.reset_index()
+
+    @property
+    def nbytes(self):
+        return kpi_engine.frame_nbytes(self.rows) + self.weight.nbytes + self.spread.nbytes + self.sampled.nbytes
+
+
+# ── Previews ──────────────────────────────────────────────────────────────────
+def _ordered(df, kpi_name):
+    order = kpi_engine.sort_spec(kpi_name)
+    df = df.sort_values([c for c, _ in order], ascending=[d == "ASC" for _, d in order], kind="stable")
+    top_n = kpi_engine.KPI_CATALOG[kpi_name].get("top_n")
+    return kpi_engine.apply_schema((df.head(top_n) if top_n else df).reset_index(drop=True), kpi_name)
+
+
+def _count_moe(counts):
+    return Z_95 * HLL_ERROR * counts
+
+
+class Preview:
+    """Day sketches, row samples and dimensions behind the APPROX_KPIS previews."""
+
+    def __init__(self):
+        started = time.perf_counter()
+        self.sketches = {sketch: DaySketches(sketch) for sketch in SKETCHES}
+        self.lines = StratifiedSample("lines")
+        self.txns = StratifiedSample("txns")
+        self.items = pd.read_sql(kpi_rollups.DIMENSION_QUERIES["items"], kpi_engine.engine)
+        self.item_groups = pd.read_sql(kpi_rollups.DIMENSION_QUERIES["item_groups"], kpi_engine.engine)
+        self.customers = pd.read_sql(CUSTOMER_CATEGORIES, kpi_engine.engine)
+        self.build_seconds = time.perf_counter() - started
+
+    @property
+    def nbytes(self):
+        return (sum(sketch.nbytes for sketch in self.sketches.values()) + self.lines.nbytes + self.txns.nbytes)
+
+    def avg_margin_with_group(self, s, e):
+        per_item = self.lines.estimate(
+            self.lines.window(s, e), ["StockItemID"], ["Lines", "LineProfit", "ExtendedPrice"],
+            {"AvgMargin": ("LineProfit", "Lines"), "MarginPct": ("LineProfit", "ExtendedPrice")})
+        invoices = self.sketches["invoices"].counts(s, e)
+        per_item["InvoiceCount"] = invoices.reindex(per_item["StockItemID"]).fillna(0).round().to_numpy()
+        per_item["InvoiceCount_moe"] = _count_moe(per_item["InvoiceCount"])
+        per_item = (per_item.rename(columns={"LineProfit": "TotalProfit", "LineProfit_moe": "TotalProfit_moe",
+                                             "ExtendedPrice": "TotalRevenue", "ExtendedPrice_moe": "TotalRevenue_moe"})
+                    .assign(MarginPct=lambda df: (df["MarginPct"] * 100).round(2),
+                            MarginPct_moe=lambda df: df["MarginPct_moe"] * 100))
+        rows = per_item.merge(self.items, on="StockItemID").merge(self.item_groups, on="StockItemID", how="left")
+        return _ordered(rows[["StockItemID", "StockItemName", "StockGroupID", "StockGroupName",
+                              "AvgMargin", "AvgMargin_moe", "InvoiceCount", "InvoiceCount_moe",
+                              "TotalProfit", "TotalProfit_moe", "TotalRevenue", "TotalRevenue_moe",
+                              "MarginPct", "MarginPct_moe"]], "avg_margin_with_group")
+
+    def sales_by_group(self, s, e):
+        # A line counts in every group of its item
+        rows = self.lines.window(s, e).merge(self.item_groups, on="StockItemID")
+        groups = self.lines.estimate(rows, ["StockGroupID", "StockGroupName"],
+                                     ["Quantity", "LineProfit", "ExtendedPrice"],
+                                     {"GrossMarginPct": ("LineProfit", "ExtendedPrice")})
+        groups = groups.rename(columns={
+            "Quantity": "TotalUnitsSold", "Quantity_moe": "TotalUnitsSold_moe", "LineProfit": "TotalProfit",
+            "LineProfit_moe": "TotalProfit_moe", "ExtendedPrice": "TotalRevenue",
+            "ExtendedPrice_moe": "TotalRevenue_moe",
+        }).assign(TotalUnitsSold=lambda df: df["TotalUnitsSold"].round(),
+                  GrossMarginPct=lambda df: (df["GrossMarginPct"] * 100).round(2),
+                  GrossMarginPct_moe=lambda df: df["GrossMarginPct_moe"] * 100)
+        return _ordered(groups, "sales_by_group")
+
+    def cust_seg(self, s=None, e=None):
+        # Not windowed: issues (type 10) to customers of a category, over all days
+        txns = self.txns.rows
+        rows = txns[txns["TransactionTypeID"] == 10].merge(self.customers, on="CustomerID")
+        segments = self.txns.estimate(rows, ["CustomerCategoryID", "CustomerCategoryName"], ["Lines", "QtyShipped"])
+        customers = self.sketches["customers"].counts()
+        segments["Customers"] = customers.reindex(segments["CustomerCategoryID"]).fillna(0).round().to_numpy()
+        segments["Customers_moe"] = _count_moe(segments["Customers"])
+        segments = segments.rename(columns={"Lines": "ShipmentEvents", "Lines_moe": "ShipmentEvents_moe",
+                                            "QtyShipped": "TotalQtyShipped", "QtyShipped_moe": "TotalQtyShipped_moe"})
+        segments = segments.assign(ShipmentEvents=lambda df: df["ShipmentEvents"].round(),
+                                   TotalQtyShipped=lambda df: df["TotalQtyShipped"].round())
+        return _ordered(segments[["CustomerCategoryName", "Customers", "Customers_moe", "ShipmentEvents",
+                                  "ShipmentEvents_moe", "TotalQtyShipped", "TotalQtyShipped_moe"]], "cust_seg")
+
+    def estimate(self, kpi_name, s, e):
+        """A KPI's estimated frame: the catalog columns plus a ``<column>_moe`` 95% half-width for each estimate."""
+        return getattr(self, kpi_name)(s, e)
+
+
+def install():
+    """Build the sketches' and samples' in-memory preview in the background; estimate through the returned manager."""
+    manager = kpi_prefix.WindowIndexManager(Preview, APPROX_TABLES)
+    manager.current()
+    return manager
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", default=kpi_engine.DB_PATH)
+    parser.add_argument("--rebuild", action="store_true", help="recompute the day sketches from scratch")
+    parser.add_argument("--compare", nargs=2, metavar=("START", "END"), type=dt.date.fromisoformat,
+                        help="print estimates against the exact KPIs for a window")
+    args = parser.parse_args()
+    started = time.perf_counter()
+    folded = refresh(args.db, args.rebuild)
+    print(f"Folded {folded:,} rows into the day sketches in {(time.perf_counter() - started) * 1000:.0f} ms")
+    if not args.compare:
+        return
+    kpi_engine.use_database(args.db)
+    s, e = kpi_engine.window_bounds(*args.compare)
+    preview = Preview()
+    print(f"Preview built in {preview.build_seconds:.2f} s, {preview.nbytes / 2**20:,.1f} MiB; "
+          f"samples of {len(preview.lines.rows):,}/{preview.lines.population:,} lines and "
+          f"{len(preview.txns.rows):,}/{preview.txns.population:,} stock transactions")
+    for name in APPROX_KPIS:
+        started = time.perf_counter()
+        estimate = preview.estimate(name, s, e)
+        estimate_ms = (time.perf_counter() - started) * 1000
+        started = time.perf_counter()
+        exact = kpi_engine.fetch_kpi(name, s, e)
+        exact_ms = (time.perf_counter() - started) * 1000
+        key = kpi_engine.KPI_CATALOG[name]["key"]
+        joined = estimate.merge(exact, on=key, suffixes=("", "_exact"))
+        print(f"\n{name}: estimate {estimate_ms:.0f} ms, exact {exact_ms:.0f} ms")
+        for col in [c[:-4] for c in estimate.columns if c.endswith("_moe")]:
+            error = (joined[col].astype(float) - joined[f"{col}_exact"].astype(float)).abs()
+            covered = (error <= joined[f"{col}_moe"] + 1e-9).mean() if len(joined) else np.nan
+            print(f"  {col:<16} median |error| {error.median():>14,.2f}   within 95% CI {covered:.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""Cached, downsampled Plotly figures for the dashboard.
+
+    fig = kpi_charts.chart("line", df, x="Period", y=["Sales", "Purchases"])
+    st.plotly_chart(fig, use_container_width=True)
+
+``chart`` builds a Plotly Express figure once per (chart type, options,
+frame contents) and keeps it in the engine's RESULT_CACHE, under the same
+memory budget as the KPI frames. A rerun that gets its KPI frame from the
+cache gets the figure too; a changed frame hashes differently and builds anew.
+Streamlit still serialises the figure on every run, which takes a few ms;
+handing it a dict instead would make it validate the whole spec again.
+
+Line and scatter series longer than ``MAX_POINTS`` (``KPI_CHART_POINTS``,
+default 2000) are downsampled with Largest-Triangle-Three-Buckets, which keeps
+the peaks, troughs and overall shape that a plain stride loses. Charts that
+still draw more than ``WEBGL_POINTS`` marks render through WebGL.
+"""
+import hashlib
+import os
+
+import numpy as np
+import pandas as pd
+import plotly.express as px
+
+import kpi_engine
+
+BUILDERS = {"line": px.line, "bar": px.bar, "pie": px.pie, "scatter": px.scatter}
+DOWNSAMPLED = {"line", "scatter"}
+MAX_POINTS = int(os.environ.get("KPI_CHART_POINTS", "2000"))
+WEBGL_POINTS = 1000
+
+
+def lttb(x, y, n):
+    """Indices of the ``n`` points of (x, y), sorted by x, that Largest-Triangle-Three-Buckets keeps."""
+    if n >= len(x) or n < 3:
+        return np.arange(len(x))
+    # First and last points stay; the rest fall into n - 2 buckets of (nearly) equal size
+    edges = np.linspace(1, len(x) - 1, n - 1).astype(int)
+    y = np.where(np.isnan(y), 0.0, y)
+    keep = np.empty(n, dtype=int)
+    keep[0], keep[-1] = 0, len(x) - 1
+    for i in range(n - 2):
+        lo, hi = edges[i], edges[i + 1]
+        # The next bucket's centroid (the last point for the last bucket)
+        if i + 2 < len(edges):
+            cx, cy = x[hi:edges[i + 2]].mean(), y[hi:edges[i + 2]].mean()
+        else:
+            cx, cy = x[-1], y[-1]
+        ax, ay = x[keep[i]], y[keep[i]]
+        # Twice the area of the triangle (previous pick, candidate, next centroid)
+        area = np.abs((ax - cx) * (y[lo:hi] - ay) - (ax - x[lo:hi]) * (cy - ay))
+        keep[i + 1] = lo + int(np.argmax(area))
+    return keep
+
+
+def _x_values(column):
+    # Sortable numbers for x: datetimes as ns, numbers as is, anything else (categories) by position
+    if pd.api.types.is_datetime64_any_dtype(column):
+        return column.to_numpy("datetime64[ns]").view("int64").astype(float), True
+    if pd.api.types.is_numeric_dtype(column):
+        return column.to_numpy(float, na_value=np.nan), True
+    return np.arange(len(column), dtype=float), False
+
+
+def downsample(df, x, y, color=None, max_points=MAX_POINTS):
+    """Rows of ``df`` that keep every plotted series within ``max_points`` points per trace.
+
+    Each series (each ``y`` column of each ``color`` group) is reduced by LTTB
+    to its share of the budget, and the union of the rows picked is returned
+    in the frame's order, so every trace keeps its shape.
+    """
+    ys = [y] if isinstance(y, str) else list(y)
+    per_series = max(max_points // len(ys), 3)
+    xs, sortable = _x_values(df[x])
+    groups = df.groupby(color, sort=False, observed=True).indices.values() if color else [np.arange(len(df))]
+    keep = []
+    for rows in groups:
+        if len(rows) <= per_series:
+            keep.append(rows)
+            continue
+        rows = rows[np.argsort(xs[rows], kind="stable")] if sortable else rows
+        for col in ys:
+            keep.append(rows[lttb(xs[rows], df[col].to_numpy(float, na_value=np.nan)[rows], per_series)])
+    return df.iloc[np.unique(np.concatenate(keep))] if keep else df
+
+
+def build(kind, df, **options):
+    """The Plotly Express figure of ``kind``, downsampled and switched to WebGL where it pays."""
+    if kind in DOWNSAMPLED and isinstance(options.get("y"), (str, list)) and options.get("x") in df.columns:
+        df = downsample(df, options["x"], options["y"], options.get("color"))
+        series = 1 if isinstance(options["y"], str) else len(options["y"])
+        options.setdefault("render_mode", "webgl" if len(df) * series > WEBGL_POINTS else "svg")
+    return BUILDERS[kind](df, **options)
+
+
+def _digest(df):
+    content = pd.util.hash_pandas_object(df, index=True).to_numpy()
+    header = repr((list(df.columns), [str(dtype) for dtype in df.dtypes], MAX_POINTS)).encode()
+    return hashlib.sha1(header + content.tobytes()).hexdigest()
+
+
+def chart(kind, df, **options):
+    """``build`` through the shared result cache, keyed by the chart options and the frame's contents.
+
+    The figure is shared by every session showing the same chart: never modify it in place.
+    """
+    key = ("figure", kind, _digest(df), repr(sorted(options.items())))
+    return kpi_engine.RESULT_CACHE.get_or_compute(key, lambda: build(kind, df, **options))
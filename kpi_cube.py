@@ -0,0 +1,224 @@
+"""Precomputed sales cube for dimension-filtered drill-down.
+
+    python kpi_cube.py                 # fold new invoice lines into the cube
+    python kpi_cube.py --rebuild       # recompute it from scratch
+
+SalesCube holds the additive sales measures per (Day, StockItemID,
+StockGroupID, CustomerCategoryID, BuyingGroupID, SupplierID) cell. Missing
+dimension members are stored as 0 so every cell has a real key and refreshes
+can upsert. An item in several stock groups gets one cell per group;
+PrimaryGroup marks its lowest group so totals count each line once.
+
+Refreshes are incremental: CubeWatermarks remembers the last InvoiceLineID
+folded in, and only newer lines are aggregated and merged. Invoice lines are
+append-only; rebuild after editing existing lines or reassigning customers,
+items or groups.
+"""
+import argparse
+import contextlib
+import time
+
+import pandas as pd
+
+import kpi_engine
+
+CUBE_DDL = [
+    """
+    CREATE TABLE IF NOT EXISTS SalesCube (
+        Day TEXT NOT NULL,
+        StockItemID INTEGER NOT NULL,
+        StockGroupID INTEGER NOT NULL,
+        CustomerCategoryID INTEGER NOT NULL,
+        BuyingGroupID INTEGER NOT NULL,
+        SupplierID INTEGER NOT NULL,
+        PrimaryGroup INTEGER NOT NULL,
+        Lines INTEGER NOT NULL,
+        Quantity INTEGER NOT NULL,
+        Revenue REAL NOT NULL,
+        Profit REAL NOT NULL,
+        TaxAmount REAL NOT NULL,
+        ExpectedTaxAmount REAL NOT NULL,
+        PRIMARY KEY (Day, StockItemID, StockGroupID, CustomerCategoryID, BuyingGroupID, SupplierID)
+    ) WITHOUT ROWID
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS CubeWatermarks (
+        SourceTable TEXT PRIMARY KEY,
+        LastID INTEGER NOT NULL
+    )
+    """,
+]
+
+MERGE_SALES = """
+    INSERT INTO SalesCube
+    SELECT
+        il.LastEditedWhen,
+        il.StockItemID,
+        COALESCE(sisg.StockGroupID, 0),
+        COALESCE(c.CustomerCategoryID, 0),
+        COALESCE(c.BuyingGroupID, 0),
+        COALESCE(si.SupplierID, 0),
+        sisg.StockGroupID IS NULL OR sisg.StockGroupID = (
+            SELECT MIN(StockGroupID) FROM StockItemsStockGroups WHERE StockItemID = il.StockItemID
+        ),
+        COUNT(*),
+        SUM(il.Quantity),
+        SUM(il.ExtendedPrice),
+        SUM(il.LineProfit),
+        SUM(il.TaxAmount),
+        SUM(il.ExpectedTaxAmount)
+    FROM SalesInvoiceLines il
+    LEFT JOIN SalesInvoices inv ON inv.InvoiceID = il.InvoiceID
+    LEFT JOIN SalesCustomers c ON c.CustomerID = inv.CustomerID
+    LEFT JOIN WarehouseStockItem si ON si.StockItemID = il.StockItemID
+    LEFT JOIN StockItemsStockGroups sisg ON sisg.StockItemID = il.StockItemID
+    WHERE il.InvoiceLineID > ? AND il.InvoiceLineID <= ?
+    GROUP BY 1, 2, 3, 4, 5, 6
+    ON CONFLICT (Day, StockItemID, StockGroupID, CustomerCategoryID, BuyingGroupID, SupplierID) DO UPDATE SET
+        Lines = Lines + excluded.Lines,
+        Quantity = Quantity + excluded.Quantity,
+        Revenue = Revenue + excluded.Revenue,
+        Profit = Profit + excluded.Profit,
+        TaxAmount = TaxAmount + excluded.TaxAmount,
+        ExpectedTaxAmount = ExpectedTaxAmount + excluded.ExpectedTaxAmount
+"""
+
+# Cube key column -> (lookup table, name column); 0 members show as "Unassigned"
+DIMENSIONS = {
+    "StockGroupID": ("WarehouseStockGroups", "StockGroupName"),
+    "CustomerCategoryID": ("SalesCustomersCategories", "CustomerCategoryName"),
+    "BuyingGroupID": ("SalesBuyingGroups", "BuyingGroupName"),
+    "SupplierID": ("PurchasingSuppliers", "SupplierName"),
+    "StockItemID": ("WarehouseStockItem", "StockItemName"),
+}
+# Tables cube_query reads, for result cache keys
+CUBE_TABLES = ("SalesCube", "StockItemsStockGroups") + tuple(table for table, _ in DIMENSIONS.values())
+FILTER_DIMENSIONS = {
+    "StockGroupID": "Stock group",
+    "BuyingGroupID": "Buying group",
+    "SupplierID": "Supplier",
+    "CustomerCategoryID": "Customer category",
+}
+# Display format per cube_query measure, as in the "formats" of kpi_engine.KPI_CATALOG
+FORMATS = {
+    "Revenue": kpi_engine.MONEY, "Profit": kpi_engine.MONEY, "GrossMarginPct": "percent",
+    "AvgMargin": kpi_engine.MONEY, "TaxAmount": kpi_engine.MONEY, "ExpectedTaxAmount": kpi_engine.MONEY,
+}
+
+
+def merge_new_lines(conn):
+    """Fold invoice lines newer than the watermark into SalesCube inside the caller's transaction."""
+    row = conn.execute("SELECT LastID FROM CubeWatermarks WHERE SourceTable = 'SalesInvoiceLines'").fetchone()
+    last_id = row[0] if row else 0
+    high, new_lines = conn.execute(
+        "SELECT MAX(InvoiceLineID), COUNT(*) FROM SalesInvoiceLines WHERE InvoiceLineID > ?", (last_id,)
+    ).fetchone()
+    if not new_lines:
+        return 0
+    conn.execute(MERGE_SALES, (last_id, high))
+    conn.execute(
+        "INSERT INTO CubeWatermarks VALUES ('SalesInvoiceLines', ?) "
+        "ON CONFLICT (SourceTable) DO UPDATE SET LastID = excluded.LastID",
+        (high,))
+    return new_lines
+
+
+def refresh_cube(conn, rebuild=False):
+    """Fold invoice lines newer than the watermark into SalesCube; returns the number of lines merged."""
+    with conn:
+        for ddl in CUBE_DDL:
+            conn.execute(ddl)
+        if rebuild:
+            conn.execute("DELETE FROM SalesCube")
+            conn.execute("DELETE FROM CubeWatermarks")
+        return merge_new_lines(conn)
+
+
+def refresh(db_path=None, rebuild=False):
+    """Refresh the cube of a database file through its own read-write connection.
+
+    On a partitioned database the cube lives in the core file and reads the
+    invoice lines through the attached partitions.
+    """
+    with contextlib.closing(kpi_engine.connect_db(db_path, "default")) as conn:
+        return refresh_cube(conn, rebuild)
+
+
+def dimension_members(dim):
+    """(id, name) options of a filter dimension, in name order, cached per version of its table."""
+    table, name = DIMENSIONS[dim]
+    return kpi_engine.RESULT_CACHE.get_or_compute(
+        ("cube_members", dim, kpi_engine.DB_PATH, kpi_engine.TABLE_VERSIONS.version((table,))),
+        lambda: pd.read_sql(f"SELECT {dim}, {name} FROM {table} ORDER BY {name}", kpi_engine.engine))
+
+
+def cube_query(s, e, filters=None, by=None):
+    """Aggregate the cube cells of window [s, e] matching the filters, optionally per ``by`` member.
+
+    ``by`` is a DIMENSIONS key or "Period" for one row per month. ``filters`` maps dimension columns to selected ids; within a dimension the
+    ids are OR-ed, across dimensions AND-ed. A stock group filter keeps items in
+    any selected group; only a per-group breakdown counts a line in each of its
+    groups.
+    """
+    where, params = ["c.Day BETWEEN ? AND ?"], [kpi_engine._sql_param(s), kpi_engine._sql_param(e)]
+    for dim, ids in sorted((filters or {}).items()):
+        if not ids:
+            continue
+        marks = ", ".join("?" * len(ids))
+        if dim == "StockGroupID" and by != "StockGroupID":
+            where.append(f"c.StockItemID IN (SELECT StockItemID FROM StockItemsStockGroups "
+                         f"WHERE StockGroupID IN ({marks}))")
+        else:
+            where.append(f"c.{dim} IN ({marks})")
+        params += [int(i) for i in ids]
+    if by != "StockGroupID":
+        where.append("c.PrimaryGroup = 1")
+
+    columns, join, group = "", "", ""
+    if by == "Period":
+        columns = "strftime('%Y-%m-01', c.Day) AS Period,"
+        group = "GROUP BY Period ORDER BY Period"
+    elif by:
+        table, name = DIMENSIONS[by]
+        columns = f"c.{by}, COALESCE(d.{name}, 'Unassigned') AS {name},"
+        join = f"LEFT JOIN {table} d ON d.{by} = c.{by}"
+        group = f"GROUP BY c.{by} ORDER BY Revenue DESC, c.{by}"
+    query = f"""
+        SELECT {columns}
+            SUM(c.Lines) AS Lines,
+            SUM(c.Quantity) AS Quantity,
+            SUM(c.Revenue) AS Revenue,
+            SUM(c.Profit) AS Profit,
+            SUM(c.Profit) * 1.0 / NULLIF(SUM(c.Revenue), 0) AS GrossMarginPct,
+            SUM(c.Profit) * 1.0 / NULLIF(SUM(c.Lines), 0) AS AvgMargin,
+            SUM(c.TaxAmount) AS TaxAmount,
+            SUM(c.ExpectedTaxAmount) AS ExpectedTaxAmount
+        FROM SalesCube c
+        {join}
+        WHERE {" AND ".join(where)}
+        {group}
+    """
+    return pd.read_sql(query, kpi_engine.engine, params=tuple(params))
+
+
+def load_cube(s, e, filters, by=None):
+    """cube_query through the shared result cache; ``filters`` is a hashable tuple of (dim, ids) pairs."""
+    key = ("cube", by, (s, e), filters, kpi_engine.DB_PATH, kpi_engine.TABLE_VERSIONS.version(CUBE_TABLES))
+    return kpi_engine.RESULT_CACHE.get_or_compute(key, lambda: cube_query(s, e, dict(filters), by))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", default=kpi_engine.DB_PATH)
+    parser.add_argument("--rebuild", action="store_true", help="recompute the cube from scratch")
+    args = parser.parse_args()
+    started = time.perf_counter()
+    merged = refresh(args.db, args.rebuild)
+    seconds = time.perf_counter() - started
+    with contextlib.closing(kpi_engine.connect_db(args.db, "default")) as conn:
+        cells = conn.execute("SELECT COUNT(*) FROM SalesCube").fetchone()[0]
+    print(f"Merged {merged:,} invoice lines in {seconds * 1000:.0f} ms -> {cells:,} cube cells")
+
+
+if __name__ == "__main__":
+    main()
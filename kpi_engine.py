@@ -0,0 +1,1677 @@
+"""KPI query catalog and execution helpers shared by the dashboard and tooling."""
+import collections
+import contextlib
+import datetime as dt
+import functools
+import os
+import pathlib
+import re
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import pyarrow as pa
+from sqlalchemy import create_engine
+
+from kpi_partitions import Partitions
+
+try:
+    import adbc_driver_sqlite.dbapi as adbc_sqlite
+except ImportError:  # optional: the arrow backend falls back to sqlite3 batches
+    adbc_sqlite = None
+
+try:
+    import psutil
+except ImportError:  # optional: memory reports then only have the peak RSS from getrusage
+    psutil = None
+
+try:
+    import resource
+except ImportError:  # not on Windows
+    resource = None
+
+DB_PATH = "mydb.db"
+
+# The dashboard never writes, so by default it opens the database read-only
+# with a large mmap window, a bigger page cache and in-memory temp b-trees.
+# "immutable" additionally skips all locking and change detection; use it only
+# for snapshot deployments where the file cannot change underneath the app.
+_READ_PRAGMAS = {
+    "mmap_size": 268435456,  # 256 MiB
+    "cache_size": -65536,  # 64 MiB
+    "temp_store": "MEMORY",
+    "query_only": 1,
+}
+CONNECTION_PROFILES = {
+    "default": {"uri_flags": None, "pragmas": {}},
+    "readonly": {"uri_flags": "mode=ro", "pragmas": _READ_PRAGMAS},
+    "immutable": {"uri_flags": "immutable=1", "pragmas": _READ_PRAGMAS},
+}
+DB_PROFILE = os.environ.get("KPI_DB_PROFILE", "readonly")
+
+# Year-partitioned fact tables (see kpi_partitions); DB_PATH is then the core file
+PARTITIONS = Partitions(os.environ["KPI_PARTITION_DIR"]) if os.environ.get("KPI_PARTITION_DIR") else None
+if PARTITIONS is not None:
+    DB_PATH = str(PARTITIONS.core)
+PER_SCHEMA_PRAGMAS = ("mmap_size", "cache_size")
+
+
+def _db_uri(db_path, uri_flags):
+    uri = pathlib.Path(db_path).resolve().as_uri()
+    return f"{uri}?{uri_flags}" if uri_flags else uri
+
+
+def connect_db(db_path=None, profile=None):
+    """Open a sqlite3 connection to the KPI database with a connection profile applied.
+
+    Connecting to the core of a partitioned database also attaches its partitions.
+    """
+    db_path, settings = db_path or DB_PATH, CONNECTION_PROFILES[profile or DB_PROFILE]
+    # Always a URI, so partitions can be attached with their own flags
+    conn = sqlite3.connect(_db_uri(db_path, settings["uri_flags"]), uri=True, check_same_thread=False)
+    for pragma, value in settings["pragmas"].items():
+        conn.execute(f"PRAGMA {pragma} = {value}")
+    if PARTITIONS is not None and pathlib.Path(db_path).resolve() == PARTITIONS.core.resolve():
+        PARTITIONS.attach(conn, settings["uri_flags"])
+        for schema in [row[1] for row in conn.execute("PRAGMA database_list")][2:]:
+            for pragma in PER_SCHEMA_PRAGMAS:
+                if pragma in settings["pragmas"]:
+                    conn.execute(f"PRAGMA {schema}.{pragma} = {settings['pragmas'][pragma]}")
+    return conn
+
+
+def create_db_engine(db_path=None, profile=None):
+    """SQLAlchemy engine whose pooled connections come from connect_db."""
+    db_path = db_path or DB_PATH
+    return create_engine(f"sqlite:///{db_path}", creator=lambda: connect_db(db_path, profile))
+
+
+engine = create_db_engine()
+
+# "pandas" reads through pd.read_sql; "arrow" builds Arrow record batches and
+# hands them to pandas with the Arrow dtype backend (see run_proc).
+FETCH_BACKEND = os.environ.get("KPI_FETCH_BACKEND", "pandas")
+ARROW_BATCH_ROWS = 65536
+
+
+def use_database(db_path, profile=None):
+    """Point the engine at another database file or connection profile (benchmarks, scaled copies)."""
+    global DB_PATH, DB_PROFILE, engine
+    DB_PATH, DB_PROFILE = db_path, profile or DB_PROFILE
+    engine.dispose()
+    engine = create_db_engine()
+    kpi_columns.cache_clear()
+
+
+def use_partitions(directory, profile=None):
+    """Serve KPIs from a year-partitioned database directory (see kpi_partitions)."""
+    global PARTITIONS
+    PARTITIONS = Partitions(directory)
+    use_database(str(PARTITIONS.core), profile)
+
+
+def window_bounds(start_date, end_date):
+    """Inclusive datetime bounds of a date window, exactly as the dashboard binds them."""
+    return dt.datetime.combine(start_date, dt.time.min), dt.datetime.combine(end_date, dt.time.max)
+
+
+COMPARE_MODES = ["None", "Previous period", "Same period last year"]
+
+
+def _year_earlier(day):
+    try:
+        return day.replace(year=day.year - 1)
+    except ValueError:  # 29 February
+        return day.replace(year=day.year - 1, day=28)
+
+
+def comparison_window(start_date, end_date, mode):
+    """(start, end) dates to compare a window against, or None when comparison is off."""
+    if mode == "Previous period":
+        length = end_date - start_date
+        previous_end = start_date - dt.timedelta(days=1)
+        return previous_end - length, previous_end
+    if mode == "Same period last year":
+        return _year_earlier(start_date), _year_earlier(end_date)
+    return None
+
+
+def data_version():
+    """Cheap token that changes whenever the database file is written.
+
+    Frozen partitions never change, so only the core and mutable partitions are checked.
+    """
+    files = [DB_PATH] + (PARTITIONS.mutable_files() if PARTITIONS is not None else [])
+    return "-".join(f"{stat.st_mtime_ns:x}-{stat.st_size:x}" for stat in map(os.stat, files))
+
+
+def get_query(query_name):
+    # Multi-row queries carry no ORDER BY / LIMIT of their own: ordering and
+    # top-N are declared per KPI in KPI_CATALOG and applied by run_proc.
+    queries = {
+        "dbo.usp_KPI_SalesVsPurchases": """
+            SELECT 
+                (SELECT SUM(ExtendedPrice)
+                 FROM SalesInvoiceLines
+                 WHERE LastEditedWhen BETWEEN ? AND ?) AS TotalSales,
+                (SELECT SUM(PurchaseValue)
+                 FROM PurchaseOrderLines 
+                 WHERE LastReceiptDate BETWEEN ? AND ?) AS TotalPurchases
+        """,
+
+        # Measures of an (item, group) row are the item's: aggregate per item,
+        # then fan out to its groups (names come from DIMENSION_LOOKUPS)
+        "dbo.usp_KPI_AvgMarginPerProductWithGroup": """
+            WITH Items AS (
+                SELECT
+                    StockItemID,
+                    AVG(LineProfit) AS AvgMargin,
+                    COUNT(DISTINCT InvoiceID) AS InvoiceCount,
+                    SUM(LineProfit) AS TotalProfit,
+                    SUM(ExtendedPrice) AS TotalRevenue
+                FROM FactSales
+                WHERE Day BETWEEN ? AND ?
+                GROUP BY StockItemID
+            )
+            SELECT 
+                i.StockItemID,
+                sg.StockGroupID,
+                i.AvgMargin,
+                i.InvoiceCount,
+                i.TotalProfit,
+                i.TotalRevenue,
+                ROUND(
+                    i.TotalProfit * 1.0
+                    / NULLIF(i.TotalRevenue, 0)
+                    * 100, 2
+                ) AS MarginPct
+            FROM Items AS i
+            JOIN WarehouseStockItem AS si
+                ON si.StockItemID = i.StockItemID
+            LEFT JOIN StockItemsStockGroups AS sisg
+                ON sisg.StockItemID = i.StockItemID
+            LEFT JOIN WarehouseStockGroups AS sg
+                ON sg.StockGroupID = sisg.StockGroupID
+        """,
+
+        "dbo.usp_KPI_DealCoverage": """
+            SELECT
+                (SELECT COUNT(DISTINCT StockGroupID)
+                 FROM SalesSpecialDeals
+                 WHERE StockGroupID IS NOT NULL) AS GroupsWithDeals,
+                (SELECT COUNT(*) FROM WarehouseStockGroups) AS TotalGroups,
+                ROUND(
+                    CAST((SELECT COUNT(DISTINCT StockGroupID)
+                          FROM SalesSpecialDeals
+                          WHERE StockGroupID IS NOT NULL) AS REAL)
+                    / NULLIF((SELECT COUNT(*) FROM WarehouseStockGroups), 0) * 100.0,
+                    2
+                ) AS DealCoveragePercent
+        """,
+
+        "dbo.usp_KPI_StockMovementVolume": """
+            SELECT 
+                SUM(Quantity) AS TotalMovementVolume
+            FROM StockItemTransactions
+            WHERE TransactionOccurredWhen BETWEEN ? AND ?
+        """,
+
+        "dbo.usp_KPI_MostDiscountedClients": """
+            SELECT
+                bg.BuyingGroupName AS ClientGroup,
+                ROUND(SUM(COALESCE(sd.DiscountPercentage, 0.0)), 2) AS TotalDiscountPct,
+                COUNT(sd.SpecialDealID) AS DealCount,
+                ROUND(AVG(COALESCE(sd.DiscountPercentage, 0.0)), 2) AS AvgDiscount,
+                ROUND(MAX(COALESCE(sd.DiscountPercentage, 0.0)), 2) AS MaxDiscount
+            FROM SalesBuyingGroups AS bg
+            LEFT JOIN SalesSpecialDeals AS sd
+                ON bg.BuyingGroupID = sd.BuyingGroupID
+                AND sd.DiscountPercentage IS NOT NULL
+            GROUP BY bg.BuyingGroupName
+            HAVING COUNT(sd.SpecialDealID) > 0
+        """,
+
+        "dbo.usp_KPI_SupplierPerformance": """
+            WITH Receipts AS (
+                SELECT
+                    sit.SupplierID,
+                    sit.TransactionOccurredWhen AS ReceiptDate,
+                    sit.Quantity
+                FROM StockItemTransactions sit
+                JOIN ApplicationTransactionTypes tt
+                    ON tt.TransactionTypeID = sit.TransactionTypeID
+                WHERE tt.TransactionTypeName = 'Stock Receipt'
+                    AND sit.SupplierID IS NOT NULL
+            ),
+            Numbered AS (
+                SELECT
+                    SupplierID,
+                    Quantity,
+                    ReceiptDate,
+                    LAG(ReceiptDate) OVER(
+                        PARTITION BY SupplierID ORDER BY ReceiptDate
+                    ) AS PrevReceipt
+                FROM Receipts
+            )
+            SELECT
+                s.SupplierID,
+                sp.SupplierName,
+                COUNT(*) AS ReceiptEvents,
+                SUM(s.Quantity) AS TotalQtyReceived,
+                AVG(julianday(s.ReceiptDate) - julianday(s.PrevReceipt)) AS AvgDaysBetweenReceipts
+            FROM Numbered s
+            JOIN PurchasingSuppliers sp
+                ON sp.SupplierID = s.SupplierID
+            WHERE s.PrevReceipt IS NOT NULL
+            GROUP BY s.SupplierID, sp.SupplierName
+        """,
+
+        "dbo.usp_KPI_PromoPerformance": """
+            SELECT
+                COUNT(DISTINCT sd.SpecialDealID) AS ActiveDeals,
+                ROUND(AVG(COALESCE(sd.DiscountPercentage, 0.0)), 2) AS AvgDiscountPct,
+                ROUND(MAX(COALESCE(sd.DiscountPercentage, 0.0)), 2) AS MaxDiscountPct,
+                COUNT(DISTINCT sd.StockGroupID) AS GroupsWithDeals,
+                COUNT(DISTINCT sd.BuyingGroupID) AS BuyingGroupsWithDeals
+            FROM SalesSpecialDeals sd
+            WHERE sd.DiscountPercentage IS NOT NULL
+        """,
+
+        "dbo.usp_KPI_TransactionDistribution": """
+            SELECT 
+                tt.TransactionTypeName,
+                COUNT(*) AS TxnCount,
+                COUNT(*) * 100.0 / SUM(COUNT(*)) OVER() AS PctShare
+            FROM StockItemTransactions sit
+            JOIN ApplicationTransactionTypes tt 
+                ON sit.TransactionTypeID = tt.TransactionTypeID
+            WHERE sit.TransactionOccurredWhen BETWEEN ? AND ?
+            GROUP BY tt.TransactionTypeName
+        """,
+
+        "dbo.usp_KPI_GrossProfit": """
+            SELECT 
+                SUM(LineProfit) AS TotalProfit,
+                SUM(ExtendedPrice) AS TotalRevenue,
+                (SUM(LineProfit) * 1.0) / NULLIF(SUM(ExtendedPrice), 0) AS GrossMarginPct
+            FROM SalesInvoiceLines
+        """,
+
+        "dbo.usp_KPI_COGSvsPurchases": """
+            SELECT 
+                SUM(CostOfSales) AS COGS,
+                (SELECT SUM(PurchaseValue)
+                 FROM PurchaseOrderLines) AS TotalPurchases
+            FROM SalesInvoiceLines
+        """,
+
+        "dbo.usp_KPI_MonthlySalesVsPurchases": """
+            WITH Sales AS (
+                SELECT 
+                    strftime('%Y-%m-01', LastEditedWhen) AS Period,
+                    SUM(ExtendedPrice) AS Sales
+                FROM SalesInvoiceLines
+                WHERE LastEditedWhen BETWEEN ? AND ?
+                GROUP BY strftime('%Y-%m', LastEditedWhen)
+            ), Purchases AS (
+                SELECT 
+                    strftime('%Y-%m-01', LastReceiptDate) AS Period,
+                    SUM(PurchaseValue) AS Purchases
+                FROM PurchaseOrderLines
+                WHERE LastReceiptDate BETWEEN ? AND ?
+                GROUP BY strftime('%Y-%m', LastReceiptDate)
+            )
+            SELECT 
+                COALESCE(s.Period, p.Period) AS Period,
+                COALESCE(s.Sales, 0) AS Sales,
+                COALESCE(p.Purchases, 0) AS Purchases
+            FROM Sales s
+            LEFT JOIN Purchases p ON s.Period = p.Period
+            UNION ALL
+            SELECT 
+                p.Period,
+                0 AS Sales,
+                p.Purchases
+            FROM Purchases p
+            WHERE p.Period NOT IN (SELECT Period FROM Sales)
+        """,
+
+        # Headline measures for the current window (?1, ?2) and a comparison
+        # window (?3, ?4): each fact table is read once over both ranges and
+        # split by conditional aggregation.
+        "dbo.usp_KPI_HeadlinePeriods": """
+            WITH Sales AS MATERIALIZED (
+                SELECT
+                    SUM(CASE WHEN LastEditedWhen BETWEEN ?1 AND ?2 THEN ExtendedPrice END) AS CurSales,
+                    SUM(CASE WHEN LastEditedWhen BETWEEN ?1 AND ?2 THEN LineProfit END) AS CurProfit,
+                    SUM(CASE WHEN LastEditedWhen BETWEEN ?3 AND ?4 THEN ExtendedPrice END) AS CmpSales,
+                    SUM(CASE WHEN LastEditedWhen BETWEEN ?3 AND ?4 THEN LineProfit END) AS CmpProfit
+                FROM SalesInvoiceLines
+                WHERE LastEditedWhen BETWEEN ?1 AND ?2
+                   OR LastEditedWhen BETWEEN ?3 AND ?4
+            ), Purchases AS MATERIALIZED (
+                SELECT
+                    SUM(CASE WHEN LastReceiptDate BETWEEN ?1 AND ?2 THEN PurchaseValue END) AS CurPurchases,
+                    SUM(CASE WHEN LastReceiptDate BETWEEN ?3 AND ?4 THEN PurchaseValue END) AS CmpPurchases
+                FROM PurchaseOrderLines
+                WHERE LastReceiptDate BETWEEN ?1 AND ?2
+                   OR LastReceiptDate BETWEEN ?3 AND ?4
+            )
+            SELECT
+                'current' AS Period,
+                CurSales AS TotalSales,
+                CurProfit AS TotalProfit,
+                (CurProfit * 1.0) / NULLIF(CurSales, 0) AS GrossMarginPct,
+                CurPurchases AS TotalPurchases,
+                CurSales - CurProfit AS COGS
+            FROM Sales, Purchases
+            UNION ALL
+            SELECT
+                'comparison',
+                CmpSales,
+                CmpProfit,
+                (CmpProfit * 1.0) / NULLIF(CmpSales, 0),
+                CmpPurchases,
+                CmpSales - CmpProfit
+            FROM Sales, Purchases
+        """,
+
+        "dbo.usp_KPI_PromoDealsByStockGroup": """
+            SELECT
+                grp.StockGroupID,
+                grp.StockGroupName,
+                COUNT(DISTINCT sd.SpecialDealID) AS DealCount,
+                COUNT(DISTINCT COALESCE(sd.StockItemID, sisg2.StockItemID)) AS AffectedItems,
+                ROUND(AVG(COALESCE(sd.DiscountPercentage, 0.0)), 2) AS AvgDiscountPct
+            FROM WarehouseStockGroups AS grp
+            LEFT JOIN SalesSpecialDeals AS sd
+                ON grp.StockGroupID = sd.StockGroupID
+                OR grp.StockGroupID IN (
+                    SELECT sisg.StockGroupID 
+                    FROM StockItemsStockGroups sisg 
+                    WHERE sisg.StockItemID = sd.StockItemID
+                )
+            LEFT JOIN StockItemsStockGroups AS sisg2
+                ON sisg2.StockGroupID = grp.StockGroupID
+            GROUP BY grp.StockGroupID, grp.StockGroupName
+        """,
+
+        "dbo.usp_KPI_PromoPerformanceByBuyingGroup": """
+            SELECT
+                bg.BuyingGroupID,
+                bg.BuyingGroupName,
+                COUNT(DISTINCT sd.SpecialDealID) AS DealCount,
+                ROUND(AVG(COALESCE(sd.DiscountPercentage, 0.0)), 2) AS AvgDiscountPct,
+                SUM(COALESCE(il.ExtendedPrice, 0)) AS SalesDuringDeals,
+                SUM(COALESCE(il.LineProfit, 0)) AS ProfitDuringDeals
+            FROM SalesBuyingGroups AS bg
+            LEFT JOIN SalesSpecialDeals AS sd
+                ON bg.BuyingGroupID = sd.BuyingGroupID
+            LEFT JOIN StockItemsStockGroups AS sisg
+                ON sisg.StockItemID = sd.StockItemID
+            LEFT JOIN WarehouseStockGroups AS grp
+                ON grp.StockGroupID = COALESCE(sisg.StockGroupID, sd.StockGroupID)
+            LEFT JOIN StockItemsStockGroups AS sisg2
+                ON sisg2.StockGroupID = grp.StockGroupID
+            LEFT JOIN SalesInvoiceLines AS il
+                ON il.StockItemID = sisg2.StockItemID
+            GROUP BY
+                bg.BuyingGroupID,
+                bg.BuyingGroupName
+        """,
+
+        "dbo.usp_KPI_SupposedTaxAmount": """
+            SELECT 
+                il.TaxRate,
+                SUM(il.ExpectedTaxAmount) AS ExpectedTaxAmount,
+                SUM(il.TaxAmount) AS RecordedTaxAmount,
+                SUM(il.TaxAmount) - SUM(il.ExpectedTaxAmount) AS TaxVariance
+            FROM SalesInvoiceLines il
+            WHERE il.LastEditedWhen BETWEEN ? AND ?
+            GROUP BY il.TaxRate
+        """,
+
+        # A line counts towards every group of its item
+        "dbo.usp_KPI_SalesByStockGroup": """
+            WITH Items AS (
+                SELECT
+                    StockItemID,
+                    SUM(Quantity) AS Quantity,
+                    SUM(LineProfit) AS LineProfit,
+                    SUM(ExtendedPrice) AS ExtendedPrice
+                FROM FactSales
+                WHERE Day BETWEEN ? AND ?
+                GROUP BY StockItemID
+            )
+            SELECT
+                sg.StockGroupID,
+                SUM(i.Quantity) AS TotalUnitsSold,
+                SUM(i.LineProfit) AS TotalProfit,
+                SUM(i.ExtendedPrice) AS TotalRevenue,
+                ROUND(
+                    SUM(i.LineProfit) * 1.0
+                    / NULLIF(SUM(i.ExtendedPrice), 0)
+                    * 100, 2
+                ) AS GrossMarginPct
+            FROM Items AS i
+            JOIN StockItemsStockGroups AS sisg
+                ON sisg.StockItemID = i.StockItemID
+            JOIN WarehouseStockGroups AS sg
+                ON sg.StockGroupID = sisg.StockGroupID
+            GROUP BY sg.StockGroupID
+        """,
+
+        # Shipments are aggregated per customer before the customers are joined
+        "dbo.usp_KPI_CustomerSegmentSales": """
+            WITH Shipments AS (
+                SELECT
+                    CustomerID,
+                    COUNT(*) AS ShipmentEvents,
+                    SUM(ABS(Quantity)) AS TotalQtyShipped
+                FROM StockItemTransactions
+                WHERE CustomerID IS NOT NULL
+                    AND TransactionTypeID = 10
+                GROUP BY CustomerID
+            )
+            SELECT
+                cc.CustomerCategoryName,
+                COUNT(*) AS Customers,
+                SUM(sh.ShipmentEvents) AS ShipmentEvents,
+                SUM(sh.TotalQtyShipped) AS TotalQtyShipped
+            FROM Shipments sh
+            JOIN SalesCustomers c
+                ON c.CustomerID = sh.CustomerID
+            JOIN SalesCustomersCategories cc
+                ON cc.CustomerCategoryID = c.CustomerCategoryID
+            GROUP BY cc.CustomerCategoryName
+        """,
+
+        "dbo.usp_KPI_ProductImbalance_SingleRow": """
+            WITH
+            Sales AS (
+                SELECT StockItemID, SUM(Quantity) AS QtySold
+                FROM FactSales
+                WHERE Day BETWEEN ? AND ?
+                GROUP BY StockItemID
+            ),
+            Purch AS (
+                SELECT
+                    pol.StockItemID,
+                    po.SupplierID,
+                    SUM(pol.OrderedOuters) AS QtyPurchased
+                FROM PurchaseOrderLines pol
+                JOIN PurchaseOrders po
+                    ON po.PurchaseOrderID = pol.PurchaseOrderID
+                WHERE pol.LastReceiptDate BETWEEN ? AND ?
+                GROUP BY pol.StockItemID, po.SupplierID
+            ),
+            Imb AS (
+                SELECT
+                    pur.StockItemID,
+                    pur.SupplierID,
+                    COALESCE(pur.QtyPurchased, 0) AS QtyPurchased,
+                    COALESCE(sal.QtySold, 0) AS QtySold,
+                    COALESCE(pur.QtyPurchased, 0) - COALESCE(sal.QtySold, 0) AS NetBuildUp,
+                    CASE
+                        WHEN COALESCE(sal.QtySold, 0) = 0 THEN NULL
+                        ELSE CAST(pur.QtyPurchased AS REAL) / sal.QtySold
+                    END AS PurchaseToSalesRatio
+                FROM Purch pur
+                LEFT JOIN Sales sal
+                    ON sal.StockItemID = pur.StockItemID
+            )
+            SELECT
+                i.StockItemID,
+                i.SupplierID,
+                i.QtyPurchased,
+                i.QtySold,
+                i.NetBuildUp,
+                i.PurchaseToSalesRatio
+            FROM Imb i
+            JOIN WarehouseStockItem si
+                ON si.StockItemID = i.StockItemID
+            JOIN PurchasingSuppliers sup
+                ON sup.SupplierID = i.SupplierID
+        """,
+
+        # On-hand at the window end: the last month-end balance before it plus the transactions since
+        "dbo.usp_KPI_StockOnHand": """
+            WITH Checkpoint AS (
+                SELECT MAX(MonthEnd) AS MonthEnd
+                FROM StockBalances
+                WHERE MonthEnd < substr(?, 1, 7)
+            ),
+            Movements AS (
+                SELECT b.StockItemID, b.QuantityOnHand AS Quantity
+                FROM StockBalances AS b
+                JOIN Checkpoint AS cp
+                    ON cp.MonthEnd = b.MonthEnd
+                UNION ALL
+                SELECT sit.StockItemID, sit.Quantity
+                FROM StockItemTransactions AS sit
+                WHERE sit.TransactionOccurredWhen >= COALESCE(
+                        (SELECT date(MonthEnd || '-01', '+1 month') FROM Checkpoint), '')
+                    AND sit.TransactionOccurredWhen <= ?
+            )
+            SELECT
+                si.StockItemID,
+                si.StockItemName,
+                SUM(m.Quantity) AS QuantityOnHand
+            FROM Movements AS m
+            JOIN WarehouseStockItem AS si
+                ON si.StockItemID = m.StockItemID
+            GROUP BY
+                si.StockItemID,
+                si.StockItemName
+        """,
+
+        # Stock levels over time: totals of the month-end balances whose month ends inside the window
+        "dbo.usp_KPI_StockLevels": """
+            SELECT
+                MonthEnd AS Period,
+                SUM(QuantityOnHand) AS TotalOnHand,
+                SUM(QuantityOnHand > 0) AS ItemsInStock,
+                SUM(QuantityOnHand <= 0) AS ItemsOutOfStock
+            FROM StockBalances
+            WHERE MonthEnd BETWEEN substr(?, 1, 7) AND substr(?, 1, 7)
+                AND date(MonthEnd || '-01', '+1 month', '-1 day') <= date(?)
+            GROUP BY MonthEnd
+        """,
+
+        # Data validation query
+        "check_special_deals": """
+            SELECT 
+                COUNT(*) as TotalRecords,
+                COUNT(StockGroupID) as RecordsWithStockGroupID,
+                COUNT(BuyingGroupID) as RecordsWithBuyingGroupID,
+                COUNT(DiscountPercentage) as RecordsWithDiscount,
+                ROUND(AVG(COALESCE(DiscountPercentage, 0.0)), 2) as AvgDiscountPct,
+                ROUND(MAX(COALESCE(DiscountPercentage, 0.0)), 2) as MaxDiscountPct,
+                COUNT(DISTINCT StockGroupID) as UniqueStockGroups,
+                COUNT(DISTINCT BuyingGroupID) as UniqueBuyingGroups
+            FROM SalesSpecialDeals
+        """
+    }
+    return queries.get(query_name, "")
+
+
+# ── KPI catalog ────────────────────────────────────────────────────────────
+# "window": the query takes the sidebar (start, end) pair.
+# "cost": 1 single-row aggregate, 2 grouped scan, 3 multi-table join; the
+#         dashboard loads cheaper KPIs first.
+# "key": columns that uniquely identify a row; used as the sort tie-breaker.
+# "order_by": default presentation order as (column, "ASC" | "DESC") pairs.
+# "top_n": row bound applied in SQL when the dashboard loads the KPI.
+# "schema": output dtype of every column (see apply_schema). Only names are
+#           DIMENSION categoricals; keys are int32; counts and summed
+#           measures stay int64/float64 so arithmetic on them cannot
+#           overflow and money keeps its cents; ratios are float32.
+# "formats": display format per output column, applied by the dashboard grid
+#            (a st.column_config.NumberColumn format: "dollar", "percent",
+#            "localized" or printf such as "%.2f%%"); the frames stay numeric.
+MONEY = "dollar"
+COUNT = "localized"
+DIMENSION = "category"
+ARROW_STRING = "string[pyarrow]"
+
+KPI_CATALOG = {
+    "sales_vs_pur": {
+        "proc": "dbo.usp_KPI_SalesVsPurchases",
+        "window": True,
+        "cost": 1,
+        "schema": {"TotalSales": "float64", "TotalPurchases": "float64"},
+    },
+    "avg_margin_with_group": {
+        "proc": "dbo.usp_KPI_AvgMarginPerProductWithGroup",
+        "window": True,
+        "cost": 3,
+        "key": ["StockItemID", "StockGroupID"],
+        "order_by": [("AvgMargin", "DESC")],
+        "top_n": 10,
+        "schema": {"StockItemID": "int32", "StockItemName": DIMENSION, "StockGroupID": "Int32",
+                   "StockGroupName": DIMENSION, "AvgMargin": "float64", "InvoiceCount": "int64",
+                   "TotalProfit": "float64", "TotalRevenue": "float64", "MarginPct": "float32"},
+    },
+    "deal_cov": {
+        "proc": "dbo.usp_KPI_DealCoverage",
+        "window": False,
+        "cost": 1,
+        "schema": {"GroupsWithDeals": "int64", "TotalGroups": "int64", "DealCoveragePercent": "float32"},
+    },
+    "movement": {
+        "proc": "dbo.usp_KPI_StockMovementVolume",
+        "window": True,
+        "cost": 1,
+        "schema": {"TotalMovementVolume": "int64"},
+    },
+    "top_clients": {
+        "proc": "dbo.usp_KPI_MostDiscountedClients",
+        "window": False,
+        "cost": 2,
+        "key": ["ClientGroup"],
+        "order_by": [("TotalDiscountPct", "DESC")],
+        "top_n": 10,
+        "schema": {"ClientGroup": DIMENSION, "TotalDiscountPct": "float64", "DealCount": "int64",
+                   "AvgDiscount": "float32", "MaxDiscount": "float32"},
+        "formats": {"TotalDiscountPct": "%.2f%%", "AvgDiscount": "%.2f%%"},
+    },
+    "supplier_perf": {
+        "proc": "dbo.usp_KPI_SupplierPerformance",
+        "window": False,
+        "cost": 3,
+        "key": ["SupplierID"],
+        "order_by": [("TotalQtyReceived", "DESC")],
+        "top_n": 20,
+        "schema": {"SupplierID": "int32", "SupplierName": DIMENSION, "ReceiptEvents": "int64",
+                   "TotalQtyReceived": "int64", "AvgDaysBetweenReceipts": "float32"},
+    },
+    "promo_perf": {
+        "proc": "dbo.usp_KPI_PromoPerformance",
+        "window": False,
+        "cost": 1,
+        "schema": {"ActiveDeals": "int64", "AvgDiscountPct": "float32", "MaxDiscountPct": "float32",
+                   "GroupsWithDeals": "int64", "BuyingGroupsWithDeals": "int64"},
+    },
+    "txn_dist": {
+        "proc": "dbo.usp_KPI_TransactionDistribution",
+        "window": True,
+        "cost": 2,
+        "key": ["TransactionTypeName"],
+        "order_by": [("TxnCount", "DESC")],
+        "schema": {"TransactionTypeName": DIMENSION, "TxnCount": "int64", "PctShare": "float32"},
+    },
+    "gross": {
+        "proc": "dbo.usp_KPI_GrossProfit",
+        "window": False,
+        "cost": 1,
+        "schema": {"TotalProfit": "float64", "TotalRevenue": "float64", "GrossMarginPct": "float32"},
+    },
+    "cogs_vs_po": {
+        "proc": "dbo.usp_KPI_COGSvsPurchases",
+        "window": False,
+        "cost": 1,
+        "schema": {"COGS": "float64", "TotalPurchases": "float64"},
+    },
+    "promo_by_group": {
+        "proc": "dbo.usp_KPI_PromoDealsByStockGroup",
+        "window": False,
+        "cost": 2,
+        "key": ["StockGroupID"],
+        "order_by": [("DealCount", "DESC")],
+        "schema": {"StockGroupID": "int32", "StockGroupName": DIMENSION, "DealCount": "int64",
+                   "AffectedItems": "int64", "AvgDiscountPct": "float32"},
+    },
+    "promo_by_buy": {
+        "proc": "dbo.usp_KPI_PromoPerformanceByBuyingGroup",
+        "window": False,
+        "cost": 3,
+        "key": ["BuyingGroupID"],
+        "order_by": [("SalesDuringDeals", "DESC")],
+        "schema": {"BuyingGroupID": "int32", "BuyingGroupName": DIMENSION, "DealCount": "int64",
+                   "AvgDiscountPct": "float32", "SalesDuringDeals": "float64", "ProfitDuringDeals": "float64"},
+    },
+    "tax_variance": {
+        "proc": "dbo.usp_KPI_SupposedTaxAmount",
+        "window": True,
+        "cost": 2,
+        "key": ["TaxRate"],
+        "schema": {"TaxRate": "float32", "ExpectedTaxAmount": "float64", "RecordedTaxAmount": "float64",
+                   "TaxVariance": "float64"},
+        "formats": {"ExpectedTaxAmount": MONEY, "RecordedTaxAmount": MONEY, "TaxVariance": MONEY},
+    },
+    "sales_by_group": {
+        "proc": "dbo.usp_KPI_SalesByStockGroup",
+        "window": True,
+        "cost": 3,
+        "key": ["StockGroupID"],
+        "order_by": [("TotalUnitsSold", "DESC")],
+        "schema": {"StockGroupID": "int32", "StockGroupName": DIMENSION, "TotalUnitsSold": "int64",
+                   "TotalProfit": "float64", "TotalRevenue": "float64", "GrossMarginPct": "float32"},
+    },
+    "cust_seg": {
+        "proc": "dbo.usp_KPI_CustomerSegmentSales",
+        "window": False,
+        "cost": 2,
+        "key": ["CustomerCategoryName"],
+        "order_by": [("TotalQtyShipped", "DESC")],
+        "schema": {"CustomerCategoryName": DIMENSION, "Customers": "int64", "ShipmentEvents": "int64",
+                   "TotalQtyShipped": "int64"},
+    },
+    "trend": {
+        "proc": "dbo.usp_KPI_MonthlySalesVsPurchases",
+        "window": True,
+        "cost": 2,
+        "key": ["Period"],
+        "schema": {"Period": ARROW_STRING, "Sales": "float64", "Purchases": "float64"},
+        "formats": {"Sales": MONEY, "Purchases": MONEY},
+    },
+    "imbalance": {
+        "proc": "dbo.usp_KPI_ProductImbalance_SingleRow",
+        "window": True,
+        "cost": 3,
+        "key": ["StockItemID", "SupplierID"],
+        "order_by": [("NetBuildUp", "DESC")],
+        "top_n": 10,
+        "schema": {"StockItemID": "int32", "StockItemName": DIMENSION, "StockGroupNames": ARROW_STRING,
+                   "SupplierID": "int32", "SupplierName": DIMENSION, "QtyPurchased": "int64",
+                   "QtySold": "int64", "NetBuildUp": "int64", "PurchaseToSalesRatio": "float32"},
+        "formats": {"QtyPurchased": COUNT, "QtySold": COUNT, "NetBuildUp": COUNT, "PurchaseToSalesRatio": "%.2f"},
+    },
+    "stock_on_hand": {
+        "proc": "dbo.usp_KPI_StockOnHand",
+        "window": True,
+        "cost": 2,
+        "key": ["StockItemID"],
+        "order_by": [("QuantityOnHand", "DESC")],
+        "top_n": 20,
+        "schema": {"StockItemID": "int32", "StockItemName": DIMENSION, "QuantityOnHand": "int64"},
+        "formats": {"QuantityOnHand": COUNT},
+    },
+    "stock_levels": {
+        "proc": "dbo.usp_KPI_StockLevels",
+        "window": True,
+        "cost": 1,
+        "key": ["Period"],
+        "schema": {"Period": ARROW_STRING, "TotalOnHand": "int64", "ItemsInStock": "int64",
+                   "ItemsOutOfStock": "int64"},
+    },
+}
+
+
+# Name column -> (key column, query of (key, name) pairs). Queries aggregate
+# on surrogate keys and the names are attached to their final rows only.
+DIMENSION_LOOKUPS = {
+    "StockItemName": ("StockItemID", "SELECT StockItemID, StockItemName FROM WarehouseStockItem"),
+    "StockGroupName": ("StockGroupID", "SELECT StockGroupID, StockGroupName FROM WarehouseStockGroups"),
+    "SupplierName": ("SupplierID", "SELECT SupplierID, SupplierName FROM PurchasingSuppliers"),
+    "StockGroupNames": ("StockItemID", """
+        SELECT sisg.StockItemID, GROUP_CONCAT(sg.StockGroupName, ', ') AS StockGroupNames
+        FROM StockItemsStockGroups sisg
+        JOIN WarehouseStockGroups sg
+            ON sg.StockGroupID = sisg.StockGroupID
+        GROUP BY sisg.StockItemID
+    """),
+}
+# Query -> name columns it leaves to DIMENSION_LOOKUPS; each follows its key column in the output
+QUERY_NAMES = {
+    "dbo.usp_KPI_AvgMarginPerProductWithGroup": ["StockItemName", "StockGroupName"],
+    "dbo.usp_KPI_SalesByStockGroup": ["StockGroupName"],
+    "dbo.usp_KPI_ProductImbalance_SingleRow": ["StockItemName", "StockGroupNames", "SupplierName"],
+}
+
+# Tables a query reads: names after FROM/JOIN, minus the query's own CTEs
+_TABLE_REF = re.compile(r"\b(?:FROM|JOIN)\s+([A-Za-z_]\w*)", re.IGNORECASE)
+_CTE_NAME = re.compile(r"\b([A-Za-z_]\w*)\s+AS\s+(?:NOT\s+)?(?:MATERIALIZED\s+)?\(", re.IGNORECASE)
+
+
+def _query_tables(query):
+    return set(_TABLE_REF.findall(query)) - set(_CTE_NAME.findall(query))
+
+
+@functools.lru_cache(maxsize=None)
+def source_tables(query_name):
+    """Sorted names of the database tables a catalog query reads, its name lookups included."""
+    tables = _query_tables(get_query(query_name))
+    for name in QUERY_NAMES.get(query_name, []):
+        tables |= _query_tables(DIMENSION_LOOKUPS[name][1])
+    return tuple(sorted(tables))
+
+
+def kpi_tables(kpi_name):
+    return source_tables(KPI_CATALOG[kpi_name]["proc"])
+
+
+_error_handler = None
+_window_index = None
+
+
+def set_error_handler(handler):
+    """Route query errors to the UI (e.g. ``st.error``) instead of stderr."""
+    global _error_handler
+    _error_handler = handler
+
+
+def set_window_index(index):
+    """Answer window KPIs from an in-memory index (see kpi_prefix) before running SQL.
+
+    ``index.kpi(name, s, e)`` and ``index.headline_periods(s, e, cs, ce)``
+    return a frame, or None to fall back to the query.
+    """
+    global _window_index
+    _window_index = index
+
+
+_local = threading.local()
+
+
+def set_thread_profile(profile):
+    """Record the query steps this thread runs into ``profile`` (a kpi_profile.RunProfile), or stop with None."""
+    _local.profile = profile
+
+
+def _timed(section, step):
+    profile = getattr(_local, "profile", None)
+    return profile.step(section, step) if profile is not None else contextlib.nullcontext()
+
+
+@contextlib.contextmanager
+def collect_errors():
+    """Collect the query errors reported on this thread into the yielded list instead of showing them."""
+    _local.errors = errors = []
+    try:
+        yield errors
+    finally:
+        _local.errors = None
+
+
+def _report_error(message):
+    # Background loads collect their errors for the requesting page to show
+    collected = getattr(_local, "errors", None)
+    if collected is not None:
+        collected.append(message)
+    elif _error_handler is not None:
+        _error_handler(message)
+    else:
+        print(message, file=sys.stderr)
+
+
+def sort_spec(kpi_name, order_by=None):
+    """Full ORDER BY for a KPI: the requested/declared order plus its key columns."""
+    spec = KPI_CATALOG[kpi_name]
+    order = list(order_by if order_by is not None else spec.get("order_by", []))
+    sorted_cols = {col for col, _ in order}
+    order += [(col, "ASC") for col in spec.get("key", []) if col not in sorted_cols]
+    return order
+
+
+def _expand_params(proc_name, params):
+    # Procedures that filter two fact tables take the date window twice
+    if proc_name in ("dbo.usp_KPI_SalesVsPurchases", "dbo.usp_KPI_ProductImbalance_SingleRow",
+                     "dbo.usp_KPI_MonthlySalesVsPurchases"):
+        return (params[0], params[1], params[0], params[1])
+    # On-hand is as of the window end
+    if proc_name == "dbo.usp_KPI_StockOnHand":
+        return (params[1], params[1])
+    # Month-ends within the window, the last one not after its end
+    if proc_name == "dbo.usp_KPI_StockLevels":
+        return (params[0], params[1], params[1])
+    return tuple(params)
+
+
+# Bytes per KPI before/after apply_schema, reported by the dashboard diagnostics
+SCHEMA_STATS = {}
+
+
+def frame_nbytes(df):
+    """Deep in-memory size of a frame, counting string payloads."""
+    return int(df.memory_usage(deep=True, index=True).sum())
+
+
+def payload_nbytes(value):
+    """Approximate in-memory size of a cached value: deep for frames, Arrow tables, arrays, figures and containers."""
+    if isinstance(value, pd.DataFrame):
+        return frame_nbytes(value)
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(deep=True, index=True))
+    if isinstance(value, pa.Table):
+        return value.nbytes
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(payload_nbytes(k) + payload_nbytes(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(payload_nbytes(item) for item in value)
+    if isinstance(value, (str, bytes, bytearray)):
+        return sys.getsizeof(value)
+    if hasattr(value, "to_plotly_json"):  # a Plotly figure: its trace arrays and layout
+        return payload_nbytes(value.to_plotly_json())
+    return getattr(value, "nbytes", None) or sys.getsizeof(value)
+
+
+def process_memory():
+    """{"rss": current resident bytes (needs psutil), "peak_rss": peak resident bytes}; None where unknown."""
+    rss = psutil.Process().memory_info().rss if psutil is not None else None
+    # ru_maxrss is in KiB on Linux, bytes on macOS
+    peak = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+            if resource is not None else None)
+    return {"rss": rss, "peak_rss": peak}
+
+
+def apply_schema(df, kpi_name, keep=()):
+    """Cast a KPI frame to its declared output schema.
+
+    Declared columns take the catalog dtype whatever the data. An all-NULL
+    measure therefore stays numeric, and an integer column holding NULLs
+    takes the nullable equivalent (int64 -> Int64). Undeclared columns and
+    those in ``keep`` are left as read.
+    """
+    schema = KPI_CATALOG[kpi_name].get("schema", {})
+    out = {}
+    for col in df.columns:
+        series = df[col]
+        dtype = schema.get(col)
+        if col in keep or dtype is None:
+            out[col] = series
+            continue
+        if dtype.startswith("int") and series.isna().any():
+            dtype = dtype.capitalize()
+        out[col] = series.astype(dtype)
+    return pd.DataFrame(out, index=df.index)
+
+
+def _compact(df, kpi_name):
+    compact = apply_schema(df, kpi_name)
+    if df.empty:
+        return compact
+    SCHEMA_STATS[kpi_name] = {
+        "rows": len(df),
+        "raw_bytes": frame_nbytes(df),
+        "compact_bytes": frame_nbytes(compact),
+    }
+    return compact
+
+
+FILTER_OPS = {"=": "=", "!=": "!=", ">": ">", ">=": ">=", "<": "<", "<=": "<=", "contains": "LIKE"}
+
+
+def _sql_param(value):
+    # Bind dates as the ISO text the fact tables store, identically for every backend
+    if isinstance(value, dt.datetime):
+        return value.isoformat(" ")
+    if isinstance(value, dt.date):
+        return value.isoformat()
+    return value
+
+
+# Time budget per cost tier in seconds; a catalog "timeout" overrides it
+TIME_BUDGETS = {1: 10, 2: 30, 3: 60}
+PROGRESS_STEPS = 20000  # SQLite VM instructions between budget checks
+
+
+def kpi_budget(kpi_name):
+    spec = KPI_CATALOG[kpi_name]
+    return spec.get("timeout", TIME_BUDGETS[spec.get("cost", 2)])
+
+
+class QueryInterrupted(Exception):
+    """A query stopped by its time budget ("timeout") or because its callers abandoned it ("cancelled")."""
+
+    def __init__(self, proc_name, reason, budget=None):
+        self.proc_name, self.reason, self.budget = proc_name, reason, budget
+        detail = f"timed out after {budget:g}s" if reason == "timeout" else "was cancelled"
+        super().__init__(f"{proc_name} {detail}")
+
+
+class QueryGuard:
+    """Deadline and cancel flag polled by SQLite's progress handler while a query runs.
+
+    The deadline starts with the first execution, not when the load is queued.
+    """
+
+    def __init__(self, budget=None):
+        self.budget = budget
+        self.deadline = None
+        self.cancelled = threading.Event()
+
+    def start(self):
+        if self.budget and self.deadline is None:
+            self.deadline = time.monotonic() + self.budget
+
+    def check(self):
+        # Non-zero makes SQLite abort the statement with "interrupted"
+        return int(self.cancelled.is_set() or (self.deadline is not None and time.monotonic() > self.deadline))
+
+    def interrupted(self, proc_name):
+        return QueryInterrupted(proc_name, "cancelled" if self.cancelled.is_set() else "timeout", self.budget)
+
+
+class QueryGuards:
+    """Guards of in-flight KPI loads by cache key, reference-counted by the batches waiting on them.
+
+    A load shared through the single-flight cache is only cancelled once every
+    batch that asked for it has been cancelled.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._guards = {}
+
+    def hold(self, key, budget):
+        with self._lock:
+            entry = self._guards.setdefault(key, [QueryGuard(budget), 0])
+            entry[1] += 1
+            return entry[0]
+
+    def release(self, key, cancel=False):
+        with self._lock:
+            entry = self._guards.get(key)
+            if entry is None:
+                return
+            entry[1] -= 1
+            if entry[1] <= 0:
+                del self._guards[key]
+                if cancel:
+                    entry[0].cancelled.set()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._guards.get(key)
+            return entry[0] if entry else None
+
+
+QUERY_GUARDS = QueryGuards()
+
+
+def _window_years(params):
+    # Date parameters bound a query's window: it only reads those years' partitions
+    dates = [p for p in params if isinstance(p, dt.date)]
+    return (min(dates).year, max(dates).year) if dates else (None, None)
+
+
+def _partition_route(conn, params):
+    if PARTITIONS is None:
+        return contextlib.nullcontext()
+    return PARTITIONS.routed(conn, *_window_years(params))
+
+
+@contextlib.contextmanager
+def _progress_guard(conn, guard):
+    if guard is None:
+        yield
+        return
+    guard.start()
+    conn.set_progress_handler(guard.check, PROGRESS_STEPS)
+    try:
+        yield
+    finally:
+        conn.set_progress_handler(None, 0)
+
+
+def read_arrow(query, params=(), guard=None):
+    """Run a query straight into an Arrow table.
+
+    With the ADBC SQLite driver installed, result columns are filled natively
+    without any per-row Python objects. Otherwise rows are pulled from sqlite3
+    in large batches and transposed into Arrow arrays, which still skips the
+    per-cell object inference of ``pd.read_sql``.
+    """
+    years = _window_years(params)
+    params = tuple(_sql_param(p) for p in params)
+    settings = CONNECTION_PROFILES[DB_PROFILE]
+    # ADBC has no interrupt hook or partition routing, so those reads take the sqlite3 path
+    if adbc_sqlite is not None and guard is None and PARTITIONS is None:
+        uri = _db_uri(DB_PATH, settings["uri_flags"]) if settings["uri_flags"] else DB_PATH
+        with adbc_sqlite.connect(uri) as conn, conn.cursor() as cur:
+            for pragma, value in settings["pragmas"].items():
+                cur.execute(f"PRAGMA {pragma} = {value}")
+            cur.execute(query, params)
+            return cur.fetch_arrow_table()
+    with contextlib.closing(connect_db()) as conn, _progress_guard(conn, guard):
+        if PARTITIONS is not None:
+            PARTITIONS.route(conn, *years)
+        cur = conn.execute(query, params)
+        names = [col[0] for col in cur.description]
+        tables = []
+        while rows := cur.fetchmany(ARROW_BATCH_ROWS):
+            tables.append(pa.table([pa.array(col) for col in zip(*rows)], names=names))
+    if not tables:
+        return pa.table({name: pa.array([], pa.null()) for name in names})
+    # Batches may disagree on a column's type (all-NULL batch, int vs real)
+    return pa.concat_tables(tables, promote_options="permissive")
+
+
+def dimension_lookup(name):
+    """{key: name} Series of a DIMENSION_LOOKUPS column, cached per version of the tables it reads."""
+    key, query = DIMENSION_LOOKUPS[name]
+    cache_key = ("dimension", name, DB_PATH, TABLE_VERSIONS.version(tuple(sorted(_query_tables(query)))))
+    return RESULT_CACHE.get_or_compute(cache_key, lambda: pd.read_sql(query, engine).set_index(key)[name])
+
+
+def _join_names(query, names):
+    # Left-join name lookups onto a query's output rows
+    joins = "".join(f" LEFT JOIN ({DIMENSION_LOOKUPS[name][1]}) AS {name}_lookup"
+                    f" ON {name}_lookup.{DIMENSION_LOOKUPS[name][0]} = kpi.{DIMENSION_LOOKUPS[name][0]}"
+                    for name in names)
+    columns = "".join(f", {name}_lookup.{name}" for name in names)
+    return f"SELECT kpi.*{columns} FROM ({query}) AS kpi{joins}"
+
+
+def _attach_names(df, names, joined=()):
+    # Each name column goes after its key column, or after the previous name of the same key
+    after = {}
+    for name in names:
+        key = DIMENSION_LOOKUPS[name][0]
+        if key not in df.columns:
+            continue
+        values = df.pop(name) if name in joined else df[key].map(dimension_lookup(name))
+        df.insert(df.columns.get_loc(after.get(key, key)) + 1, name, values)
+        after[key] = name
+    return df
+
+
+def _read_sql(proc_name, query, conn, params):
+    if getattr(_local, "profile", None) is None:
+        return pd.read_sql(query, conn, params=params)
+    # What pd.read_sql does, split into running the query to its last row and building the frame
+    with _timed(proc_name, "sql"):
+        result = conn.exec_driver_sql(query, params)
+        columns, rows = list(result.keys()), result.fetchall()
+    with _timed(proc_name, "to DataFrame"):
+        return pd.DataFrame.from_records(rows, columns=columns, coerce_float=True)
+
+
+def run_proc(proc_name: str, params=(), order_by=None, limit=None, offset=None, where=None, where_params=(),
+             backend=None, guard=None):
+    """Run a named query into a DataFrame; errors are reported and give an empty frame.
+
+    With a ``guard`` the query is interrupted once its budget runs out or it is
+    cancelled, raising QueryInterrupted instead. Name columns of QUERY_NAMES are
+    attached to the result rows from the dimension lookup cache, or joined in
+    SQL when the filter or sort refers to them.
+    """
+    query = get_query(proc_name)
+    if not query:
+        return pd.DataFrame()  # Return empty DataFrame if query not found
+
+    names = QUERY_NAMES.get(proc_name, [])
+    joined = [name for name in names if f'"{name}"' in (where or "") or name in dict(order_by or ())]
+    if joined:
+        query = _join_names(query, joined)
+    sql_params = _expand_params(proc_name, params)
+    if order_by or where or limit is not None:
+        # Wrap the KPI so filters, ordering and the row bound apply to its
+        # output columns and SQLite can use a bounded (LIMIT-aware) sorter.
+        query = f"SELECT * FROM ({query}) AS kpi"
+        if where:
+            query += f" WHERE {where}"
+            sql_params += tuple(where_params)
+        if order_by:
+            query += " ORDER BY " + ", ".join(f'"{col}" {direction}' for col, direction in order_by)
+        if limit is not None:
+            query += " LIMIT ? OFFSET ?"
+            sql_params += (int(limit), int(offset or 0))
+
+    try:
+        if (backend or FETCH_BACKEND) == "arrow":
+            with _timed(proc_name, "sql"):
+                table = read_arrow(query, sql_params, guard)
+            with _timed(proc_name, "to DataFrame"):
+                df = table.to_pandas(types_mapper=pd.ArrowDtype)
+        else:
+            with engine.connect() as conn:
+                raw = conn.connection.driver_connection
+                with _partition_route(raw, sql_params), _progress_guard(raw, guard):
+                    df = _read_sql(proc_name, query, conn, sql_params)
+        with _timed(proc_name, "names"):
+            return _attach_names(df, names, joined)
+    except Exception as e:
+        if guard is not None and guard.check():
+            raise guard.interrupted(proc_name) from e
+        _report_error(f"Error executing query {proc_name}: {e}")
+        return pd.DataFrame()  # Return empty DataFrame on error
+
+
+def fetch_kpi(kpi_name, s=None, e=None, limit=None, order_by=None, backend=None, guard=None):
+    """Run a catalog KPI; ``limit`` defaults to its declared top-N."""
+    spec = KPI_CATALOG[kpi_name]
+    params = (s, e) if spec["window"] else ()
+    if limit is None:
+        limit = spec.get("top_n")
+    order = sort_spec(kpi_name, order_by) if ("key" in spec or order_by) else None
+    df = run_proc(spec["proc"], params, order_by=order, limit=limit, backend=backend, guard=guard)
+    with _timed(kpi_name, "compact"):
+        return _compact(df, kpi_name)
+
+
+class SingleFlight:
+    """Coalesce concurrent calls for the same key into one execution.
+
+    The first caller (the leader) runs the function; callers arriving while it
+    is in flight wait for it and receive the same result or exception.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self.executions = 0
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._in_flight.get(key)
+            leader = call is None
+            if leader:
+                call = self._in_flight[key] = {"done": threading.Event(), "result": None, "error": None}
+            else:
+                self.coalesced += 1
+        if not leader:
+            call["done"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            return call["result"]
+        try:
+            call["result"] = fn()
+            return call["result"]
+        except BaseException as exc:
+            call["error"] = exc
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+                self.executions += 1
+            call["done"].set()
+
+
+class ResultCache:
+    """Process-wide TTL cache of KPI frames and other derived results, filled through a SingleFlight.
+
+    Entries are kept in least-recently-used order with their in-memory size
+    (``payload_nbytes``). Once the total passes ``budget`` bytes, expired
+    entries are dropped, then the least recently used ones, so a long-running
+    process holds a bounded amount of results however many date windows its
+    users try. A result larger than the whole budget is returned uncached.
+
+    A computation that reported query errors (``run_proc`` then returns an
+    empty frame) is not cached, so the next load retries it. Every caller
+    sharing its in-flight result gets the errors reported on its own thread,
+    to show them with the result.
+
+    Cached frames are shared by every session and must be treated as read-only.
+    """
+
+    def __init__(self, ttl=600, budget=None):
+        self.ttl = ttl
+        self.budget = budget
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self.flight = SingleFlight()
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+        self.evictions = 0
+        self.oversized = 0
+
+    def get_or_compute(self, key, fn):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry["expires"] > now:
+                self.hits += 1
+                entry["hits"] += 1
+                self._entries.move_to_end(key)
+                return entry["value"]
+            self.misses += 1
+
+        def compute():
+            outer = getattr(_local, "errors", None)
+            _local.errors = errors = []
+            try:
+                value = fn()
+            finally:
+                _local.errors = outer
+            if isinstance(value, (pd.DataFrame, pd.Series)):
+                # pandas fills an index's hash table lazily and not thread-safely; a session looking up
+                # labels mid-fill can see a unique index as non-unique, so fill it before sharing the value
+                value.index.is_unique
+            if not errors:
+                self._store(key, value)
+            return value, errors
+
+        value, errors = self.flight.do(key, compute)
+        for message in errors:
+            _report_error(message)
+        return value
+
+    def _store(self, key, value):
+        nbytes = payload_nbytes(value)
+        now = time.monotonic()
+        with self._lock:
+            self._discard(key)
+            if self.budget is not None and nbytes > self.budget:
+                self.oversized += 1
+                return
+            self._entries[key] = {"expires": now + self.ttl, "value": value, "nbytes": nbytes, "hits": 0,
+                                  "stored": now}
+            self.nbytes += nbytes
+            if self.budget is None or self.nbytes <= self.budget:
+                return
+            for stale in [k for k, entry in self._entries.items() if entry["expires"] <= now]:
+                self._discard(stale)
+            while self.nbytes > self.budget:
+                self._discard(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry["nbytes"]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def entries(self):
+        """[(key, bytes, hits, age in seconds, expired)] from least to most recently used."""
+        now = time.monotonic()
+        with self._lock:
+            return [(key, entry["nbytes"], entry["hits"], now - entry["stored"], entry["expires"] <= now)
+                    for key, entry in self._entries.items()]
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "executions": self.flight.executions,
+            "duplicates_avoided": self.flight.coalesced,
+            "bytes": self.nbytes,
+            "budget": self.budget,
+            "evictions": self.evictions,
+            "oversized": self.oversized,
+        }
+
+
+# Memory budget of the result cache, in MiB
+CACHE_BUDGET_MB = float(os.environ.get("KPI_CACHE_MB", "256"))
+RESULT_CACHE = ResultCache(ttl=600, budget=int(CACHE_BUDGET_MB * 2**20))
+
+
+def _entry_owner(key):
+    # (kind, name, the rest of the key): load_kpi keys lead with the KPI name (then its parameters); other
+    # entries with their kind, then usually the KPI or dimension they belong to
+    if key[0] in KPI_CATALOG:
+        return "kpi", key[0], key[1]
+    if len(key) > 1 and isinstance(key[1], str):
+        return key[0], key[1], key[2:]
+    return key[0], "", key[1:]
+
+
+def cache_memory(per_entry=False):
+    """Bytes held by the result cache per (kind, name) (KPI, page, cube, dimension, …), largest first.
+
+    With ``per_entry`` every entry is listed with its key, hit count, age and
+    whether it has expired (expired entries stay until evicted or replaced).
+    """
+    rows = []
+    for key, nbytes, hits, age, expired in RESULT_CACHE.entries():
+        kind, name, rest = _entry_owner(key)
+        rows.append({"Kind": kind, "Name": name, "Key": repr(rest),
+                     "Bytes": nbytes, "Hits": hits, "AgeSeconds": round(age, 1), "Expired": expired})
+    entries = pd.DataFrame(rows, columns=["Kind", "Name", "Key", "Bytes", "Hits", "AgeSeconds", "Expired"])
+    if per_entry:
+        return entries.sort_values("Bytes", ascending=False, ignore_index=True)
+    return (entries.groupby(["Kind", "Name"], as_index=False)
+            .agg(Entries=("Bytes", "size"), Bytes=("Bytes", "sum"), Hits=("Hits", "sum"))
+            .sort_values("Bytes", ascending=False, ignore_index=True))
+
+
+class TableVersions:
+    """Per-table change counters, so a cached result only expires when a table it reads changes.
+
+    A dedicated connection reads ``PRAGMA data_version`` of every attached
+    database, which moves whenever another connection commits; only then are
+    the tracked tables re-signed by row count and highest rowid. A commit that
+    changes no signature (an in-place UPDATE) bumps every tracked table.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._conn = None
+        self._db_path = None
+        self._data_version = None
+        self._signatures = {}
+        self._versions = {}
+        self.commits_seen = 0
+
+    def _connection(self):
+        if self._conn is None or self._db_path != DB_PATH:
+            if self._conn is not None:
+                self._conn.close()
+            self._conn, self._db_path, self._data_version = connect_db(), DB_PATH, None
+            # Another database: every tracked table counts as changed
+            self._versions = {table: version + 1 for table, version in self._versions.items()}
+            self._signatures = {table: self._signature(table) for table in self._signatures}
+        return self._conn
+
+    def _signature(self, table):
+        try:
+            return self._conn.execute(f"SELECT COUNT(*), MAX(rowid) FROM {table}").fetchone()
+        except sqlite3.OperationalError:  # WITHOUT ROWID tables and partition views
+            return self._conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()
+
+    def _poll(self):
+        schemas = [row[1] for row in self._conn.execute("PRAGMA database_list") if row[1] != "temp"]
+        data_version = tuple(self._conn.execute(f"PRAGMA {schema}.data_version").fetchone()[0]
+                             for schema in schemas)
+        if data_version == self._data_version:
+            return
+        first, self._data_version = self._data_version is None, data_version
+        if first:
+            return
+        self.commits_seen += 1
+        signatures = {table: self._signature(table) for table in self._signatures}
+        changed = [table for table, sig in signatures.items() if sig != self._signatures[table]]
+        for table in changed or signatures:
+            self._versions[table] += 1
+        self._signatures = signatures
+
+    def version(self, tables):
+        """Change counters of ``tables`` as of now; new tables start being tracked."""
+        with self._lock:
+            self._connection()
+            self._poll()
+            for table in tables:
+                if table not in self._signatures:
+                    self._signatures[table] = self._signature(table)
+                    self._versions.setdefault(table, 0)
+            return tuple(self._versions[table] for table in tables)
+
+
+TABLE_VERSIONS = TableVersions()
+
+
+def load_kpi(kpi_name, s=None, e=None, key=None):
+    """Dashboard entry point: a KPI at its declared top-N, cached and single-flighted.
+
+    The cache key is (KPI, parameters, versions of the tables it reads), so
+    windowless KPIs are shared across every date window, concurrent identical
+    loads run the query once, and a write makes the next load of the KPIs
+    reading the written tables recompute. A KPIBatch passes the ``key`` it
+    registered the query's guard under, so a write in between cannot detach
+    the query from the batch's cancel.
+    """
+    key = key or _cache_key(kpi_name, s, e)
+
+    def fetch():
+        if _window_index is not None:
+            with _timed(kpi_name, "prefix index"):
+                df = _window_index.kpi(kpi_name, s, e)
+            if df is not None:
+                return df
+        # Bounded by the KPI's time budget; batches waiting on it can also cancel it
+        guard = QUERY_GUARDS.get(key) or QueryGuard(kpi_budget(kpi_name))
+        return fetch_kpi(kpi_name, s, e, guard=guard)
+
+    return RESULT_CACHE.get_or_compute(key, fetch)
+
+
+def _cache_key(kpi_name, s, e):
+    params = (s, e) if KPI_CATALOG[kpi_name]["window"] else ()
+    return kpi_name, params, DB_PATH, TABLE_VERSIONS.version(kpi_tables(kpi_name))
+
+
+# Shared by every session: concurrent pages queue behind each other instead of
+# each opening a connection per KPI.
+KPI_EXECUTOR = ThreadPoolExecutor(max_workers=int(os.environ.get("KPI_WORKERS", "4")), thread_name_prefix="kpi")
+
+
+class KPIBatch(dict):
+    """{name: future} of one page run's KPI loads.
+
+    ``cancel()`` abandons the loads: queued ones never start, and running ones
+    are interrupted unless another batch is still waiting on the same result.
+    With a ``profile`` (kpi_profile.RunProfile) each load is timed and cProfiled into it.
+    """
+
+    def __init__(self, profile=None):
+        super().__init__()
+        self._lock = threading.Lock()
+        self._held = {}
+        self.cancelled = threading.Event()
+        self.profile = profile
+
+    def hold(self, name, key):
+        QUERY_GUARDS.hold(key, kpi_budget(name))
+        self._held[name] = key
+
+    def release(self, name, cancel=False):
+        with self._lock:
+            key = self._held.pop(name, None)
+        if key is not None:
+            QUERY_GUARDS.release(key, cancel)
+
+    def cancel(self):
+        self.cancelled.set()
+        for name in list(self._held):
+            self.release(name, cancel=True)
+
+
+def _load_in_batch(batch, kpi_name, s, e, key):
+    _local.errors = []
+    _local.profile = batch.profile
+    try:
+        if batch.cancelled.is_set():
+            raise QueryInterrupted(KPI_CATALOG[kpi_name]["proc"], "cancelled")
+        with batch.profile.capture() if batch.profile else contextlib.nullcontext(), _timed(kpi_name, "load"):
+            return load_kpi(kpi_name, s, e, key), _local.errors
+    finally:
+        _local.errors = None
+        _local.profile = None
+        batch.release(kpi_name)
+
+
+def submit_kpis(s, e, names=None, profile=None):
+    """Start loading KPIs on the background executor, cheapest first.
+
+    Returns a KPIBatch of futures in submission order; each resolves to
+    (frame, error messages reported while loading it) or raises
+    QueryInterrupted when the KPI ran out of budget or was cancelled.
+    """
+    batch = KPIBatch(profile)
+    for name in sorted(names or KPI_CATALOG, key=lambda name: KPI_CATALOG[name].get("cost", 2)):
+        key = _cache_key(name, s, e)
+        batch.hold(name, key)
+        batch[name] = KPI_EXECUTOR.submit(_load_in_batch, batch, name, s, e, key)
+    return batch
+
+
+HEADLINE_MEASURES = ["TotalSales", "TotalProfit", "GrossMarginPct", "TotalPurchases", "COGS"]
+
+
+def load_headline_periods(s, e, cs, ce):
+    """Headline measures of the window (s, e) and the comparison window (cs, ce), indexed by Period.
+
+    Both periods come from one query that reads each fact table once, so a
+    comparison costs about as much as the window alone.
+    """
+    def fetch():
+        if _window_index is not None:
+            df = _window_index.headline_periods(s, e, cs, ce)
+            if df is not None:
+                return df
+        df = run_proc("dbo.usp_KPI_HeadlinePeriods", (s, e, cs, ce))
+        return df.set_index("Period") if "Period" in df.columns else df
+
+    key = ("headline_periods", (s, e, cs, ce), DB_PATH,
+           TABLE_VERSIONS.version(source_tables("dbo.usp_KPI_HeadlinePeriods")))
+    return RESULT_CACHE.get_or_compute(key, fetch)
+
+
+@functools.lru_cache(maxsize=None)
+def kpi_columns(kpi_name):
+    """Output column names of a KPI, read from an empty result."""
+    spec = KPI_CATALOG[kpi_name]
+    params = (None, None) if spec["window"] else ()
+    return list(run_proc(spec["proc"], params, limit=0).columns)
+
+
+def kpi_formats(kpi_name):
+    """Display format per column of a KPI (see "formats" in KPI_CATALOG)."""
+    return KPI_CATALOG[kpi_name].get("formats", {})
+
+
+def _keyset_predicate(order, after):
+    # Rows strictly after ``after`` in ``order``; SQLite sorts NULLs first
+    # ascending and last descending, so they need explicit handling.
+    clauses, params = [], []
+    for i, (col, direction) in enumerate(order):
+        terms, term_params = [], []
+        for (prev_col, _), prev_value in zip(order[:i], after[:i]):
+            terms.append(f'"{prev_col}" IS ?')
+            term_params.append(prev_value)
+        value = after[i]
+        if value is None:
+            if direction == "DESC":
+                continue  # nothing sorts after NULL in descending order
+            terms.append(f'"{col}" IS NOT NULL')
+        elif direction == "DESC":
+            terms.append(f'("{col}" < ? OR "{col}" IS NULL)')
+            term_params.append(value)
+        else:
+            terms.append(f'"{col}" > ?')
+            term_params.append(value)
+        clauses.append("(" + " AND ".join(terms) + ")")
+        params += term_params
+    return ("(" + " OR ".join(clauses) + ")" if clauses else "0"), params
+
+
+def fetch_page(kpi_name, s=None, e=None, order_by=None, filters=(), after=None, page_size=50):
+    """One keyset page of a KPI's full result.
+
+    ``filters`` is a sequence of (column, op, value) with op from FILTER_OPS,
+    ``after`` the sort-column values of the previous page's last row (see
+    ``page_cursor``). Sorting, filtering and the page bound all run in SQL.
+    """
+    spec = KPI_CATALOG[kpi_name]
+    columns = kpi_columns(kpi_name)
+    order = sort_spec(kpi_name, order_by)
+    where, where_params = [], []
+    for col, op, value in filters:
+        if col not in columns or op not in FILTER_OPS:
+            raise ValueError(f"Unsupported filter {col!r} {op!r} for {kpi_name}")
+        where.append(f'"{col}" {FILTER_OPS[op]} ?')
+        where_params.append(f"%{value}%" if op == "contains" else value)
+    for col, direction in order:
+        if col not in columns or direction not in ("ASC", "DESC"):
+            raise ValueError(f"Unsupported sort {col!r} {direction!r} for {kpi_name}")
+    if after is not None:
+        predicate, predicate_params = _keyset_predicate(order, after)
+        where.append(predicate)
+        where_params += predicate_params
+    params = (s, e) if spec["window"] else ()
+    page = run_proc(spec["proc"], params, order_by=order, limit=page_size,
+                    where=" AND ".join(where) or None, where_params=where_params,
+                    guard=QueryGuard(kpi_budget(kpi_name)))
+    # Sort columns keep SQLite's values: a float32 cursor would not compare equal to the stored float64
+    return apply_schema(page, kpi_name, keep={col for col, _ in order})
+
+
+def load_page(kpi_name, s=None, e=None, order_by=None, filters=(), after=None, page_size=50):
+    """fetch_page through the shared result cache, per version of the KPI's tables."""
+    key = ("page", kpi_name, (s, e), order_by, tuple(filters), after, page_size, DB_PATH,
+           TABLE_VERSIONS.version(kpi_tables(kpi_name)))
+    return RESULT_CACHE.get_or_compute(key, lambda: fetch_page(kpi_name, s, e, order_by, filters, after, page_size))
+
+
+def page_cursor(page, kpi_name, order_by=None):
+    """Keyset cursor (sort-column values of the last row) for the page after ``page``."""
+    return tuple(_to_python(page[col].iloc[-1]) for col, _ in sort_spec(kpi_name, order_by))
+
+
+def _to_python(value):
+    # numpy scalars and NaN are not valid sqlite3 parameters
+    if pd.isna(value):
+        return None
+    return value.item() if hasattr(value, "item") else value
@@ -0,0 +1,120 @@
+"""Denormalised sales fact: one wide row per invoice line.
+
+    python kpi_fact.py                 # fold new invoice lines into FactSales
+    python kpi_fact.py --rebuild       # recompute it from scratch
+
+FactSales carries each line's measures with the integer surrogate keys of its
+customer, customer category, buying group, supplier and primary (lowest)
+stock group, so KPIs aggregate a single table and attach names only to their
+final rows (see ``kpi_engine.DIMENSION_LOOKUPS``). It is clustered by
+(Day, InvoiceLineID), so a date window is one contiguous range of the table.
+Missing dimension members are stored as NULL.
+
+Refreshes are incremental: FactWatermarks remembers the last InvoiceLineID
+folded in. Invoice lines are append-only; rebuild after editing existing
+lines or reassigning customers, items or groups.
+"""
+import argparse
+import contextlib
+import time
+
+import kpi_engine
+
+FACT_DDL = [
+    """
+    CREATE TABLE IF NOT EXISTS FactSales (
+        Day TEXT NOT NULL,
+        InvoiceLineID INTEGER NOT NULL,
+        InvoiceID INTEGER NOT NULL,
+        StockItemID INTEGER NOT NULL,
+        CustomerID INTEGER,
+        CustomerCategoryID INTEGER,
+        BuyingGroupID INTEGER,
+        SupplierID INTEGER,
+        PrimaryStockGroupID INTEGER,
+        Quantity INTEGER NOT NULL,
+        ExtendedPrice REAL NOT NULL,
+        LineProfit REAL NOT NULL,
+        PRIMARY KEY (Day, InvoiceLineID)
+    ) WITHOUT ROWID
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS FactWatermarks (
+        SourceTable TEXT PRIMARY KEY,
+        LastID INTEGER NOT NULL
+    )
+    """,
+]
+
+MERGE_FACT = """
+    INSERT INTO FactSales
+    SELECT
+        il.LastEditedWhen,
+        il.InvoiceLineID,
+        il.InvoiceID,
+        il.StockItemID,
+        inv.CustomerID,
+        c.CustomerCategoryID,
+        c.BuyingGroupID,
+        si.SupplierID,
+        (SELECT MIN(StockGroupID) FROM StockItemsStockGroups WHERE StockItemID = il.StockItemID),
+        il.Quantity,
+        il.ExtendedPrice,
+        il.LineProfit
+    FROM SalesInvoiceLines il
+    LEFT JOIN SalesInvoices inv ON inv.InvoiceID = il.InvoiceID
+    LEFT JOIN SalesCustomers c ON c.CustomerID = inv.CustomerID
+    LEFT JOIN WarehouseStockItem si ON si.StockItemID = il.StockItemID
+    WHERE il.InvoiceLineID > ? AND il.InvoiceLineID <= ?
+"""
+
+
+def merge_new_lines(conn):
+    """Append invoice lines newer than the watermark to FactSales inside the caller's transaction."""
+    row = conn.execute("SELECT LastID FROM FactWatermarks WHERE SourceTable = 'SalesInvoiceLines'").fetchone()
+    last_id = row[0] if row else 0
+    high, new_lines = conn.execute(
+        "SELECT MAX(InvoiceLineID), COUNT(*) FROM SalesInvoiceLines WHERE InvoiceLineID > ?", (last_id,)
+    ).fetchone()
+    if not new_lines:
+        return 0
+    conn.execute(MERGE_FACT, (last_id, high))
+    conn.execute(
+        "INSERT INTO FactWatermarks VALUES ('SalesInvoiceLines', ?) "
+        "ON CONFLICT (SourceTable) DO UPDATE SET LastID = excluded.LastID",
+        (high,))
+    return new_lines
+
+
+def refresh_fact(conn, rebuild=False):
+    """Append invoice lines newer than the watermark to FactSales; returns the number of lines added."""
+    with conn:
+        for ddl in FACT_DDL:
+            conn.execute(ddl)
+        if rebuild:
+            conn.execute("DELETE FROM FactSales")
+            conn.execute("DELETE FROM FactWatermarks")
+        return merge_new_lines(conn)
+
+
+def refresh(db_path=None, rebuild=False):
+    """Refresh the fact table of a database file through its own read-write connection."""
+    with contextlib.closing(kpi_engine.connect_db(db_path, "default")) as conn:
+        return refresh_fact(conn, rebuild)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", default=kpi_engine.DB_PATH)
+    parser.add_argument("--rebuild", action="store_true", help="recompute the fact table from scratch")
+    args = parser.parse_args()
+    started = time.perf_counter()
+    added = refresh(args.db, args.rebuild)
+    seconds = time.perf_counter() - started
+    with contextlib.closing(kpi_engine.connect_db(args.db, "default")) as conn:
+        rows = conn.execute("SELECT COUNT(*) FROM FactSales").fetchone()[0]
+    print(f"Added {added:,} invoice lines in {seconds * 1000:.0f} ms -> {rows:,} fact rows")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,290 @@
+"""Micro-batch ingestion of an append-only JSONL/CSV feed.
+
+    python kpi_ingest.py feed.jsonl                          # ingest what is there, then exit
+    python kpi_ingest.py feed.jsonl --follow                 # keep tailing the feed
+    python kpi_ingest.py lines.csv --type invoice_line       # CSV feeds hold one record type
+
+A JSONL feed carries one record per line, e.g. ``{"type": "invoice_line",
+"InvoiceLineID": 70001, ...}``, keyed by the target table's column names. A
+CSV feed starts with a header row of column names; its fields must not
+contain newlines. Missing columns are stored as NULL.
+
+Every micro-batch of ``--batch`` records is one transaction: the feed rows
+go in through prepared statements, the rows init_db derives from them follow
+(issue/receipt stock transactions, their stock movements and Transactions
+entries, invoice and purchase order totals), new invoice lines are folded
+into SalesCube and appended to FactSales, new lines and stock transactions into the approximate-mode
+day sketches, the month-end stock balances are brought forward, and the
+feed's byte offset is checkpointed in IngestCheckpoints. A crash loses only the open batch, which the next run
+re-reads from the checkpoint; only complete lines are consumed.
+
+The feed must be in dependency order (an invoice or purchase order before
+its lines) with increasing invoice line ids, as the cube and the sales
+fact fold in lines above their watermarks. Stock transaction ids are always assigned on insert.
+Partitioned databases are not written to: ingest into the flat file and
+split it again. A database without the derived measure columns is migrated
+(see kpi_schema) before the first batch.
+"""
+import argparse
+import contextlib
+import csv
+import json
+import pathlib
+import time
+
+import kpi_approx
+import kpi_cube
+import kpi_engine
+import kpi_fact
+import kpi_schema
+import kpi_stock
+
+# Feed record type -> (table, columns accepted from the feed); applied in this order
+RECORD_TYPES = {
+    "invoice": ("SalesInvoices", ["InvoiceID", "CustomerID", "InvoiceDate"]),
+    "purchase_order": ("PurchaseOrders", [
+        "PurchaseOrderID", "SupplierID", "OrderDate", "DeliveryMethodID", "ContactPersonID",
+        "AuthorisedPersonID", "ExpectedDeliveryDate"]),
+    "invoice_line": ("SalesInvoiceLines", [
+        "InvoiceLineID", "InvoiceID", "StockItemID", "Quantity", "UnitPrice", "ExtendedPrice",
+        "TaxAmount", "TaxRate", "TaxRateID", "LineProfit", "LastEditedWhen"]),
+    "po_line": ("PurchaseOrderLines", [
+        "PurchaseOrderLineID", "PurchaseOrderID", "StockItemID", "OrderedOuters", "ReceivedOuters",
+        "ExpectedUnitPricePerOuter", "LastReceiptDate"]),
+    "stock_txn": ("StockItemTransactions", [
+        "StockItemID", "TransactionTypeID", "CustomerID", "SupplierID", "Quantity", "TransactionOccurredWhen"]),
+}
+# Types whose keys (their first column) are noted per batch, to derive rows from exactly the batch's rows
+BATCH_KINDS = {"invoice", "purchase_order", "invoice_line", "po_line"}
+
+INGEST_DDL = [
+    """
+    CREATE TABLE IF NOT EXISTS IngestCheckpoints (
+        Feed TEXT PRIMARY KEY,
+        Offset INTEGER NOT NULL,
+        Records INTEGER NOT NULL,
+        UpdatedAt TEXT NOT NULL
+    )
+    """,
+    # Totals are maintained per batch, so their Transactions rows must be found by key
+    "CREATE INDEX IF NOT EXISTS idx_Transactions_InvoiceID ON Transactions(InvoiceID)",
+    "CREATE INDEX IF NOT EXISTS idx_Transactions_PurchaseOrderID ON Transactions(PurchaseOrderID)",
+]
+
+_TRANSACTION_COLUMNS = ("TransactionDate, TransactionTypeID, CustomerID, SupplierID, InvoiceID, "
+                        "PurchaseOrderID, PaymentMethodID, Amount, IsFinalized")
+_STOCK_COLUMNS = "StockItemID, TransactionTypeID, CustomerID, SupplierID, Quantity, TransactionOccurredWhen"
+
+# Rows derived from a batch, as init_db derives them; ? is the StockItemTransactionID high-water mark
+DERIVE_SQL = [
+    # Sales and purchase Transactions, totalled by the line statements below
+    f"""
+    INSERT INTO Transactions ({_TRANSACTION_COLUMNS})
+    SELECT inv.InvoiceDate, 1, inv.CustomerID, NULL, inv.InvoiceID, NULL, 1, 0, 1
+    FROM temp.IngestBatch b JOIN SalesInvoices inv ON inv.InvoiceID = b.ID
+    WHERE b.Kind = 'invoice'
+    """,
+    f"""
+    INSERT INTO Transactions ({_TRANSACTION_COLUMNS})
+    SELECT po.OrderDate, 2, NULL, po.SupplierID, NULL, po.PurchaseOrderID, 1, 0, 1
+    FROM temp.IngestBatch b JOIN PurchaseOrders po ON po.PurchaseOrderID = b.ID
+    WHERE b.Kind = 'purchase_order'
+    """,
+    """
+    UPDATE Transactions SET Amount = Amount + batch.Total
+    FROM (
+        SELECT il.InvoiceID, SUM(il.ExtendedPrice) AS Total
+        FROM temp.IngestBatch b JOIN SalesInvoiceLines il ON il.InvoiceLineID = b.ID
+        WHERE b.Kind = 'invoice_line'
+        GROUP BY il.InvoiceID
+    ) AS batch
+    WHERE Transactions.TransactionTypeID = 1 AND Transactions.InvoiceID = batch.InvoiceID
+    """,
+    """
+    UPDATE Transactions SET Amount = Amount + batch.Total
+    FROM (
+        SELECT pol.PurchaseOrderID, SUM(pol.PurchaseValue) AS Total
+        FROM temp.IngestBatch b JOIN PurchaseOrderLines pol ON pol.PurchaseOrderLineID = b.ID
+        WHERE b.Kind = 'po_line'
+        GROUP BY pol.PurchaseOrderID
+    ) AS batch
+    WHERE Transactions.TransactionTypeID = 2 AND Transactions.PurchaseOrderID = batch.PurchaseOrderID
+    """,
+    # Stock issues of invoice lines and receipts of received purchase order lines
+    f"""
+    INSERT INTO StockItemTransactions ({_STOCK_COLUMNS})
+    SELECT il.StockItemID, 10, inv.CustomerID, NULL, -il.Quantity, il.LastEditedWhen
+    FROM temp.IngestBatch b
+    JOIN SalesInvoiceLines il ON il.InvoiceLineID = b.ID
+    LEFT JOIN SalesInvoices inv ON inv.InvoiceID = il.InvoiceID
+    WHERE b.Kind = 'invoice_line'
+    ORDER BY il.InvoiceLineID
+    """,
+    f"""
+    INSERT INTO StockItemTransactions ({_STOCK_COLUMNS})
+    SELECT pol.StockItemID, 11, NULL, po.SupplierID, pol.ReceivedOuters, pol.LastReceiptDate
+    FROM temp.IngestBatch b
+    JOIN PurchaseOrderLines pol ON pol.PurchaseOrderLineID = b.ID
+    LEFT JOIN PurchaseOrders po ON po.PurchaseOrderID = pol.PurchaseOrderID
+    WHERE b.Kind = 'po_line' AND pol.ReceivedOuters IS NOT NULL AND pol.LastReceiptDate IS NOT NULL
+    ORDER BY pol.PurchaseOrderLineID
+    """,
+    # Movements and valued Transactions of every stock transaction of the batch
+    """
+    INSERT INTO StockMovements (StockItemID, MovementDate, Quantity, MovementTypeID, CustomerID, SupplierID, Notes)
+    SELECT StockItemID, TransactionOccurredWhen, ABS(Quantity), CASE WHEN Quantity > 0 THEN 1 ELSE 2 END,
+           CustomerID, SupplierID, 'Stock movement for item ' || StockItemID
+    FROM StockItemTransactions
+    WHERE StockItemTransactionID > ?
+    ORDER BY StockItemTransactionID
+    """,
+    f"""
+    INSERT INTO Transactions ({_TRANSACTION_COLUMNS})
+    SELECT sit.TransactionOccurredWhen, sit.TransactionTypeID, sit.CustomerID, sit.SupplierID, NULL, NULL, 1,
+           ABS(sit.Quantity) * COALESCE(si.UnitPrice, 0), 1
+    FROM StockItemTransactions sit
+    LEFT JOIN WarehouseStockItem si ON si.StockItemID = sit.StockItemID
+    WHERE sit.StockItemTransactionID > ?
+    ORDER BY sit.StockItemTransactionID
+    """,
+]
+
+
+def _insert_sql(record_type):
+    table, columns = RECORD_TYPES[record_type]
+    return f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+
+
+def read_feed(path, offset, limit, record_type=None):
+    """Up to ``limit`` complete records after byte ``offset``; returns ([(type, row)], new offset).
+
+    Without ``record_type`` the feed is JSONL; with it, CSV rows of that type.
+    """
+    records = []
+    with open(path, "rb") as feed:
+        header = None
+        if record_type is not None:
+            first = feed.readline()
+            if not first.endswith(b"\n"):
+                return records, offset
+            header = next(csv.reader([first.decode()]))
+            offset = max(offset, len(first))
+        if offset > feed.seek(0, 2):
+            raise ValueError(f"{path} is shorter than its checkpoint ({offset:,} bytes); was it rotated?")
+        feed.seek(offset)
+        while len(records) < limit:
+            line = feed.readline()
+            if not line.endswith(b"\n"):  # EOF, or a line still being written
+                break
+            offset += len(line)
+            if not line.strip():
+                continue
+            if header is None:
+                record = json.loads(line)
+                kind = record.get("type")
+            else:
+                record = {name: value if value != "" else None
+                          for name, value in zip(header, next(csv.reader([line.decode()])))}
+                kind = record_type
+            if kind not in RECORD_TYPES:
+                raise ValueError(f"Unknown record type {kind!r} at byte {offset - len(line):,} of {path}")
+            records.append((kind, tuple(record.get(column) for column in RECORD_TYPES[kind][1])))
+    return records, offset
+
+
+def apply_batch(conn, feed_key, records, offset):
+    """Insert one micro-batch with its derived rows and checkpoint, in a single transaction.
+
+    Returns the number of rows written, derived ones included.
+    """
+    changes = conn.total_changes
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("DELETE FROM temp.IngestBatch")
+        stock_mark = conn.execute("SELECT COALESCE(MAX(StockItemTransactionID), 0) FROM StockItemTransactions"
+                                  ).fetchone()[0]
+        for kind in RECORD_TYPES:
+            rows = [row for record_kind, row in records if record_kind == kind]
+            if not rows:
+                continue
+            conn.executemany(_insert_sql(kind), rows)
+            if kind in BATCH_KINDS:
+                conn.executemany("INSERT OR IGNORE INTO temp.IngestBatch VALUES (?, ?)",
+                                 [(kind, row[0]) for row in rows])
+        for sql in DERIVE_SQL:
+            conn.execute(sql, (stock_mark,) if "?" in sql else ())
+        kpi_cube.merge_new_lines(conn)
+        kpi_fact.merge_new_lines(conn)
+        kpi_approx.merge_new_rows(conn)
+        kpi_stock.merge_new_transactions(conn)
+        conn.execute(
+            "INSERT INTO IngestCheckpoints VALUES (?, ?, ?, datetime('now')) "
+            "ON CONFLICT (Feed) DO UPDATE SET Offset = excluded.Offset, "
+            "Records = Records + excluded.Records, UpdatedAt = excluded.UpdatedAt",
+            (feed_key, offset, len(records)))
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    return conn.total_changes - changes
+
+
+def ingest(feed, db_path=None, record_type=None, batch=5000, follow=False, poll=1.0, report=print):
+    """Ingest a feed from its checkpoint onwards; returns (records, rows written, seconds)."""
+    db_path = db_path or kpi_engine.DB_PATH
+    if kpi_engine.PARTITIONS is not None and pathlib.Path(db_path).resolve() == kpi_engine.PARTITIONS.core.resolve():
+        raise ValueError("Ingest into the unpartitioned database and split it again")
+    feed_key = str(pathlib.Path(feed).resolve())
+    records_done = rows_done = 0
+    busy = 0.0
+    with contextlib.closing(kpi_engine.connect_db(db_path, "default")) as conn:
+        conn.isolation_level = None
+        kpi_schema.migrate_schema(conn)
+        for ddl in INGEST_DDL + kpi_cube.CUBE_DDL + kpi_fact.FACT_DDL + kpi_approx.SKETCH_DDL + kpi_stock.BALANCE_DDL:
+            conn.execute(ddl)
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS IngestBatch (Kind TEXT, ID INTEGER, PRIMARY KEY (Kind, ID))")
+        row = conn.execute("SELECT Offset FROM IngestCheckpoints WHERE Feed = ?", (feed_key,)).fetchone()
+        offset = row[0] if row else 0
+        while True:
+            started = time.perf_counter()
+            records, end = read_feed(feed, offset, batch, record_type)
+            if not records:
+                if end != offset:  # only blank lines: still move the checkpoint past them
+                    apply_batch(conn, feed_key, records, end)
+                    offset = end
+                if not follow:
+                    break
+                time.sleep(poll)
+                continue
+            rows = apply_batch(conn, feed_key, records, end)
+            seconds = time.perf_counter() - started
+            offset, busy = end, busy + seconds
+            records_done, rows_done = records_done + len(records), rows_done + rows
+            if follow:
+                report(f"  {len(records):,} records -> {rows:,} rows in {seconds * 1000:.0f} ms "
+                       f"(offset {offset:,})")
+    return records_done, rows_done, busy
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("feed", help="JSONL feed, or CSV feed with --type")
+    parser.add_argument("--type", choices=list(RECORD_TYPES), help="record type of a CSV feed")
+    parser.add_argument("--db", default=kpi_engine.DB_PATH)
+    parser.add_argument("--batch", type=int, default=5000, help="records per transaction")
+    parser.add_argument("--follow", action="store_true", help="keep polling the feed for new records")
+    parser.add_argument("--poll", type=float, default=1.0, help="seconds between polls with --follow")
+    args = parser.parse_args()
+    try:
+        records, rows, seconds = ingest(args.feed, args.db, args.type, args.batch, args.follow, args.poll)
+    except KeyboardInterrupt:
+        return
+    if records:
+        print(f"Ingested {records:,} records ({rows:,} rows with derived ones) in {seconds:.2f} s: "
+              f"{records / seconds:,.0f} records/s, {rows / seconds:,.0f} rows/s")
+    else:
+        print("No new records")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+"""Multi-session load test of the dashboard.
+
+Build a scaled database first, e.g. ``python init_db.py --db bench.db --scale 200``, then:
+
+    python kpi_loadtest.py --db bench.db --sessions 8 --actions 20
+    python kpi_loadtest.py --db bench.db --sessions 16 --processes 2 --json load.json
+
+Every simulated session is a headless Streamlit AppTest of app.py running in
+its own thread, so the sessions of one process share its caches, KPI pool and
+database connections as the browser sessions of one dashboard process do.
+A session opens the page, then makes ``--actions`` random interactions with
+think time between them: moving the date window (to month boundaries, so
+windows recur across sessions as real users' do), switching the comparison
+mode, or working a tab: paging, sorting or resizing one of its tables, or
+changing the drill-down breakdown. Streamlit switches tabs in the browser,
+so a tab visit costs the server only the interactions made inside it.
+
+Page-ready latency runs from an interaction to the end of the script run
+that has filled every section. Per process the report gives throughput,
+latency percentiles, CPU (in cores), peak resident memory and the result
+cache hit rate, size and evictions; with ``--processes`` the sessions are split across that many
+fresh processes, each one a dashboard replica.
+"""
+import argparse
+import concurrent.futures
+import datetime as dt
+import json
+import multiprocessing
+import pathlib
+import random
+import threading
+import time
+
+import numpy as np
+from streamlit.testing.v1 import AppTest
+
+import kpi_cube
+import kpi_engine
+
+APP = str(pathlib.Path(__file__).with_name("app.py"))
+MIN_DATE, MAX_DATE = dt.date(2013, 1, 1), dt.date(2016, 12, 31)
+# Paginated tables a tab interaction can work, and the drill-down breakdowns
+TABLE_KPIS = ["avg_margin_with_group", "supplier_perf", "sales_by_group", "cust_seg", "txn_dist"]
+BREAKDOWNS = list(kpi_cube.FILTER_DIMENSIONS) + ["StockItemID"]
+# Relative frequency of each interaction
+ACTION_WEIGHTS = {"window": 4, "compare": 1, "page": 2, "sort": 1, "rows": 1, "breakdown": 1}
+
+
+def _month_starts():
+    months, day = [], MIN_DATE
+    while day <= MAX_DATE:
+        months.append(day)
+        day = (day.replace(day=28) + dt.timedelta(days=4)).replace(day=1)
+    return months
+
+
+MONTHS = _month_starts()
+
+
+def _widget(widgets, label):
+    return next(widget for widget in widgets if widget.label == label)
+
+
+class Session:
+    """One simulated user: an AppTest of the dashboard and the page-ready latency of each of its runs."""
+
+    def __init__(self, rng, timeout):
+        self.rng = rng
+        self.at = AppTest.from_file(APP, default_timeout=timeout)
+        self.latencies = []
+        self.errors = 0
+
+    def run(self):
+        started = time.perf_counter()
+        try:
+            self.at.run()
+        except Exception:  # a run that timed out or crashed the script
+            self.errors += 1
+            return
+        self.latencies.append(time.perf_counter() - started)
+        self.errors += bool(len(self.at.exception) or len(self.at.error))
+
+    def window(self):
+        first, last = sorted(self.rng.sample(range(len(MONTHS)), 2))
+        end = MONTHS[last + 1] - dt.timedelta(days=1) if last + 1 < len(MONTHS) else MAX_DATE
+        self.at.sidebar.date_input[0].set_value(MONTHS[first])
+        self.at.sidebar.date_input[1].set_value(end)
+
+    def compare(self):
+        _widget(self.at.sidebar.selectbox, "Compare to").set_value(self.rng.choice(kpi_engine.COMPARE_MODES))
+
+    def page(self):
+        button = self.at.button(key=f"{self.rng.choice(TABLE_KPIS)}_next")
+        if not button.disabled:
+            button.click()
+
+    def sort(self):
+        sort = self.at.selectbox(key=f"{self.rng.choice(TABLE_KPIS)}_sort")
+        sort.set_value(self.rng.choice(sort.options))
+
+    def rows(self):
+        self.at.selectbox(key=f"{self.rng.choice(TABLE_KPIS)}_page_size").set_value(self.rng.choice([25, 50, 100]))
+
+    def breakdown(self):
+        _widget(self.at.radio, "Break down by").set_value(self.rng.choice(BREAKDOWNS))
+
+    def act(self):
+        action = self.rng.choices(list(ACTION_WEIGHTS), list(ACTION_WEIGHTS.values()))[0]
+        try:
+            getattr(self, action)()
+        except (KeyError, StopIteration, IndexError):  # the widget is not on the page (empty or errored section)
+            self.errors += 1
+            return
+        self.run()
+
+
+def _peak_rss():
+    memory = kpi_engine.process_memory()
+    return memory["rss"] or memory["peak_rss"]
+
+
+def run_process(index, sessions, actions, think, seed, db_path=None, timeout=300):
+    """Drive ``sessions`` concurrent sessions in this process; returns its measurements."""
+    if db_path:
+        kpi_engine.use_database(db_path)
+    # Startup work (summary refreshes, the prefix index) is not part of any user's page load
+    Session(random.Random(seed), timeout).run()
+
+    rng = random.Random(seed * 1000 + index)
+    users = [Session(random.Random(rng.random()), timeout) for _ in range(sessions)]
+    peak = [_peak_rss()]
+    done = threading.Event()
+
+    def sample_memory():
+        while not done.wait(0.25):
+            peak.append(_peak_rss())
+
+    def drive(user):
+        user.run()
+        for _ in range(actions):
+            if think:
+                time.sleep(user.rng.expovariate(1 / think))
+            user.act()
+
+    stats_before, cpu_before = kpi_engine.RESULT_CACHE.stats(), time.process_time()
+    monitor = threading.Thread(target=sample_memory, daemon=True)
+    monitor.start()
+    started = time.perf_counter()
+    threads = [threading.Thread(target=drive, args=(user,), name=f"session-{i}") for i, user in enumerate(users)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+    done.set()
+    stats = kpi_engine.RESULT_CACHE.stats()
+    hits, misses, evictions = (stats[k] - stats_before[k] for k in ("hits", "misses", "evictions"))
+    peak = [rss for rss in peak + [_peak_rss()] if rss is not None]
+    return {
+        "process": index,
+        "sessions": sessions,
+        "latencies": [latency for user in users for latency in user.latencies],
+        "errors": sum(user.errors for user in users),
+        "seconds": wall,
+        "cpu_cores": (time.process_time() - cpu_before) / wall,
+        "peak_rss": max(peak) if peak else None,
+        "cache_hits": hits,
+        "cache_misses": misses,
+        "cache_bytes": stats["bytes"],
+        "evictions": evictions,
+    }
+
+
+def summarize(result):
+    """Throughput, latency percentiles and resource figures of one process (or of all, combined)."""
+    latencies = np.asarray(result["latencies"]) * 1000
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) if len(latencies) else (np.nan,) * 3
+    lookups = result["cache_hits"] + result["cache_misses"]
+    return {
+        "sessions": result["sessions"],
+        "pages": len(latencies),
+        "errors": result["errors"],
+        "pages_per_s": len(latencies) / result["seconds"],
+        "p50_ms": p50,
+        "p95_ms": p95,
+        "p99_ms": p99,
+        "cpu_cores": result["cpu_cores"],
+        "peak_rss_mib": result["peak_rss"] / 2 ** 20 if result["peak_rss"] else np.nan,
+        "cache_hit_rate": result["cache_hits"] / lookups if lookups else np.nan,
+        "cache_mib": result["cache_bytes"] / 2 ** 20,
+        "evictions": result["evictions"],
+    }
+
+
+def combine(results):
+    """All processes as one deployment: throughput adds up, latencies pool, resources add up."""
+    return {
+        "sessions": sum(r["sessions"] for r in results),
+        "latencies": [latency for r in results for latency in r["latencies"]],
+        "errors": sum(r["errors"] for r in results),
+        # Processes run side by side: the slowest one bounds the run
+        "seconds": max(r["seconds"] for r in results),
+        "cpu_cores": sum(r["cpu_cores"] for r in results),
+        "peak_rss": sum(r["peak_rss"] or 0 for r in results),
+        "cache_hits": sum(r["cache_hits"] for r in results),
+        "cache_misses": sum(r["cache_misses"] for r in results),
+        "cache_bytes": sum(r["cache_bytes"] for r in results),
+        "evictions": sum(r["evictions"] for r in results),
+    }
+
+
+def load_test(sessions=8, actions=20, processes=1, think=0.5, seed=0, db_path=None, timeout=300):
+    """Run the load test; returns {"processes": [summary, ...], "total": summary}."""
+    split = [sessions // processes + (i < sessions % processes) for i in range(processes)]
+    if processes == 1:
+        results = [run_process(0, sessions, actions, think, seed, db_path, timeout)]
+    else:
+        # Fresh interpreters, so every replica starts with cold caches like a new dashboard process
+        context = multiprocessing.get_context("spawn")
+        with concurrent.futures.ProcessPoolExecutor(processes, mp_context=context) as pool:
+            results = list(pool.map(run_process, range(processes), split, [actions] * processes,
+                                    [think] * processes, [seed] * processes, [db_path] * processes,
+                                    [timeout] * processes))
+    return {"processes": [summarize(r) for r in results], "total": summarize(combine(results))}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", default=kpi_engine.DB_PATH, help="database file the dashboard reads")
+    parser.add_argument("--sessions", type=int, default=8, help="concurrent simulated users")
+    parser.add_argument("--actions", type=int, default=20, help="interactions per session after the first page")
+    parser.add_argument("--processes", type=int, default=1, help="dashboard processes to spread the sessions over")
+    parser.add_argument("--think", type=float, default=0.5, help="mean think time between interactions (s)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--timeout", type=float, default=300, help="longest a page may take before it errors (s)")
+    parser.add_argument("--json", help="also write the report to this file")
+    args = parser.parse_args()
+    print(f"{args.sessions} sessions x {args.actions} actions on {args.db}, {args.processes} process(es)"
+          + ("" if kpi_engine.psutil is not None else " (psutil not installed: memory is the getrusage peak)"))
+    report = load_test(args.sessions, args.actions, args.processes, args.think, args.seed, args.db, args.timeout)
+
+    print(f"{'process':>8} {'sessions':>8} {'pages':>6} {'errors':>6} {'pages/s':>8} {'p50 ms':>8} "
+          f"{'p95 ms':>8} {'p99 ms':>8} {'CPU cores':>9} {'peak MiB':>9} {'cache hits':>10} {'cache MiB':>9} "
+          f"{'evicted':>7}")
+    rows = list(enumerate(report["processes"])) + ([("total", report["total"])] if args.processes > 1 else [])
+    for label, row in rows:
+        print(f"{label:>8} {row['sessions']:>8} {row['pages']:>6} {row['errors']:>6} {row['pages_per_s']:>8.2f} "
+              f"{row['p50_ms']:>8.0f} {row['p95_ms']:>8.0f} {row['p99_ms']:>8.0f} {row['cpu_cores']:>9.2f} "
+              f"{row['peak_rss_mib']:>9.0f} {row['cache_hit_rate']:>10.1%} {row['cache_mib']:>9.1f} "
+              f"{row['evictions']:>7}")
+    if args.json:
+        pathlib.Path(args.json).write_text(json.dumps(report, indent=2, default=float))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+"""Year-partitioned fact tables, ATTACHed and routed per query.
+
+    python kpi_partitions.py split --db mydb.db --out partitions --freeze-before 2016
+    python kpi_partitions.py freeze --out partitions --before 2017
+    KPI_PARTITION_DIR=partitions streamlit run app.py
+
+``split`` copies the database to ``<out>/core.db`` with the fact tables
+emptied, and moves their rows into one ``facts_<year>.db`` per year (rows
+without a date go to ``facts_undated.db``). Each partition keeps the table's
+own indexes, so a window only searches the B-trees of the years it covers.
+The source is migrated first (see kpi_schema), so every partition carries
+the derived measure columns, their covering indexes and their triggers;
+``freeze`` migrates a partition's file before it becomes read-only.
+
+On a partitioned connection every fact table name resolves to a TEMP view
+(temp objects shadow ``main``) that UNION ALLs the table across the attached
+partitions. ``route`` narrows those views to the partitions a query's window
+overlaps; SQLite pushes the window predicate into each arm and aggregates
+over the union itself, so the KPI SQL runs unchanged. Frozen partitions are
+attached ``immutable=1``: no locking and no change detection.
+"""
+import argparse
+import contextlib
+import json
+import os
+import pathlib
+import re
+import sqlite3
+
+import kpi_schema
+
+# Fact table -> the date column it is partitioned on
+FACT_TABLES = {
+    "SalesInvoiceLines": "LastEditedWhen",
+    "StockItemTransactions": "TransactionOccurredWhen",
+    "PurchaseOrderLines": "LastReceiptDate",
+    "StockMovements": "MovementDate",
+    "Transactions": "TransactionDate",
+}
+MANIFEST = "manifest.json"
+CORE_DB = "core.db"
+
+
+def _schema_name(year):
+    return f"p{year}" if year is not None else "pundated"
+
+
+class Partitions:
+    """The partition manifest of a directory and the routing of connections onto it."""
+
+    def __init__(self, directory):
+        self.directory = pathlib.Path(directory)
+        manifest = json.loads((self.directory / MANIFEST).read_text())
+        self.entries = manifest["partitions"]
+        self.core = self.directory / manifest["core"]
+
+    def mutable_files(self):
+        return [self.directory / entry["file"] for entry in self.entries if not entry["frozen"]]
+
+    def frozen_schemas(self):
+        """Schema names of the partitions attached immutable."""
+        return {_schema_name(entry["year"]) for entry in self.entries if entry["frozen"]}
+
+    def select(self, first_year=None, last_year=None):
+        """Partitions overlapping [first_year, last_year]; all of them, undated included, without bounds."""
+        if first_year is None:
+            return list(self.entries)
+        return [entry for entry in self.entries
+                if entry["year"] is not None and first_year <= entry["year"] <= last_year]
+
+    def attach(self, conn, uri_flags=None):
+        """ATTACH every partition to a connection opened with uri=True and route it to all of them."""
+        for entry in self.entries:
+            flags = "immutable=1" if entry["frozen"] else uri_flags
+            uri = (self.directory / entry["file"]).resolve().as_uri() + (f"?{flags}" if flags else "")
+            conn.execute("ATTACH DATABASE ? AS " + _schema_name(entry["year"]), (uri,))
+        self.route(conn)
+
+    def route(self, conn, first_year=None, last_year=None):
+        """Point the fact-table views of a connection at the partitions overlapping the years."""
+        schemas = [_schema_name(entry["year"]) for entry in self.select(first_year, last_year)] or ["main"]
+        current = dict(conn.execute("SELECT name, sql FROM sqlite_temp_master WHERE type = 'view'").fetchall())
+        wanted = {table: f"CREATE TEMP VIEW {table} AS " + " UNION ALL ".join(
+            f"SELECT * FROM {schema}.{table}" for schema in schemas) for table in FACT_TABLES}
+        stale = [sql for table, sql in wanted.items() if current.get(table) != sql]
+        if not stale:
+            return
+        # query_only also blocks temp-schema DDL; the files stay protected by their open flags
+        query_only = conn.execute("PRAGMA query_only").fetchone()[0]
+        conn.execute("PRAGMA query_only = 0")
+        try:
+            for sql in stale:
+                conn.execute(f"DROP VIEW IF EXISTS temp.{sql.split()[3]}")
+                conn.execute(sql)
+        finally:
+            conn.execute(f"PRAGMA query_only = {query_only}")
+
+    @contextlib.contextmanager
+    def routed(self, conn, first_year=None, last_year=None):
+        """Narrow a connection's routing for one query, restoring the all-partition routing afterwards."""
+        if first_year is None:
+            yield
+            return
+        self.route(conn, first_year, last_year)
+        try:
+            yield
+        finally:
+            self.route(conn)
+
+
+def _partition_ddl(conn, table, schema):
+    # CREATE TABLE/INDEX statements of a fact table, retargeted at another schema
+    rows = conn.execute(
+        "SELECT sql FROM main.sqlite_master WHERE tbl_name = ? AND type IN ('table', 'index') AND sql IS NOT NULL "
+        "ORDER BY type DESC",
+        (table,)).fetchall()
+    return [re.sub(r"^CREATE (TABLE|INDEX) (\w+)", rf"CREATE \1 {schema}.\2", sql) for (sql,) in rows]
+
+
+def split(db_path, out_dir, freeze_before=None):
+    """Write ``<out>/core.db`` and one fact file per year from an unpartitioned database."""
+    out = pathlib.Path(out_dir)
+    out.mkdir(parents=True, exist_ok=True)
+    core = out / CORE_DB
+    with contextlib.closing(sqlite3.connect(db_path)) as src, contextlib.closing(sqlite3.connect(core)) as dst:
+        src.backup(dst)
+
+    entries = []
+    with contextlib.closing(sqlite3.connect(core, isolation_level=None)) as conn:
+        kpi_schema.migrate_schema(conn)
+        years = set()
+        for table, column in FACT_TABLES.items():
+            years.update(row[0] for row in conn.execute(
+                f"SELECT DISTINCT CAST(substr({column}, 1, 4) AS INTEGER) FROM {table}"))
+        for year in sorted(years, key=lambda y: (y is None, y)):
+            file = out / f"facts_{year if year is not None else 'undated'}.db"
+            file.unlink(missing_ok=True)
+            conn.execute("ATTACH DATABASE ? AS part", (str(file),))
+            conn.execute("BEGIN")
+            for table, column in FACT_TABLES.items():
+                for ddl in _partition_ddl(conn, table, "part"):
+                    conn.execute(ddl)
+                if year is None:
+                    conn.execute(f"INSERT INTO part.{table} SELECT * FROM main.{table} WHERE {column} IS NULL")
+                else:
+                    conn.execute(f"INSERT INTO part.{table} SELECT * FROM main.{table} "
+                                 f"WHERE {column} >= ? AND {column} < ?", (str(year), str(year + 1)))
+                # After the copy, whose derived values are already computed
+                for ddl in kpi_schema.derived_triggers(table, "part") if table in kpi_schema.DERIVED_COLUMNS else []:
+                    conn.execute(ddl)
+            conn.execute("COMMIT")
+            conn.execute("DETACH DATABASE part")
+            entries.append({"year": year, "file": file.name,
+                            "frozen": bool(freeze_before and year is not None and year < freeze_before)})
+        for table in FACT_TABLES:
+            conn.execute(f"DELETE FROM {table}")
+        conn.execute("VACUUM")
+
+    (out / MANIFEST).write_text(json.dumps({"core": CORE_DB, "partitions": entries}, indent=2))
+    return entries
+
+
+def freeze(out_dir, before):
+    """Mark every dated partition older than ``before`` frozen (opened immutable from now on).
+
+    Each partition is migrated first: once frozen its file is never written.
+    """
+    path = pathlib.Path(out_dir) / MANIFEST
+    manifest = json.loads(path.read_text())
+    for entry in manifest["partitions"]:
+        if entry["year"] is not None and entry["year"] < before and not entry["frozen"]:
+            with contextlib.closing(sqlite3.connect(pathlib.Path(out_dir) / entry["file"])) as conn:
+                kpi_schema.migrate_schema(conn)
+            entry["frozen"] = True
+    path.write_text(json.dumps(manifest, indent=2))
+    return manifest["partitions"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    split_cmd = commands.add_parser("split", help="partition a database by year")
+    split_cmd.add_argument("--db", default="mydb.db")
+    split_cmd.add_argument("--out", required=True, help="directory for core.db and the fact files")
+    split_cmd.add_argument("--freeze-before", type=int, help="freeze partitions of years before this one")
+    freeze_cmd = commands.add_parser("freeze", help="freeze old partitions")
+    freeze_cmd.add_argument("--out", required=True)
+    freeze_cmd.add_argument("--before", type=int, required=True)
+    args = parser.parse_args()
+
+    if args.command == "split":
+        entries = split(args.db, args.out, args.freeze_before)
+    else:
+        entries = freeze(args.out, args.before)
+    for entry in entries:
+        size = os.path.getsize(pathlib.Path(args.out) / entry["file"])
+        print(f"  {entry['file']:<22} {size / 1024:>10,.0f} KiB  {'frozen' if entry['frozen'] else 'mutable'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""Profile of one dashboard rerun: section timings plus cProfile data.
+
+Open the dashboard with ``?profile=1``, or press "Profile this page" in the
+sidebar's Diagnostics. Both work for admins only: pages opened with
+``?admin=<token>`` when ``KPI_ADMIN_TOKEN`` is set, nobody when it is not,
+every session with ``KPI_ADMIN_TOKEN=*`` (local development).
+The next script run is profiled end to end and its report appears at the
+bottom of the page:
+
+* a table of seconds per (section, step). Engine steps are keyed by query
+  (``sql`` runs a query to its last row, ``to DataFrame`` is ``pd.read_sql``'s
+  frame building, ``names`` the dimension lookups) or by KPI (``load`` on the
+  KPI pool, ``prefix index``, ``compact``); page steps by section (``wait``
+  for a KPI, ``render`` the whole section, within it ``figure`` and ``table``).
+  Steps nest, so a section's ``render`` includes its ``figure`` and ``table``;
+* the merged cProfile of the script thread and every KPI load the run
+  started, downloadable as a ``.prof`` file (pstats format) for
+  ``python -m pstats``, snakeviz or gprof2dot.
+
+Time a KPI spends waiting on a load another session started shows up as its
+``load`` or ``wait`` with no ``sql`` under it.
+"""
+import contextlib
+import cProfile
+import datetime as dt
+import marshal
+import pstats
+import threading
+import time
+
+import pandas as pd
+
+
+class RunProfile:
+    """Section timings and cProfile data of one script run, across the script thread and the KPI pool."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._timings = []
+        self._profilers = []
+        self._script = None
+        self._thread = None
+        self.started_at = dt.datetime.now()
+        self.started = None
+        self.seconds = None
+        self.data = b""
+
+    @property
+    def active(self):
+        return self.started is not None and self.seconds is None
+
+    def start(self):
+        """Start timing and cProfile the calling (script) thread until ``stop()``."""
+        self._thread = threading.get_ident()
+        self.started = time.perf_counter()
+        self._script = cProfile.Profile()
+        self._script.enable()
+
+    def stop(self):
+        """Finish the profile; idempotent. Steps recorded afterwards (e.g. by live fragments) are ignored."""
+        if not self.active:
+            return
+        self._script.disable()
+        self.seconds = time.perf_counter() - self.started
+        with self._lock:
+            profilers = [self._script] + self._profilers
+        stats = pstats.Stats(profilers[0])
+        for profiler in profilers[1:]:
+            stats.add(profiler)
+        # The same marshalled dict pstats.Stats.dump_stats writes
+        self.data = marshal.dumps(stats.stats)
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def record(self, section, step, seconds):
+        if not self.active:
+            return
+        where = "script" if threading.get_ident() == self._thread else threading.current_thread().name
+        with self._lock:
+            self._timings.append((section, step, seconds, where))
+
+    @contextlib.contextmanager
+    def step(self, section, step):
+        """Time a block as ``step`` of ``section``."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(section, step, time.perf_counter() - started)
+
+    @contextlib.contextmanager
+    def capture(self):
+        """cProfile the calling thread (a KPI pool worker) for the duration of the block."""
+        if not self.active:
+            yield
+            return
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            with self._lock:
+                self._profilers.append(profiler)
+
+    def sections(self):
+        """Seconds and calls per (section, step), slowest first."""
+        with self._lock:
+            timings = pd.DataFrame(self._timings, columns=["Section", "Step", "Seconds", "Thread"])
+        return (timings.groupby(["Section", "Step"], sort=False)
+                .agg(Seconds=("Seconds", "sum"), Calls=("Seconds", "size"), Thread=("Thread", "first"))
+                .reset_index()
+                .sort_values("Seconds", ascending=False, ignore_index=True))
@@ -0,0 +1,119 @@
+"""Batch KPI packs: every date-dependent KPI for many windows in one sweep.
+
+    python kpi_report.py --every month --from 2013-01-01 --to 2016-12-31 --out pack.xlsx
+    python kpi_report.py --every quarter --out pack_dir --format parquet
+    python kpi_report.py --windows 2014-01-01:2014-06-30 2015-01-01:2015-06-30 --out h1.xlsx
+
+The fact tables are scanned once over the union of all windows into per-day
+rollups (see kpi_rollups). Each window's rows are located by binary search,
+then every KPI is aggregated once for all windows together, instead of the
+queries being re-run per window.
+"""
+import argparse
+import datetime as dt
+import pathlib
+import time
+
+import pandas as pd
+
+import kpi_engine
+import kpi_rollups
+
+
+def _month_end(day):
+    following = (day.replace(day=1) + dt.timedelta(days=32)).replace(day=1)
+    return following - dt.timedelta(days=1)
+
+
+def make_windows(rule, start, end):
+    """(start, end) date pairs for a rule: month, quarter or rolling90 (one window per month end).
+
+    Calendar windows are clipped to [start, end]; rolling windows always span
+    90 days, so those not wholly inside the range are left out.
+    """
+    windows, cursor = [], start.replace(day=1)
+    while cursor <= end:
+        if rule == "month":
+            windows.append((cursor, _month_end(cursor)))
+            cursor = _month_end(cursor) + dt.timedelta(days=1)
+        elif rule == "quarter":
+            cursor = cursor.replace(month=(cursor.month - 1) // 3 * 3 + 1)
+            quarter_end = _month_end(cursor.replace(month=cursor.month + 2))
+            windows.append((cursor, quarter_end))
+            cursor = quarter_end + dt.timedelta(days=1)
+        elif rule == "rolling90":
+            month_end = _month_end(cursor)
+            windows.append((month_end - dt.timedelta(days=89), month_end))
+            cursor = month_end + dt.timedelta(days=1)
+        else:
+            raise ValueError(f"Unknown window rule {rule!r}")
+    if rule == "rolling90":
+        return [(s, e) for s, e in windows if start <= s and e <= end]
+    return [(max(s, start), min(e, end)) for s, e in windows]
+
+
+def parse_window(text):
+    start, _, end = text.partition(":")
+    return dt.date.fromisoformat(start), dt.date.fromisoformat(end)
+
+
+def build_pack(windows):
+    """Compute every rollup KPI for every window; returns ({kpi: frame}, timings)."""
+    started = time.perf_counter()
+    daily = kpi_rollups.load_daily(*kpi_engine.window_bounds(min(s for s, _ in windows), max(e for _, e in windows)))
+    scanned = time.perf_counter()
+
+    bounds = [kpi_engine.window_bounds(start, end) for start, end in windows]
+    window_start = pd.Series([pd.Timestamp(start) for start, _ in windows])
+    window_end = pd.Series([pd.Timestamp(end) for _, end in windows])
+    pack = {}
+    for name, frame in kpi_rollups.multi_window_kpis(daily, bounds).items():
+        frame.insert(0, "WindowEnd", window_end.iloc[frame["Window"]].to_numpy())
+        frame.insert(0, "WindowStart", window_start.iloc[frame["Window"]].to_numpy())
+        pack[name] = frame.drop(columns="Window")
+    return pack, {"scan": scanned - started, "windows": time.perf_counter() - scanned}
+
+
+def write_pack(pack, out, fmt):
+    out = pathlib.Path(out)
+    if fmt == "xlsx":
+        with pd.ExcelWriter(out, engine="openpyxl") as writer:
+            for name, frame in pack.items():
+                frame.to_excel(writer, sheet_name=name[:31], index=False)
+        return
+    out.mkdir(parents=True, exist_ok=True)
+    for name, frame in pack.items():
+        if fmt == "parquet":
+            frame.to_parquet(out / f"{name}.parquet", index=False)
+        else:
+            frame.to_csv(out / f"{name}.csv", index=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    rule = parser.add_mutually_exclusive_group(required=True)
+    rule.add_argument("--every", choices=["month", "quarter", "rolling90"])
+    rule.add_argument("--windows", nargs="+", type=parse_window, metavar="START:END")
+    parser.add_argument("--from", dest="start", type=dt.date.fromisoformat, default=dt.date(2013, 1, 1))
+    parser.add_argument("--to", dest="end", type=dt.date.fromisoformat, default=dt.date(2016, 12, 31))
+    parser.add_argument("--out", required=True, help="workbook (.xlsx) or output directory")
+    parser.add_argument("--format", choices=["xlsx", "parquet", "csv"],
+                        help="defaults to xlsx for .xlsx outputs, parquet otherwise")
+    parser.add_argument("--db", default=kpi_engine.DB_PATH)
+    args = parser.parse_args()
+
+    kpi_engine.use_database(args.db)
+    windows = args.windows or make_windows(args.every, args.start, args.end)
+    if not windows:
+        parser.error(f"no {args.every} window fits between --from {args.start} and --to {args.end}")
+    fmt = args.format or ("xlsx" if args.out.endswith(".xlsx") else "parquet")
+    pack, timings = build_pack(windows)
+    write_pack(pack, args.out, fmt)
+    total = timings["scan"] + timings["windows"]
+    print(f"{len(windows)} windows x {len(pack)} KPIs -> {args.out} ({fmt})")
+    print(f"  scan {timings['scan'] * 1000:.0f} ms, windows {timings['windows'] * 1000:.0f} ms, "
+          f"{len(windows) / total:,.1f} windows/s overall")
+
+
+if __name__ == "__main__":
+    main()
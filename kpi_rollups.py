@@ -0,0 +1,200 @@
+"""Per-day rollups of the fact tables and window KPIs computed from them.
+
+One scan per fact table over a date range yields small per-day frames; the
+date-dependent ``usp_KPI_*`` results for any window inside that range are then
+re-derived from the rollups without touching the database again. The "Day"
+column holds the fact table's own date text and windows compare against it
+exactly as the SQL ``BETWEEN`` does, so the numbers match the dashboard.
+"""
+import numpy as np
+import pandas as pd
+
+import kpi_engine
+
+DAILY_QUERIES = {
+    "sales": """
+        SELECT LastEditedWhen AS Day, StockItemID,
+               COUNT(*) AS Lines,
+               COUNT(DISTINCT InvoiceID) AS Invoices,
+               SUM(Quantity) AS Quantity,
+               SUM(ExtendedPrice) AS Revenue,
+               SUM(LineProfit) AS Profit
+        FROM SalesInvoiceLines
+        WHERE LastEditedWhen BETWEEN ? AND ?
+        GROUP BY LastEditedWhen, StockItemID
+    """,
+    "tax": """
+        SELECT LastEditedWhen AS Day, TaxRate,
+               COUNT(*) AS Lines,
+               SUM(ExpectedTaxAmount) AS ExpectedTaxAmount,
+               SUM(TaxAmount) AS RecordedTaxAmount
+        FROM SalesInvoiceLines
+        WHERE LastEditedWhen BETWEEN ? AND ?
+        GROUP BY LastEditedWhen, TaxRate
+    """,
+    "purchases": """
+        SELECT pol.LastReceiptDate AS Day, pol.StockItemID, po.SupplierID,
+               COUNT(*) AS Lines,
+               SUM(pol.OrderedOuters) AS QtyPurchased,
+               SUM(pol.PurchaseValue) AS PurchaseValue
+        FROM PurchaseOrderLines pol
+        LEFT JOIN PurchaseOrders po
+            ON po.PurchaseOrderID = pol.PurchaseOrderID
+        WHERE pol.LastReceiptDate BETWEEN ? AND ?
+        GROUP BY pol.LastReceiptDate, pol.StockItemID, po.SupplierID
+    """,
+    "stock": """
+        SELECT sit.TransactionOccurredWhen AS Day, tt.TransactionTypeName,
+               COUNT(*) AS TxnCount,
+               SUM(sit.Quantity) AS Quantity
+        FROM StockItemTransactions sit
+        LEFT JOIN ApplicationTransactionTypes tt
+            ON tt.TransactionTypeID = sit.TransactionTypeID
+        WHERE sit.TransactionOccurredWhen BETWEEN ? AND ?
+        GROUP BY sit.TransactionOccurredWhen, tt.TransactionTypeName
+    """,
+}
+
+DIMENSION_QUERIES = {
+    "items": "SELECT StockItemID, StockItemName FROM WarehouseStockItem",
+    "item_groups": """
+        SELECT sisg.StockItemID, sg.StockGroupID, sg.StockGroupName
+        FROM StockItemsStockGroups sisg
+        JOIN WarehouseStockGroups sg
+            ON sg.StockGroupID = sisg.StockGroupID
+        ORDER BY sisg.StockItemID, sg.StockGroupID
+    """,
+    "suppliers": "SELECT SupplierID, SupplierName FROM PurchasingSuppliers",
+}
+
+# KPIs re-derivable from the rollups
+WINDOW_KPIS = ["sales_vs_pur", "avg_margin_with_group", "movement", "txn_dist",
+               "tax_variance", "sales_by_group", "imbalance"]
+
+
+def load_daily(s, e):
+    """Scan each fact table once over [s, e] into per-day frames sorted by Day."""
+    params = (kpi_engine._sql_param(s), kpi_engine._sql_param(e))
+    daily = {name: pd.read_sql(query, kpi_engine.engine, params=params).sort_values("Day", kind="stable")
+             for name, query in DAILY_QUERIES.items()}
+    daily.update({name: pd.read_sql(query, kpi_engine.engine) for name, query in DIMENSION_QUERIES.items()})
+    return daily
+
+
+def label_windows(frame, windows):
+    """Rows of a per-day frame once per window containing them, tagged with the window's index.
+
+    Windows are (start, end) datetime pairs; rows are located by binary search
+    on the sorted Day column, so each window costs O(log n) plus its rows.
+    """
+    days = frame["Day"].to_numpy()
+    lo = np.searchsorted(days, [kpi_engine._sql_param(s) for s, _ in windows], "left")
+    hi = np.searchsorted(days, [kpi_engine._sql_param(e) for _, e in windows], "right")
+    hi = np.maximum(hi, lo)
+    rows = np.concatenate([np.arange(a, b) for a, b in zip(lo, hi)]) if len(windows) else np.array([], int)
+    labelled = frame.iloc[rows].reset_index(drop=True)
+    labelled.insert(0, "Window", np.repeat(np.arange(len(windows)), hi - lo))
+    return labelled
+
+
+def _pct(numerator, denominator):
+    return (numerator * 100.0 / denominator.replace(0, np.nan)).round(2)
+
+
+def _ordered(df, kpi_name):
+    order = [("Window", "ASC")] + kpi_engine.sort_spec(kpi_name)
+    df = df.sort_values([c for c, _ in order], ascending=[d == "ASC" for _, d in order], kind="stable")
+    return kpi_engine.apply_schema(df.reset_index(drop=True), kpi_name)
+
+
+def _per_window(df, column, windows):
+    # Single-row KPIs: one total per window, NULL (NaN) for windows without rows
+    return df.groupby("Window")[column].sum().reindex(range(len(windows)))
+
+
+def multi_window_kpis(daily, windows):
+    """Date-dependent KPI frames for many windows at once, with a leading Window index column.
+
+    Every KPI is aggregated once over all windows (grouping by Window), so the
+    per-window cost is just the rows it covers rather than a fixed pandas
+    overhead per query.
+    """
+    sales, tax, purchases, stock = (label_windows(daily[name], windows) for name in DAILY_QUERIES)
+    items, item_groups, suppliers = daily["items"], daily["item_groups"], daily["suppliers"]
+    kpis = {}
+
+    kpis["sales_vs_pur"] = pd.DataFrame({
+        "Window": range(len(windows)),
+        "TotalSales": _per_window(sales, "Revenue", windows).to_numpy(),
+        "TotalPurchases": _per_window(purchases, "PurchaseValue", windows).to_numpy(),
+    })
+    kpis["movement"] = pd.DataFrame({
+        "Window": range(len(windows)),
+        "TotalMovementVolume": _per_window(stock, "Quantity", windows).to_numpy(),
+    })
+
+    by_type = (stock.dropna(subset=["TransactionTypeName"])
+               .groupby(["Window", "TransactionTypeName"], as_index=False)["TxnCount"].sum())
+    by_type["PctShare"] = by_type["TxnCount"] * 100.0 / by_type.groupby("Window")["TxnCount"].transform("sum")
+    kpis["txn_dist"] = _ordered(by_type, "txn_dist")
+
+    kpis["tax_variance"] = _ordered(
+        tax.groupby(["Window", "TaxRate"], as_index=False)[["ExpectedTaxAmount", "RecordedTaxAmount"]].sum()
+        .assign(TaxVariance=lambda df: df["RecordedTaxAmount"] - df["ExpectedTaxAmount"]),
+        "tax_variance")
+
+    per_item = (sales.groupby(["Window", "StockItemID"], as_index=False)
+                [["Lines", "Invoices", "Quantity", "Revenue", "Profit"]].sum())
+    margin = (per_item.merge(items, on="StockItemID")
+              .merge(item_groups, on="StockItemID", how="left"))
+    kpis["avg_margin_with_group"] = _ordered(pd.DataFrame({
+        "Window": margin["Window"],
+        "StockItemID": margin["StockItemID"],
+        "StockItemName": margin["StockItemName"],
+        "StockGroupID": margin["StockGroupID"],
+        "StockGroupName": margin["StockGroupName"],
+        "AvgMargin": margin["Profit"] / margin["Lines"],
+        "InvoiceCount": margin["Invoices"],
+        "TotalProfit": margin["Profit"],
+        "TotalRevenue": margin["Revenue"],
+        "MarginPct": _pct(margin["Profit"], margin["Revenue"]),
+    }), "avg_margin_with_group")
+
+    group_sales = (per_item.merge(item_groups, on="StockItemID")
+                   .groupby(["Window", "StockGroupID", "StockGroupName"], as_index=False)
+                   [["Quantity", "Profit", "Revenue"]].sum())
+    kpis["sales_by_group"] = _ordered(pd.DataFrame({
+        "Window": group_sales["Window"],
+        "StockGroupID": group_sales["StockGroupID"],
+        "StockGroupName": group_sales["StockGroupName"],
+        "TotalUnitsSold": group_sales["Quantity"],
+        "TotalProfit": group_sales["Profit"],
+        "TotalRevenue": group_sales["Revenue"],
+        "GrossMarginPct": _pct(group_sales["Profit"], group_sales["Revenue"]),
+    }), "sales_by_group")
+
+    purch = (purchases.dropna(subset=["SupplierID"])
+             .groupby(["Window", "StockItemID", "SupplierID"], as_index=False)["QtyPurchased"].sum())
+    imb = purch.merge(per_item[["Window", "StockItemID", "Quantity"]].rename(columns={"Quantity": "QtySold"}),
+                      on=["Window", "StockItemID"], how="left").fillna({"QtySold": 0})
+    group_names = item_groups.groupby("StockItemID")["StockGroupName"].agg(", ".join).rename("StockGroupNames")
+    imb = (imb.merge(items, on="StockItemID").merge(suppliers, on="SupplierID")
+           .merge(group_names, on="StockItemID", how="left"))
+    kpis["imbalance"] = _ordered(pd.DataFrame({
+        "Window": imb["Window"],
+        "StockItemID": imb["StockItemID"],
+        "StockItemName": imb["StockItemName"],
+        "StockGroupNames": imb["StockGroupNames"],
+        "SupplierID": imb["SupplierID"].astype("int64"),
+        "SupplierName": imb["SupplierName"],
+        "QtyPurchased": imb["QtyPurchased"],
+        "QtySold": imb["QtySold"].astype("int64"),
+        "NetBuildUp": imb["QtyPurchased"] - imb["QtySold"],
+        "PurchaseToSalesRatio": imb["QtyPurchased"] / imb["QtySold"].replace(0, np.nan),
+    }), "imbalance")
+    return kpis
+
+
+def window_kpis(daily, s, e):
+    """Date-dependent KPI frames for one window, matching the catalog queries."""
+    return {name: frame.drop(columns="Window") for name, frame in multi_window_kpis(daily, [(s, e)]).items()}
@@ -0,0 +1,155 @@
+"""Persisted derived measures and the covering indexes that read them.
+
+    python kpi_schema.py                 # migrate mydb.db in place (idempotent)
+    python kpi_schema.py --explain       # then show the plans of the tax and cost KPIs
+
+The per-line tax, cost of sales and purchase value expressions are computed
+once per row into ordinary columns: the migration adds and backfills them,
+and triggers recompute a row's measures whenever it is inserted or its inputs
+are updated, so no writer has to know about them. The covering indexes lead
+with the date key and carry every column the tax, cost and headline KPIs
+read, so those KPIs scan the index alone and never touch the table rows.
+
+These are not generated columns because SQLite (as of 3.40) never treats an
+index as covering for a query that reads a generated column.
+
+On a year-partitioned connection (see kpi_partitions) the fact table names
+are TEMP views, so every physical copy of a table (``main`` and each mutable
+``p<year>`` partition) is migrated by its qualified name, with its triggers
+and indexes created in its own file. Frozen partitions are attached
+read-only: ``split`` and ``freeze`` migrate them before they are frozen.
+"""
+import argparse
+import contextlib
+import time
+
+import kpi_engine
+
+# Table -> {column: expression} of the derived measures stored on it
+DERIVED_COLUMNS = {
+    "SalesInvoiceLines": {
+        "ExpectedTaxAmount": "ROUND(ExtendedPrice * (TaxRate / (100.0 + TaxRate)), 2)",
+        "CostOfSales": "ExtendedPrice - LineProfit",
+    },
+    "PurchaseOrderLines": {
+        "PurchaseValue": "ExpectedUnitPricePerOuter * OrderedOuters",
+    },
+}
+# Columns the measures are computed from; updating one of them recomputes the row's measures
+DERIVED_INPUTS = {
+    "SalesInvoiceLines": ["ExtendedPrice", "TaxRate", "LineProfit"],
+    "PurchaseOrderLines": ["ExpectedUnitPricePerOuter", "OrderedOuters"],
+}
+
+# The plain date indexes stay: queries that need other columns of the rows walk those faster
+COVERING_INDEXES = {
+    "SalesInvoiceLines": """
+    CREATE INDEX IF NOT EXISTS {schema}.idx_SalesInvoiceLines_LastEditedWhen_Measures ON SalesInvoiceLines(
+        LastEditedWhen, TaxRate, ExtendedPrice, LineProfit, TaxAmount, ExpectedTaxAmount, CostOfSales)
+    """,
+    "PurchaseOrderLines": """
+    CREATE INDEX IF NOT EXISTS {schema}.idx_PurchaseOrderLines_LastReceiptDate_Value ON PurchaseOrderLines(
+        LastReceiptDate, PurchaseValue)
+    """,
+}
+
+# KPIs whose plans --explain shows, with the parameters to plan them for
+_YEAR = ("2015-01-01", "2015-12-31 23:59:59")
+EXPLAINED_PROCS = {
+    "dbo.usp_KPI_SupposedTaxAmount": _YEAR,
+    "dbo.usp_KPI_COGSvsPurchases": (),
+    "dbo.usp_KPI_SalesVsPurchases": _YEAR * 2,
+    "dbo.usp_KPI_HeadlinePeriods": _YEAR + ("2014-01-01", "2014-12-31 23:59:59"),
+}
+
+
+def _assignments(table):
+    return ", ".join(f"{column} = {expression}" for column, expression in DERIVED_COLUMNS[table].items())
+
+
+def derived_triggers(table, schema="main"):
+    # A trigger's unqualified table names resolve in its own file. The recomputing UPDATE only
+    # sets derived columns, so it does not fire the UPDATE OF trigger again
+    update = f"UPDATE {table} SET {_assignments(table)} WHERE rowid = NEW.rowid;"
+    return [
+        f"CREATE TRIGGER IF NOT EXISTS {schema}.trg_{table}_DerivedInsert AFTER INSERT ON {table} BEGIN {update} END",
+        f"CREATE TRIGGER IF NOT EXISTS {schema}.trg_{table}_DerivedUpdate AFTER UPDATE OF "
+        f"{', '.join(DERIVED_INPUTS[table])} ON {table} BEGIN {update} END",
+    ]
+
+
+def missing_columns(conn, table, schema="main"):
+    present = {row[1] for row in conn.execute(f"PRAGMA {schema}.table_info({table})")}
+    return [column for column in DERIVED_COLUMNS[table] if column not in present]
+
+
+def physical_schemas(conn, table):
+    """Schemas of the files attached to ``conn`` that hold ``table`` as a table (not a view)."""
+    schemas = [row[1] for row in conn.execute("PRAGMA database_list") if row[1] != "temp"]
+    return [schema for schema in schemas if conn.execute(
+        f"SELECT 1 FROM {schema}.sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()]
+
+
+def migrate_schema(conn):
+    """Add, backfill and maintain the derived columns and create the covering indexes in every file of ``conn``.
+
+    Returns the qualified tables added to. Raises ValueError if a frozen
+    partition still lacks the columns, as it cannot be written.
+    """
+    frozen = kpi_engine.PARTITIONS.frozen_schemas() if kpi_engine.PARTITIONS is not None else set()
+    changed = []
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        for table in DERIVED_COLUMNS:
+            for schema in physical_schemas(conn, table):
+                missing = missing_columns(conn, table, schema)
+                if schema in frozen:
+                    if missing:
+                        raise ValueError(f"Frozen partition {schema} lacks {', '.join(missing)} on {table}; "
+                                         "migrate its file with kpi_schema.py --db before freezing it")
+                    continue
+                for column in missing:
+                    conn.execute(f"ALTER TABLE {schema}.{table} ADD COLUMN {column} REAL")
+                if missing:
+                    conn.execute(f"UPDATE {schema}.{table} SET {_assignments(table)}")
+                    changed.append(f"{schema}.{table}")
+                for ddl in derived_triggers(table, schema):
+                    conn.execute(ddl)
+                conn.execute(COVERING_INDEXES[table].format(schema=schema))
+    return changed
+
+
+def migrate(db_path=None):
+    """Migrate a database file through its own read-write connection."""
+    with contextlib.closing(kpi_engine.connect_db(db_path, "default")) as conn:
+        return migrate_schema(conn)
+
+
+def explain(db_path=None):
+    """{proc: EXPLAIN QUERY PLAN details} of the KPIs the covering indexes serve."""
+    plans = {}
+    with contextlib.closing(kpi_engine.connect_db(db_path, "default")) as conn:
+        for proc, params in EXPLAINED_PROCS.items():
+            rows = conn.execute("EXPLAIN QUERY PLAN " + kpi_engine.get_query(proc), params).fetchall()
+            plans[proc] = [row[3] for row in rows]
+    return plans
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", default=kpi_engine.DB_PATH)
+    parser.add_argument("--explain", action="store_true", help="print the plans of the tax and cost KPIs")
+    args = parser.parse_args()
+    started = time.perf_counter()
+    changed = migrate(args.db)
+    seconds = time.perf_counter() - started
+    print(f"Backfilled {', '.join(changed) or 'no tables'} in {seconds * 1000:.0f} ms")
+    if args.explain:
+        for proc, details in explain(args.db).items():
+            print(proc)
+            for detail in details:
+                print(f"    {detail}")
+
+
+if __name__ == "__main__":
+    main()
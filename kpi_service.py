@@ -0,0 +1,132 @@
+"""Headless HTTP/JSON access to the dashboard KPIs.
+
+    python kpi_service.py --port 8600
+
+    GET /kpis                                   catalog of available KPIs
+    GET /kpis/<name>?start=2013-01-01&end=2016-12-31[&format=json|arrow]
+    GET /cache                                  process RSS and result cache memory per KPI
+
+Responses carry an ETag derived from the KPI's result-cache key (its
+parameters and the versions of the tables it reads); clients sending it back
+in If-None-Match get a 304 without any query being run. Empty results and
+query errors (500) carry no ETag. Results come from the engine's RESULT_CACHE, the same cache
+the dashboard uses when the service runs inside the Streamlit process
+(``KPI_SERVICE_PORT``).
+"""
+import argparse
+import datetime as dt
+import hashlib
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pyarrow as pa
+
+import kpi_engine
+
+DEFAULT_START = dt.date(2013, 1, 1)
+DEFAULT_END = dt.date(2016, 12, 31)
+ARROW_STREAM = "application/vnd.apache.arrow.stream"
+
+
+def _etag(*parts):
+    return '"' + hashlib.sha1("|".join(map(str, parts)).encode()).hexdigest()[:20] + '"'
+
+
+def encode_json(df):
+    """Compact column/row JSON of a KPI frame."""
+    return df.to_json(orient="split", index=False, date_format="iso").encode()
+
+
+def encode_arrow(df):
+    """Arrow IPC stream of a KPI frame."""
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+class KPIRequestHandler(BaseHTTPRequestHandler):
+    server_version = "KPIService/1.0"
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = [p for p in url.path.split("/") if p]
+        if parts == ["kpis"]:
+            catalog = {name: {"window": spec["window"], "top_n": spec.get("top_n")}
+                       for name, spec in kpi_engine.KPI_CATALOG.items()}
+            return self._send(200, json.dumps(catalog).encode(), "application/json")
+        if parts == ["cache"]:
+            memory = {"process": kpi_engine.process_memory(), "cache": kpi_engine.RESULT_CACHE.stats(),
+                      "held": kpi_engine.cache_memory().to_dict(orient="records")}
+            return self._send(200, json.dumps(memory, default=int).encode(), "application/json")
+        if len(parts) != 2 or parts[0] != "kpis" or parts[1] not in kpi_engine.KPI_CATALOG:
+            return self._send(404, b'{"error": "unknown KPI"}', "application/json")
+
+        name, query = parts[1], parse_qs(url.query)
+        try:
+            start = dt.date.fromisoformat(query.get("start", [DEFAULT_START.isoformat()])[0])
+            end = dt.date.fromisoformat(query.get("end", [DEFAULT_END.isoformat()])[0])
+        except ValueError:
+            return self._send(400, b'{"error": "start/end must be YYYY-MM-DD"}', "application/json")
+        fmt = query.get("format", ["json"])[0]
+        if fmt not in ("json", "arrow"):
+            return self._send(400, b'{"error": "format must be json or arrow"}', "application/json")
+
+        # The cache key changes only when a table the KPI reads does; windowless KPIs share one
+        s, e = kpi_engine.window_bounds(start, end)
+        key = kpi_engine._cache_key(name, s, e)
+        etag = _etag(key, fmt)
+        if etag in [tag.strip() for tag in self.headers.get("If-None-Match", "").split(",")]:
+            return self._send(304, b"", None, etag)
+
+        try:
+            with kpi_engine.collect_errors() as errors:
+                df = kpi_engine.load_kpi(name, s, e, key)
+        except kpi_engine.QueryInterrupted as exc:
+            return self._send(504, json.dumps({"error": str(exc)}).encode(), "application/json")
+        if errors:
+            return self._send(500, json.dumps({"error": "; ".join(errors)}).encode(), "application/json")
+        if df.empty:
+            etag = None  # nothing worth revalidating; let clients ask again
+        if fmt == "arrow":
+            return self._send(200, encode_arrow(df), ARROW_STREAM, etag)
+        return self._send(200, encode_json(df), "application/json", etag)
+
+    def _send(self, status, body, content_type, etag=None):
+        self.send_response(status)
+        if content_type:
+            self.send_header("Content-Type", content_type)
+        if etag:
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", "no-cache")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # keep the dashboard's console quiet
+
+
+def serve_in_background(port, host="127.0.0.1"):
+    """Start the service on a daemon thread of the current process and return the server."""
+    server = ThreadingHTTPServer((host, port), KPIRequestHandler)
+    threading.Thread(target=server.serve_forever, name="kpi-service", daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8600)
+    parser.add_argument("--db", default=kpi_engine.DB_PATH, help="database file to serve")
+    args = parser.parse_args()
+    kpi_engine.use_database(args.db)
+    print(f"Serving KPIs from {args.db} on http://{args.host}:{args.port}/kpis")
+    ThreadingHTTPServer((args.host, args.port), KPIRequestHandler).serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""Month-end stock balances for point-in-time on-hand inventory.
+
+    python kpi_stock.py                  # extend the balances with new stock transactions
+    python kpi_stock.py --rebuild        # recompute them from scratch
+
+StockBalances holds every item's on-hand quantity (the running sum of its
+signed StockItemTransactions) at the end of each calendar month, one row per
+item from its first transaction on. On-hand at any moment is the balance of
+the last month-end before it plus the transactions since, so
+``dbo.usp_KPI_StockOnHand`` reads at most one month of transactions.
+
+Refreshes are incremental: BalanceWatermarks remembers the last
+StockItemTransactionID folded in, and the months from the earliest month of
+the newer transactions onwards are recomputed from the balance before them.
+Stock transactions are append-only; rebuild after editing existing ones.
+"""
+import argparse
+import contextlib
+import time
+
+import pandas as pd
+
+import kpi_engine
+
+BALANCE_DDL = [
+    """
+    CREATE TABLE IF NOT EXISTS StockBalances (
+        MonthEnd TEXT NOT NULL,
+        StockItemID INTEGER NOT NULL,
+        QuantityOnHand INTEGER NOT NULL,
+        PRIMARY KEY (MonthEnd, StockItemID)
+    ) WITHOUT ROWID
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS BalanceWatermarks (
+        SourceTable TEXT PRIMARY KEY,
+        LastID INTEGER NOT NULL
+    )
+    """,
+]
+
+
+def merge_new_transactions(conn):
+    """Recompute the month-end balances touched by transactions above the watermark, in the caller's transaction."""
+    row = conn.execute("SELECT LastID FROM BalanceWatermarks WHERE SourceTable = 'StockItemTransactions'").fetchone()
+    last_id = row[0] if row else 0
+    high, new_txns, first_month, last_month = conn.execute(
+        "SELECT MAX(StockItemTransactionID), COUNT(*), MIN(substr(TransactionOccurredWhen, 1, 7)), "
+        "MAX(substr(TransactionOccurredWhen, 1, 7)) FROM StockItemTransactions WHERE StockItemTransactionID > ?",
+        (last_id,)).fetchone()
+    if not new_txns:
+        return 0
+    last_month = max(last_month, conn.execute("SELECT COALESCE(MAX(MonthEnd), '') FROM StockBalances").fetchone()[0])
+
+    opening = pd.DataFrame(conn.execute(
+        "SELECT StockItemID, QuantityOnHand FROM StockBalances "
+        "WHERE MonthEnd = (SELECT MAX(MonthEnd) FROM StockBalances WHERE MonthEnd < ?)", (first_month,)
+    ).fetchall(), columns=["StockItemID", "QuantityOnHand"]).astype("int64")
+    # Month texts sort before their own days: '2014-03' < '2014-03-01'
+    deltas = pd.DataFrame(conn.execute(
+        "SELECT substr(TransactionOccurredWhen, 1, 7), StockItemID, SUM(Quantity) FROM StockItemTransactions "
+        "WHERE TransactionOccurredWhen >= ? GROUP BY 1, 2", (first_month,)
+    ).fetchall(), columns=["MonthEnd", "StockItemID", "Quantity"])
+
+    months = pd.period_range(first_month, last_month, freq="M").strftime("%Y-%m")
+    moves = deltas.pivot_table(index="MonthEnd", columns="StockItemID", values="Quantity", aggfunc="sum")
+    items = moves.columns.union(pd.Index(opening["StockItemID"]))
+    moves = moves.reindex(index=months, columns=items)
+    # An item gets a row every month from the first one it has a balance in
+    held = moves.notna().cummax() | moves.columns.isin(opening["StockItemID"])
+    balances = moves.fillna(0).cumsum() + opening.set_index("StockItemID")["QuantityOnHand"].reindex(items).fillna(0)
+    balances = balances.where(held).stack().astype("int64")
+
+    conn.execute("DELETE FROM StockBalances WHERE MonthEnd >= ?", (first_month,))
+    conn.executemany("INSERT INTO StockBalances VALUES (?, ?, ?)",
+                     ((month, int(item), int(qty)) for (month, item), qty in balances.items()))
+    conn.execute(
+        "INSERT INTO BalanceWatermarks VALUES ('StockItemTransactions', ?) "
+        "ON CONFLICT (SourceTable) DO UPDATE SET LastID = excluded.LastID",
+        (high,))
+    return new_txns
+
+
+def refresh_balances(conn, rebuild=False):
+    """Fold stock transactions newer than the watermark into StockBalances; returns how many were folded."""
+    with conn:
+        for ddl in BALANCE_DDL:
+            conn.execute(ddl)
+        if rebuild:
+            conn.execute("DELETE FROM StockBalances")
+            conn.execute("DELETE FROM BalanceWatermarks")
+        return merge_new_transactions(conn)
+
+
+def refresh(db_path=None, rebuild=False):
+    """Refresh the balances of a database file through its own read-write connection."""
+    with contextlib.closing(kpi_engine.connect_db(db_path, "default")) as conn:
+        return refresh_balances(conn, rebuild)
+
+
+def item_history(item_id, s, e):
+    """One item's month-end balances over [s, e], then its on-hand at ``e`` as the last row."""
+    def compute():
+        start, end = kpi_engine._sql_param(s), kpi_engine._sql_param(e)
+        months = pd.read_sql(
+            "SELECT MonthEnd AS Period, QuantityOnHand FROM StockBalances "
+            "WHERE StockItemID = ? AND MonthEnd BETWEEN substr(?, 1, 7) AND substr(?, 1, 7) "
+            "AND date(MonthEnd || '-01', '+1 month', '-1 day') <= date(?) ORDER BY MonthEnd",
+            kpi_engine.engine, params=(int(item_id), start, end, end))
+        now = kpi_engine.run_proc("dbo.usp_KPI_StockOnHand", (s, e), where="StockItemID = ?",
+                                  where_params=(int(item_id),))
+        current = pd.DataFrame({"Period": [end[:10]],
+                                "QuantityOnHand": [now["QuantityOnHand"].sum()]})
+        return pd.concat([months, current], ignore_index=True)
+
+    key = ("stock_history", int(item_id), (s, e), kpi_engine.DB_PATH,
+           kpi_engine.TABLE_VERSIONS.version(kpi_engine.kpi_tables("stock_on_hand")))
+    return kpi_engine.RESULT_CACHE.get_or_compute(key, compute)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", default=kpi_engine.DB_PATH)
+    parser.add_argument("--rebuild", action="store_true", help="recompute the balances from scratch")
+    args = parser.parse_args()
+    started = time.perf_counter()
+    folded = refresh(args.db, args.rebuild)
+    seconds = time.perf_counter() - started
+    with contextlib.closing(kpi_engine.connect_db(args.db, "default")) as conn:
+        rows, months = conn.execute("SELECT COUNT(*), COUNT(DISTINCT MonthEnd) FROM StockBalances").fetchone()
+    print(f"Folded {folded:,} stock transactions in {seconds * 1000:.0f} ms -> "
+          f"{rows:,} balances over {months:,} month-ends")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""Result-cache behaviour of KPI loads that report query errors.
+
+    python -m pytest -q test_kpi_engine.py
+"""
+import datetime as dt
+import pathlib
+import shutil
+import threading
+
+import pandas as pd
+import pytest
+
+import kpi_engine
+
+SAMPLE_DB = pathlib.Path(__file__).with_name("mydb.db")
+
+
+@pytest.fixture
+def database(tmp_path):
+    db = tmp_path / "kpis.db"
+    shutil.copyfile(SAMPLE_DB, db)
+    previous = kpi_engine.DB_PATH
+    kpi_engine.use_database(str(db))
+    kpi_engine.RESULT_CACHE.clear()
+    yield db
+    kpi_engine.use_database(previous)
+    kpi_engine.RESULT_CACHE.clear()
+
+
+def test_failed_load_is_retried_and_reports_its_error_each_time(database, monkeypatch):
+    get_query, broken = kpi_engine.get_query, {"on": True}
+
+    def flaky(name):
+        if name == "dbo.usp_KPI_GrossProfit" and broken["on"]:
+            return "SELECT NoSuchColumn FROM SalesInvoiceLines"
+        return get_query(name)
+
+    monkeypatch.setattr(kpi_engine, "get_query", flaky)
+    for _ in range(2):
+        executions = kpi_engine.RESULT_CACHE.flight.executions
+        with kpi_engine.collect_errors() as errors:
+            df = kpi_engine.load_kpi("gross")
+        assert df.empty and len(errors) == 1 and "NoSuchColumn" in errors[0]
+        assert kpi_engine.RESULT_CACHE.flight.executions == executions + 1  # ran again, not served from cache
+
+    broken["on"] = False
+    with kpi_engine.collect_errors() as errors:
+        df = kpi_engine.load_kpi("gross")
+    assert not errors and len(df) == 1
+    executions = kpi_engine.RESULT_CACHE.flight.executions
+    assert kpi_engine.load_kpi("gross") is df and kpi_engine.RESULT_CACHE.flight.executions == executions
+
+
+def test_sessions_sharing_a_failed_load_all_see_its_error():
+    cache, started, release = kpi_engine.ResultCache(), threading.Event(), threading.Event()
+
+    def failing():
+        started.set()
+        release.wait(5)
+        kpi_engine._report_error("query failed")
+        return pd.DataFrame()
+
+    seen = {}
+
+    def load(name):
+        with kpi_engine.collect_errors() as errors:
+            cache.get_or_compute(("kpi", dt.date(2015, 1, 1)), failing)
+        seen[name] = errors
+
+    leader = threading.Thread(target=load, args=("leader",))
+    leader.start()
+    started.wait(5)
+    waiter = threading.Thread(target=load, args=("waiter",))
+    waiter.start()
+    while cache.flight.coalesced == 0:
+        pass
+    release.set()
+    leader.join()
+    waiter.join()
+    assert seen == {"leader": ["query failed"], "waiter": ["query failed"]}
+    assert cache.stats()["entries"] == 0